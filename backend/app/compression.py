@@ -0,0 +1,110 @@
+"""
+Response compression, brotli when the optional `brotli` package is installed and accepted by the
+client, gzip otherwise. Only complete bodies of compressible types above COMPRESSION_MIN_SIZE are
+compressed: streamed responses (Server-Sent Events, blob downloads) are passed through so they are
+still flushed chunk by chunk.
+"""
+import gzip
+from typing import Optional, Set
+from starlette.datastructures import Headers, MutableHeaders
+from app.config import COMPRESSION_BROTLI_QUALITY, COMPRESSION_GZIP_LEVEL, COMPRESSION_MIN_SIZE
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_TYPES = ("application/json", "text/plain", "text/html", "text/csv", "application/x-ndjson")
+
+
+def accepted_encodings(accept_encoding: str) -> Set[str]:
+    """
+    Encodings accepted by an Accept-Encoding header (with a non-zero quality).
+    """
+    accepted = set()
+    for item in accept_encoding.lower().split(","):
+        name, *params = item.split(";")
+        quality = 1.0
+        for param in params:
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            accepted.add(name.strip())
+    return accepted
+
+
+def accepted_encoding(accept_encoding: str) -> Optional[str]:
+    """
+    Picks the encoding of the response from the Accept-Encoding header, preferring brotli.
+    """
+    accepted = accepted_encodings(accept_encoding)
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=COMPRESSION_BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=COMPRESSION_GZIP_LEVEL)
+
+
+class CompressionMiddleware:
+    """
+    ASGI middleware compressing the single-message response bodies.
+    """
+
+    def __init__(self, app, minimum_size: int = COMPRESSION_MIN_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        encoding = accepted_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message = None
+        passthrough = False
+
+        async def send_compressed(message):
+            nonlocal start_message, passthrough
+            if passthrough:
+                await send(message)
+                return
+
+            if message["type"] == "http.response.start":
+                headers = Headers(raw=message["headers"])
+                content_type = headers.get("content-type", "").split(";")[0].strip()
+                if "content-encoding" in headers or content_type not in COMPRESSIBLE_TYPES:
+                    passthrough = True
+                    await send(message)
+                else:
+                    start_message = message  # Held until the body shows whether it is worth compressing
+                return
+
+            body = message.get("body", b"")
+            headers = MutableHeaders(raw=start_message["headers"])
+            headers.add_vary_header("Accept-Encoding")
+            if not message.get("more_body", False) and len(body) >= self.minimum_size:
+                body = compress(body, encoding)
+                headers["Content-Encoding"] = encoding
+                headers["Content-Length"] = str(len(body))
+                message = {**message, "body": body}
+
+            # Streamed bodies and small bodies are sent as they are
+            passthrough = True
+            await send(start_message)
+            await send(message)
+
+        await self.app(scope, receive, send_compressed)
@@ -4,15 +4,131 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
-# Firestore Project
+# Firestore Project, FIRESTORE_BACKEND=memory runs on an in-memory stand-in instead (local runs, benchmarks)
 FIRESTORE_PROJECT_ID = os.environ.get("FIRESTORE_PROJECT_ID", "your-project-id")
+FIRESTORE_BACKEND = os.environ.get("FIRESTORE_BACKEND", "firestore")
 
 # JWT Settings
 SECRET_KEY = os.environ.get("SECRET_KEY", secrets.token_hex(32))
+SECRET_KEY_GENERATED = not os.environ.get("SECRET_KEY")  # Random per process, tokens only valid on the process that signed them
+SECRET_KEY_FINGERPRINT = os.environ.get("SECRET_KEY_FINGERPRINT", "")  # Set by app.server for its workers to check
 ALGORITHM = os.environ.get("ALGORITHM", "HS256")
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.environ.get("ACCESS_TOKEN_EXPIRE_MINUTES", 480))
 
 # BACKEND & FRONTEND URLs
 BACKEND_URL = os.environ.get("BACKEND_URL", "http://localhost:8000")
 FRONTEND_URL = os.environ.get("FRONTEND_URL", "http://localhost:3000")
-GENAI_API_URL = os.environ.get("GENAI_API_URL", "http://localhost:8080")
\ No newline at end of file
+GENAI_API_URL = os.environ.get("GENAI_API_URL", "http://localhost:8080")
+GENAI_LLM_STREAM_PATH = os.environ.get("GENAI_LLM_STREAM_PATH", "/llm/stream")  # Streaming variant of /llm/invoke
+GENAI_BACKEND = os.environ.get("GENAI_BACKEND", "http")  # "fake" serves the GenAI calls in-process (app.fake_genai)
+
+# Number of attempts of a Firestore transaction before giving up on contention
+FIRESTORE_TRANSACTION_MAX_ATTEMPTS = int(os.environ.get("FIRESTORE_TRANSACTION_MAX_ATTEMPTS", 5))
+
+# Authenticated user lookup cache
+USER_CACHE_MAX_SIZE = int(os.environ.get("USER_CACHE_MAX_SIZE", 1024))
+USER_CACHE_TTL_SECONDS = int(os.environ.get("USER_CACHE_TTL_SECONDS", 300))
+
+# GenAI HTTP client (shared connection pool)
+GENAI_MAX_CONNECTIONS = int(os.environ.get("GENAI_MAX_CONNECTIONS", 100))
+GENAI_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("GENAI_MAX_KEEPALIVE_CONNECTIONS", 20))
+GENAI_KEEPALIVE_EXPIRY_SECONDS = float(os.environ.get("GENAI_KEEPALIVE_EXPIRY_SECONDS", 30))
+GENAI_HTTP2 = os.environ.get("GENAI_HTTP2", "false").lower() == "true"
+GENAI_CONNECT_TIMEOUT_SECONDS = float(os.environ.get("GENAI_CONNECT_TIMEOUT_SECONDS", 5))
+GENAI_STT_TIMEOUT_SECONDS = float(os.environ.get("GENAI_STT_TIMEOUT_SECONDS", 30))
+GENAI_LLM_TIMEOUT_SECONDS = float(os.environ.get("GENAI_LLM_TIMEOUT_SECONDS", 120))
+GENAI_MAX_RETRIES = int(os.environ.get("GENAI_MAX_RETRIES", 2))
+GENAI_RETRY_BACKOFF_SECONDS = float(os.environ.get("GENAI_RETRY_BACKOFF_SECONDS", 0.5))
+
+# LLM answer cache (opt-in), identical questions of a user in a conversation are answered once per TTL
+LLM_CACHE_ENABLED = os.environ.get("LLM_CACHE_ENABLED", "false").lower() == "true"
+LLM_CACHE_MAX_SIZE = int(os.environ.get("LLM_CACHE_MAX_SIZE", 1024))
+LLM_CACHE_TTL_SECONDS = int(os.environ.get("LLM_CACHE_TTL_SECONDS", 300))
+LLM_CACHE_MAX_ENTRY_BYTES = int(os.environ.get("LLM_CACHE_MAX_ENTRY_BYTES", 64 * 1024))
+LLM_CACHE_CONTEXT_LOOKBACK = int(os.environ.get("LLM_CACHE_CONTEXT_LOOKBACK", 10))  # Messages read to find the conversation state of a question
+
+# Background jobs (audio message processing)
+JOB_BACKEND = os.environ.get("JOB_BACKEND", "inprocess")
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 8))
+JOB_QUEUE_MAX_SIZE = int(os.environ.get("JOB_QUEUE_MAX_SIZE", 100))
+JOB_RETRY_AFTER_SECONDS = int(os.environ.get("JOB_RETRY_AFTER_SECONDS", 5))
+
+# Password hashing pool (bcrypt), bursts beyond the pending limit are rejected with a 503
+PASSWORD_HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", min(4, os.cpu_count() or 1)))
+PASSWORD_HASH_MAX_PENDING = int(os.environ.get("PASSWORD_HASH_MAX_PENDING", 32))
+PASSWORD_HASH_RETRY_AFTER_SECONDS = int(os.environ.get("PASSWORD_HASH_RETRY_AFTER_SECONDS", 2))
+
+# Rate limits of the GenAI-backed message endpoints, per user and for the whole service (0 disables a limit).
+# The "memory" backend limits each worker process separately
+RATE_LIMIT_ENABLED = os.environ.get("RATE_LIMIT_ENABLED", "true").lower() == "true"
+RATE_LIMIT_BACKEND = os.environ.get("RATE_LIMIT_BACKEND", "memory")
+RATE_LIMIT_USER_PER_MINUTE = float(os.environ.get("RATE_LIMIT_USER_PER_MINUTE", 30))
+RATE_LIMIT_USER_BURST = int(os.environ.get("RATE_LIMIT_USER_BURST", 10))
+RATE_LIMIT_USER_MAX_CONCURRENT = int(os.environ.get("RATE_LIMIT_USER_MAX_CONCURRENT", 3))
+RATE_LIMIT_GLOBAL_PER_MINUTE = float(os.environ.get("RATE_LIMIT_GLOBAL_PER_MINUTE", 0))
+RATE_LIMIT_GLOBAL_BURST = int(os.environ.get("RATE_LIMIT_GLOBAL_BURST", 100))
+RATE_LIMIT_GLOBAL_MAX_CONCURRENT = int(os.environ.get("RATE_LIMIT_GLOBAL_MAX_CONCURRENT", 100))
+RATE_LIMIT_CONCURRENCY_RETRY_AFTER_SECONDS = int(os.environ.get("RATE_LIMIT_CONCURRENCY_RETRY_AFTER_SECONDS", 2))
+RATE_LIMIT_SLOT_TTL_SECONDS = int(os.environ.get("RATE_LIMIT_SLOT_TTL_SECONDS", 300))  # Expiry of the in-flight slots in shared stores
+
+# Serialize the message and conversation lists directly with orjson (optional dependency)
+FAST_JSON_RESPONSES = os.environ.get("FAST_JSON_RESPONSES", "false").lower() == "true"
+
+# Response compression (brotli requires the optional `brotli` package, gzip is used otherwise)
+COMPRESSION_ENABLED = os.environ.get("COMPRESSION_ENABLED", "true").lower() == "true"
+COMPRESSION_MIN_SIZE = int(os.environ.get("COMPRESSION_MIN_SIZE", 1024))
+COMPRESSION_GZIP_LEVEL = int(os.environ.get("COMPRESSION_GZIP_LEVEL", 6))
+COMPRESSION_BROTLI_QUALITY = int(os.environ.get("COMPRESSION_BROTLI_QUALITY", 4))
+
+# Message & conversation pagination
+MESSAGES_PAGE_MAX_LIMIT = int(os.environ.get("MESSAGES_PAGE_MAX_LIMIT", 100))
+CONVERSATIONS_PAGE_MAX_LIMIT = int(os.environ.get("CONVERSATIONS_PAGE_MAX_LIMIT", 100))
+MESSAGES_BATCH_MAX_SIZE = int(os.environ.get("MESSAGES_BATCH_MAX_SIZE", 1000))  # Messages of a batch ingestion request
+MESSAGE_PREVIEW_LENGTH = int(os.environ.get("MESSAGE_PREVIEW_LENGTH", 100))
+EXPORT_PAGE_SIZE = int(os.environ.get("EXPORT_PAGE_SIZE", 500))  # Messages read (and held in memory) at a time by an export
+
+# Full-text search of the messages, served by an inverted index maintained on every message write
+SEARCH_INDEX_ENABLED = os.environ.get("SEARCH_INDEX_ENABLED", "true").lower() == "true"
+SEARCH_CANDIDATES_PER_TERM = int(os.environ.get("SEARCH_CANDIDATES_PER_TERM", 200))  # Postings read per query term
+SEARCH_MAX_QUERY_TERMS = int(os.environ.get("SEARCH_MAX_QUERY_TERMS", 8))
+SEARCH_MAX_TERMS_PER_MESSAGE = int(os.environ.get("SEARCH_MAX_TERMS_PER_MESSAGE", 100))  # Keeps a message update in one batch
+SEARCH_PAGE_MAX_LIMIT = int(os.environ.get("SEARCH_PAGE_MAX_LIMIT", 50))
+SEARCH_SNIPPET_LENGTH = int(os.environ.get("SEARCH_SNIPPET_LENGTH", 160))
+
+# Feedback and usage counters, maintained on every message and feedback write (sharded to spread the writes)
+STATS_ENABLED = os.environ.get("STATS_ENABLED", "true").lower() == "true"
+STATS_COUNTER_SHARDS = int(os.environ.get("STATS_COUNTER_SHARDS", 8))
+STATS_MAX_DAYS = int(os.environ.get("STATS_MAX_DAYS", 90))  # Days a stats request can cover
+STATS_ADMIN_USERS = [username for username in os.environ.get("STATS_ADMIN_USERS", "").split(",") if username.strip()]  # Users allowed to read the global stats
+
+# Out-of-line storage of the answer payloads (result tables and charts) larger than PAYLOAD_INLINE_MAX_BYTES,
+# off unless the blob store outlives the instances (the `gcs` backend of the deployments)
+PAYLOAD_STORAGE_ENABLED = os.environ.get("PAYLOAD_STORAGE_ENABLED", "false").lower() == "true"
+PAYLOAD_INLINE_MAX_BYTES = int(os.environ.get("PAYLOAD_INLINE_MAX_BYTES", 4096))
+PAYLOAD_COMPRESSION_LEVEL = int(os.environ.get("PAYLOAD_COMPRESSION_LEVEL", 9))  # Written once, read many times
+DATA_TABLE_CHUNK_ROWS = int(os.environ.get("DATA_TABLE_CHUNK_ROWS", 1000))  # Rows of a table stored (and read) together
+DATA_PREVIEW_ROWS = int(os.environ.get("DATA_PREVIEW_ROWS", 5))  # Rows of a stored table kept in the message
+DATA_PAGE_MAX_LIMIT = int(os.environ.get("DATA_PAGE_MAX_LIMIT", 5000))
+
+# Blob storage (audio payloads, result tables and charts), "local" for development or "gcs" in production
+BLOB_STORAGE_BACKEND = os.environ.get("BLOB_STORAGE_BACKEND", "local")
+BLOB_STORAGE_PATH = os.environ.get("BLOB_STORAGE_PATH", "./data/blobs")
+BLOB_STORAGE_BUCKET = os.environ.get("BLOB_STORAGE_BUCKET", "")
+BLOB_CHUNK_SIZE = int(os.environ.get("BLOB_CHUNK_SIZE", 64 * 1024))
+RUNNING_ON_CLOUD_RUN = bool(os.environ.get("K_SERVICE"))  # Set by Cloud Run, whose instances have an ephemeral, unshared disk
+AUDIO_MAX_UPLOAD_BYTES = int(os.environ.get("AUDIO_MAX_UPLOAD_BYTES", 25 * 1024 * 1024))
+
+# Fake GenAI service (GENAI_BACKEND=fake)
+FAKE_GENAI_LATENCY_SECONDS = float(os.environ.get("FAKE_GENAI_LATENCY_SECONDS", 0.05))
+FAKE_GENAI_ANSWER_TOKENS = int(os.environ.get("FAKE_GENAI_ANSWER_TOKENS", 20))
+
+# Instrumentation: Prometheus metrics on /metrics and per-request JSON trace logs
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "false").lower() == "true"
+TRACE_LOGS = METRICS_ENABLED and os.environ.get("TRACE_LOGS", "false").lower() == "true"
+
+# Production server (python -m app.server)
+SERVER_HOST = os.environ.get("SERVER_HOST", "0.0.0.0")
+SERVER_PORT = int(os.environ.get("PORT", 8000))
+WEB_CONCURRENCY = int(os.environ.get("WEB_CONCURRENCY", os.cpu_count() or 1))  # Worker processes
+SHUTDOWN_TIMEOUT_SECONDS = float(os.environ.get("SHUTDOWN_TIMEOUT_SECONDS", 10))  # Drain of requests, then of jobs
+STARTUP_WARMUP = os.environ.get("STARTUP_WARMUP", "true").lower() == "true"
@@ -1,17 +1,78 @@
+import hashlib
 import os
+import re
 import secrets
-from typing import Optional
+import unicodedata
+from typing import Optional, Tuple
 from google.cloud import firestore
 from fastapi.security import OAuth2PasswordBearer
 from passlib.context import CryptContext
 from datetime import datetime, timedelta
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Request, status
 import jwt
-from app.config import ALGORITHM, FIRESTORE_PROJECT_ID, SECRET_KEY
+from app.cache import TTLCache
+from app.metrics import instrument_firestore
+from app.config import (
+    ALGORITHM,
+    FIRESTORE_BACKEND,
+    FIRESTORE_PROJECT_ID,
+    SECRET_KEY,
+    SECRET_KEY_FINGERPRINT,
+    USER_CACHE_MAX_SIZE,
+    USER_CACHE_TTL_SECONDS,
+)
 
-# Initialize Firestore client
-client = firestore.Client(project=FIRESTORE_PROJECT_ID)
+# The async client keeps Firestore round trips off the event loop.
+# FIRESTORE_BACKEND=memory swaps in the in-memory stand-in, for local runs and benchmarks
+if FIRESTORE_BACKEND == "memory":
+    from app.firestore_memory import MemoryClient, async_transactional
+else:
+    async_transactional = firestore.async_transactional
+
+
+class FirestoreClient:
+    """
+    Handle to the Firestore client of the worker process, created on startup by the application
+    lifespan (or on first use, for scripts and migrations) and closed on shutdown. Everything
+    else is delegated, so the handle is used as the client itself.
+    """
+
+    def __init__(self):
+        self._client = None
+
+    def start(self):
+        if self._client is None:
+            raw_client = MemoryClient() if FIRESTORE_BACKEND == "memory" else firestore.AsyncClient(project=FIRESTORE_PROJECT_ID)
+            # Records a span per Firestore operation when metrics are enabled, returns the client untouched otherwise
+            self._client = instrument_firestore(raw_client)
+        return self._client
+
+    async def close(self):
+        if self._client is None or FIRESTORE_BACKEND == "memory":
+            return  # The in-memory stand-in holds the data, it lives as long as the process
+
+        raw_client = getattr(self._client, "_target", self._client)
+        raw_client.close()
+        # The gRPC channel is only created by the first call, and has no public close on the client
+        firestore_api = getattr(raw_client, "_firestore_api_internal", None)
+        if firestore_api is not None:
+            await firestore_api.transport.close()
+        self._client = None
+
+    def __getattr__(self, name):
+        return getattr(self.start(), name)
+
+
+client = FirestoreClient()
 USERS_COLLECTION = "users"  # Firestore collection name
+CONVERSATIONS_COLLECTION = "conversations"  # Subcollection of each user document
+MESSAGES_COLLECTION = "messages"  # Subcollection of each conversation document
+
+# Firestore document IDs cannot contain "/", be "." or "..", or match __.*__
+RESERVED_DOCUMENT_ID = re.compile(r"^(\.\.?|__.*__)$")
+
+# Cache of user identities and document references, keyed by normalized username
+user_cache = TTLCache(maxsize=USER_CACHE_MAX_SIZE, ttl=USER_CACHE_TTL_SECONDS)
 
 # Password Hashing
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
@@ -24,6 +85,18 @@ def get_password_hash(password):
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
 
+def signing_key_fingerprint() -> str:
+    return hashlib.sha256(SECRET_KEY.encode()).hexdigest()[:16]
+
+
+def check_signing_key():
+    """
+    Fails the startup of a worker whose token signing key differs from the one of the server
+    (SECRET_KEY_FINGERPRINT, set by `app.server`), its tokens would be rejected by the other workers.
+    """
+    if SECRET_KEY_FINGERPRINT and SECRET_KEY_FINGERPRINT != signing_key_fingerprint():
+        raise RuntimeError("SECRET_KEY differs between the server workers, set the same SECRET_KEY for all of them")
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -34,7 +107,73 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-async def get_current_user(token: str = Depends(oauth2_scheme)):
+def normalize_username(username: str) -> str:
+    """
+    Canonical form of a username, the ID of its user document: usernames differing only by case,
+    Unicode composition or surrounding whitespace belong to the same user.
+    """
+    return unicodedata.normalize("NFKC", username).strip().casefold()
+
+
+def get_user_document_reference(username: str):
+    """
+    Returns the reference of the user document keyed by the normalized username, or None when the
+    username cannot be a document ID (such a user cannot exist).
+    """
+    user_id = normalize_username(username)
+    if not user_id or "/" in user_id or RESERVED_DOCUMENT_ID.match(user_id) or len(user_id.encode()) > 1500:
+        return None
+    return client.collection(USERS_COLLECTION).document(user_id)
+
+
+async def get_user_entry(username: str) -> Optional[dict]:
+    """
+    Returns the identity and document reference of a user, served from the in-process
+    cache when possible so the user document is only read once per TTL.
+    """
+    user_id = normalize_username(username)
+    user = user_cache.get(user_id)
+    if user is not None:
+        return user
+
+    # Direct read of the user document, keyed by the normalized username
+    user_ref = get_user_document_reference(username)
+    if user_ref is None:
+        return None
+
+    user_doc = await user_ref.get(["username"])
+    if not user_doc.exists:
+        return None
+
+    user = {"username": user_doc.get("username"), "reference": user_ref}
+    user_cache.set(user_id, user)
+
+    return user
+
+
+def invalidate_user(username: str):
+    """
+    Drops the cached entry of a user, to be called whenever the user document is created or replaced.
+    """
+    user_cache.pop(normalize_username(username))
+
+
+async def get_current_user(request: Request, token: str = Depends(oauth2_scheme)):
+    # Request-scoped memo, so helpers resolving the user again within the same request don't hit Firestore
+    current_user = getattr(request.state, "current_user", None)
+    if current_user is not None:
+        return current_user
+
+    user, _ = await authenticate_token(token)
+    request.state.current_user = user
+    return user
+
+
+async def authenticate_token(token: str) -> Tuple[dict, Optional[datetime]]:
+    """
+    Returns the user of an access token and the expiry of the token, raises a 401 when the token
+    is invalid or expired or its user does not exist.
+    """
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -49,14 +188,9 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
     except jwt.PyJWTError:
         raise credentials_exception
     
-    # Query Firestore for the user document based on username
-    query = client.collection(USERS_COLLECTION).where("username", "==", username).limit(1).stream()
-    user_docs = list(query)
-    
-    if not user_docs:
+    user = await get_user_entry(username)
+    if user is None:
         raise credentials_exception
 
-    # Assume only one document matches (unique username)
-    user = user_docs[0].to_dict()
-    
-    return user
+    expires_at = datetime.utcfromtimestamp(payload["exp"]) if "exp" in payload else None
+    return user, expires_at
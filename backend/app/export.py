@@ -0,0 +1,174 @@
+"""
+Streaming export of the messages of a user, as NDJSON (one message per line) or CSV.
+
+Messages are read page by page (EXPORT_PAGE_SIZE documents, ordered by timestamp within each
+conversation) and each page is serialized and sent before the next one is read, so an export holds
+a single page in memory whatever the size of the history. Only the exported fields are read: the
+large fields (`generated_chart`, `data`, `tools`) are left out unless requested. Audio, and the
+tables and charts stored out of line, are never inlined: they are referenced by the URL of their
+endpoint (with the size and columns of a table, the title and trace types of a chart), so a single
+message never loads a whole table into memory.
+"""
+import csv
+import io
+import json
+from typing import AsyncIterator, Callable, Dict, List, Optional
+from google.cloud import firestore
+from app.config import EXPORT_PAGE_SIZE
+from app.dependencies import CONVERSATIONS_COLLECTION, MESSAGES_COLLECTION
+from app.responses import parse_generated_chart
+from app.utils import iter_query_pages
+
+# Large fields, exported on request
+OPTIONAL_FIELDS = ("generated_chart", "data", "tools")
+
+COLUMNS = [
+    "conversation_id", "conversation_title", "message_id", "timestamp", "question_type",
+    "question_content", "transcription", "answer_content", "feedback", "status",
+]
+
+# Fields read for the columns, the question content of AUDIO messages is empty (or legacy base64, not exported)
+MESSAGE_FIELDS = [
+    "message_id", "timestamp", "question.type", "question.content", "question.transcription",
+    "question.audio_id", "answer.content", "feedback", "status",
+]
+
+FEEDBACK_NONE = "NONE"  # Filter value of the messages without feedback
+
+
+def export_columns(include: List[str], audio_url: Optional[Callable[[str, str], str]]) -> List[str]:
+    return COLUMNS + (["audio_url"] if audio_url else []) + [field for field in OPTIONAL_FIELDS if field in include]
+
+
+def export_record(
+    conversation: Dict,
+    message: Dict,
+    include: List[str],
+    audio_url: Optional[Callable[[str, str], str]],
+    payload_urls: Dict[str, Callable[[str, str], str]]
+) -> Dict:
+    """
+    Flattens a stored message into an export record, with the columns of `export_columns`.
+    `payload_urls` builds the URLs of the endpoints of the `data` and `generated_chart` payloads.
+    """
+    question = message.get("question") or {}
+    answer = message.get("answer") or {}
+    conversation_id = conversation["conversation_id"]
+    record = {
+        "conversation_id": conversation_id,
+        "conversation_title": conversation.get("title"),
+        "message_id": message.get("message_id"),
+        "timestamp": message.get("timestamp"),
+        "question_type": question.get("type"),
+        "question_content": question.get("content") if question.get("type") != "AUDIO" else None,
+        "transcription": question.get("transcription"),
+        "answer_content": answer.get("content"),
+        "feedback": message.get("feedback"),
+        "status": message.get("status", "DONE"),
+    }
+    if audio_url:
+        record["audio_url"] = audio_url(conversation_id, record["message_id"]) if question.get("audio_id") else None
+    if "generated_chart" in include:
+        chart_ref = answer.get("chart_ref")
+        record["generated_chart"] = (
+            {"url": payload_urls["generated_chart"](conversation_id, record["message_id"]),
+             "title": chart_ref.get("title"), "trace_types": chart_ref.get("trace_types")}
+            if chart_ref else parse_generated_chart(answer.get("generated_chart"))
+        )
+    if "data" in include:
+        data_ref = message.get("data_ref")
+        record["data"] = (
+            {"url": payload_urls["data"](conversation_id, record["message_id"]),
+             "rows": data_ref.get("rows"), "columns": data_ref.get("columns")}
+            if data_ref else message.get("data")
+        )
+    if "tools" in include:
+        record["tools"] = message.get("tools")
+    return record
+
+
+# Fields read for each optional field, payloads stored out of line are exported as their reference
+OPTIONAL_FIELD_PATHS = {
+    "generated_chart": ["answer.generated_chart", "answer.chart_ref"],
+    "data": ["data", "data_ref"],
+    "tools": ["tools"],
+}
+
+
+def message_query(conversation_ref, include: List[str], since: Optional[str], until: Optional[str], feedback: Optional[str]):
+    field_paths = MESSAGE_FIELDS + [field_path for field in include for field_path in OPTIONAL_FIELD_PATHS[field]]
+    query = conversation_ref.collection(MESSAGES_COLLECTION).select(field_paths).order_by("timestamp")
+    if since:
+        query = query.where(filter=firestore.FieldFilter("timestamp", ">=", since))
+    if until:
+        query = query.where(filter=firestore.FieldFilter("timestamp", "<", until))
+    if feedback:
+        # Served with the composite index (feedback, timestamp) of the messages
+        query = query.where(filter=firestore.FieldFilter("feedback", "==", None if feedback == FEEDBACK_NONE else feedback))
+    return query
+
+
+async def iter_conversations(user_ref, conversation_id: Optional[str] = None) -> AsyncIterator:
+    """
+    Yields the conversation documents (ID and title) to export, one or every conversation of the user.
+    """
+    conversations = user_ref.collection(CONVERSATIONS_COLLECTION)
+    if conversation_id:
+        conversation_doc = await conversations.document(conversation_id).get(field_paths=["conversation_id", "title"])
+        if conversation_doc.exists:
+            yield conversation_doc
+        return
+
+    query = conversations.select(["conversation_id", "title"]).order_by("conversation_id")
+    async for conversation_docs in iter_query_pages(query, EXPORT_PAGE_SIZE):
+        for conversation_doc in conversation_docs:
+            yield conversation_doc
+
+
+async def iter_export_records(
+    user_ref,
+    conversation_id: Optional[str],
+    include: List[str],
+    audio_url: Optional[Callable[[str, str], str]],
+    payload_urls: Dict[str, Callable[[str, str], str]],
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    feedback: Optional[str] = None,
+) -> AsyncIterator[List[Dict]]:
+    """
+    Yields the export records page by page, for one conversation or every conversation of the user.
+    """
+    async for conversation_doc in iter_conversations(user_ref, conversation_id):
+        conversation = conversation_doc.to_dict()
+        query = message_query(conversation_doc.reference, include, since, until, feedback)
+        async for message_docs in iter_query_pages(query, EXPORT_PAGE_SIZE):
+            yield [
+                export_record(conversation, message_doc.to_dict(), include, audio_url, payload_urls)
+                for message_doc in message_docs
+            ]
+
+
+async def ndjson_lines(pages: AsyncIterator[List[Dict]]) -> AsyncIterator[bytes]:
+    async for records in pages:
+        yield "".join(json.dumps(record, ensure_ascii=False, default=str) + "\n" for record in records).encode()
+
+
+async def csv_lines(pages: AsyncIterator[List[Dict]], columns: List[str]) -> AsyncIterator[bytes]:
+    """
+    CSV with a header line, nested values (answers with structured content, charts, data, tools)
+    are written as JSON.
+    """
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=columns, extrasaction="ignore")
+    writer.writeheader()
+    yield buffer.getvalue().encode()
+
+    async for records in pages:
+        buffer.seek(0)
+        buffer.truncate()
+        for record in records:
+            writer.writerow({
+                column: json.dumps(value, ensure_ascii=False, default=str) if isinstance(value, (dict, list)) else value
+                for column, value in record.items()
+            })
+        yield buffer.getvalue().encode()
@@ -0,0 +1,43 @@
+"""
+Fake GenAI service implementing the endpoints called by the API with a configurable latency.
+Used in-process with GENAI_BACKEND=fake, or standalone with `uvicorn app.fake_genai:app --port 8080`.
+"""
+import asyncio
+import base64
+import json
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+from app.config import FAKE_GENAI_ANSWER_TOKENS, FAKE_GENAI_LATENCY_SECONDS
+
+app = FastAPI(title="Fake GenAI Service")
+
+
+def fake_answer(message: str) -> list:
+    return [f"token{index} " for index in range(FAKE_GENAI_ANSWER_TOKENS)] + [f"(re: {message[:30]})"]
+
+
+@app.post("/speech/speech-to-text")
+async def speech_to_text(request: Request):
+    audio = base64.b64decode((await request.json())["audio_base64"], validate=True)
+    await asyncio.sleep(FAKE_GENAI_LATENCY_SECONDS)
+    return {"transcription": f"fake transcription of {len(audio)} audio bytes"}
+
+
+@app.post("/llm/invoke")
+async def llm_invoke(request: Request):
+    payload = await request.json()
+    await asyncio.sleep(FAKE_GENAI_LATENCY_SECONDS)
+    return {"output": {"content": "".join(fake_answer(payload["input"]["message"]))}}
+
+
+@app.post("/llm/stream")
+async def llm_stream(request: Request):
+    payload = await request.json()
+
+    async def events():
+        for token in fake_answer(payload["input"]["message"]):
+            await asyncio.sleep(FAKE_GENAI_LATENCY_SECONDS / FAKE_GENAI_ANSWER_TOKENS)
+            yield f"event: data\ndata: {json.dumps(token)}\n\n"
+        yield "event: end\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
@@ -0,0 +1,504 @@
+"""
+In-memory stand-in for the Firestore `AsyncClient`, selected with FIRESTORE_BACKEND=memory.
+
+It implements the subset of the client API used by the application (documents, subcollections,
+queries with filters/ordering/cursors/projections, batches and transactions) so the API can be
+run and benchmarked without a GCP project. Reads and writes are counted, with the bytes of the
+documents involved, per label of the `firestore_stats_label` context variable.
+
+Transactions are optimistic: the documents read in a transaction are checked on commit and, when
+one was written in the meantime, the commit is aborted and the transaction retried, like Firestore
+does on contention. Transactional reads and batch commits yield to the event loop, as the RPCs of
+the real client do, so concurrent requests interleave between a read and the write based on it.
+"""
+import asyncio
+import copy
+import functools
+import heapq
+import json
+import uuid
+from collections import defaultdict
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+from google.api_core.exceptions import Aborted, AlreadyExists, InvalidArgument, NotFound
+from google.cloud.firestore_v1 import transforms
+
+MAX_DOCUMENT_BYTES = 1024 * 1024  # Firestore rejects documents larger than 1 MiB
+
+# Label the Firestore operations are accounted to, e.g. the endpoint being benchmarked
+firestore_stats_label: ContextVar[str] = ContextVar("firestore_stats_label", default="default")
+
+_MISSING = object()
+_RAISE = object()
+
+
+def document_size(data: Dict) -> int:
+    return len(json.dumps(data, default=str).encode())
+
+
+def get_path(data: Dict, field_path: str, default=_RAISE):
+    value = data
+    for key in field_path.split("."):
+        if not isinstance(value, dict) or key not in value:
+            if default is _RAISE:
+                raise KeyError(field_path)
+            return default
+        value = value[key]
+    return value
+
+
+def set_path(data: Dict, field_path: str, value):
+    *parents, key = field_path.split(".")
+    for parent in parents:
+        data = data.setdefault(parent, {})
+
+    if value is transforms.DELETE_FIELD:
+        data.pop(key, None)
+    elif isinstance(value, transforms.Increment):
+        data[key] = (data.get(key) or 0) + value.value
+    elif isinstance(value, transforms.ArrayUnion):
+        current = data.get(key) or []
+        data[key] = current + [item for item in value.values if item not in current]
+    elif isinstance(value, transforms.ArrayRemove):
+        data[key] = [item for item in data.get(key) or [] if item not in value.values]
+    else:
+        data[key] = copy.deepcopy(value)
+
+
+def project(data: Dict, field_paths: Optional[List[str]]) -> Dict:
+    if field_paths is None:
+        return copy.deepcopy(data)
+
+    projected = {}
+    for field_path in field_paths:
+        value = get_path(data, field_path, _MISSING)
+        if value is not _MISSING:
+            set_path(projected, field_path, value)
+    return projected
+
+
+def merge(target: Dict, data: Dict):
+    for key, value in data.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            merge(target[key], value)
+        else:
+            set_path(target, key, value)
+
+
+class MemoryStats:
+    def __init__(self):
+        self.by_label: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+
+    def record(self, kind: str, data: Optional[Dict]):
+        counters = self.by_label[firestore_stats_label.get()]
+        counters[kind] += 1
+        if data is not None:
+            counters[f"bytes_{kind}"] += document_size(data)
+
+    def reset(self):
+        self.by_label.clear()
+
+
+class MemoryDocumentSnapshot:
+    def __init__(self, reference, data: Optional[Dict]):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+
+    @property
+    def exists(self) -> bool:
+        return self._data is not None
+
+    def to_dict(self) -> Optional[Dict]:
+        return copy.deepcopy(self._data)
+
+    def get(self, field_path: str):
+        return copy.deepcopy(get_path(self._data or {}, field_path))
+
+
+class MemoryDocumentReference:
+    def __init__(self, client, path: str):
+        self._client = client
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+
+    @property
+    def parent_path(self) -> str:
+        return self.path.rsplit("/", 1)[0]
+
+    def collection(self, name: str):
+        return MemoryCollectionReference(self._client, f"{self.path}/{name}")
+
+    async def collections(self):
+        # Subcollections holding documents, like Firestore lists them
+        prefix = f"{self.path}/"
+        for path, documents in list(self._client._collections.items()):
+            if documents and path.startswith(prefix) and "/" not in path[len(prefix):]:
+                yield MemoryCollectionReference(self._client, path)
+
+    async def get(self, field_paths: Optional[List[str]] = None, transaction=None) -> MemoryDocumentSnapshot:
+        data = self._client._read(self.path, field_paths)
+        if transaction is not None:
+            transaction._record_read(self.path)
+            await asyncio.sleep(0)
+        return MemoryDocumentSnapshot(self, data)
+
+    async def set(self, data: Dict, merge: bool = False):
+        self._client._apply([("set_merge" if merge else "set", self, data)])
+
+    async def create(self, data: Dict):
+        self._client._apply([("create", self, data)])
+
+    async def update(self, fields: Dict):
+        self._client._apply([("update", self, fields)])
+
+    async def delete(self):
+        self._client._apply([("delete", self, None)])
+
+    def __eq__(self, other):
+        return isinstance(other, MemoryDocumentReference) and other.path == self.path
+
+    def __hash__(self):
+        return hash(self.path)
+
+
+class _Reversed:
+    """Sort key inverting the order of the wrapped key."""
+    __slots__ = ("key",)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __lt__(self, other):
+        return other.key < self.key
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+
+class MemoryQuery:
+    ASCENDING = "ASCENDING"
+    DESCENDING = "DESCENDING"
+
+    def __init__(self, client, path: str, filters=(), orders=(), limit_count=None, fields=None, cursor=None):
+        self._client = client
+        self._path = path
+        self._filters = tuple(filters)
+        self._orders = tuple(orders)
+        self._limit = limit_count
+        self._fields = fields
+        self._cursor = cursor
+
+    def _copy(self, **changes) -> "MemoryQuery":
+        params = dict(
+            filters=self._filters, orders=self._orders, limit_count=self._limit,
+            fields=self._fields, cursor=self._cursor
+        )
+        params.update(changes)
+        return MemoryQuery(self._client, self._path, **params)
+
+    def where(self, field_path: str = None, op_string: str = None, value: Any = None, *, filter=None) -> "MemoryQuery":
+        if filter is not None:
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        op_string = getattr(op_string, "name", op_string)  # `== None` filters carry the IS_NULL operator enum
+        return self._copy(filters=self._filters + ((field_path, op_string, value),))
+
+    def order_by(self, field_path: str, direction: str = ASCENDING) -> "MemoryQuery":
+        return self._copy(orders=self._orders + ((field_path, direction),))
+
+    def limit(self, count: int) -> "MemoryQuery":
+        return self._copy(limit_count=count)
+
+    def select(self, field_paths: List[str]) -> "MemoryQuery":
+        return self._copy(fields=list(field_paths))
+
+    def start_after(self, document_fields) -> "MemoryQuery":
+        return self._copy(cursor=document_fields)
+
+    def _matches(self, data: Dict) -> bool:
+        for field_path, op, value in self._filters:
+            current = get_path(data, field_path, _MISSING)
+            if current is _MISSING:
+                return False
+            if op == "==" and not current == value:
+                return False
+            if op == "IS_NULL" and current is not None:
+                return False
+            if op == "IS_NOT_NULL" and current is None:
+                return False
+            if op == "!=" and not current != value:
+                return False
+            if op == "<" and not current < value:
+                return False
+            if op == "<=" and not current <= value:
+                return False
+            if op == ">" and not current > value:
+                return False
+            if op == ">=" and not current >= value:
+                return False
+            if op == "in" and current not in value:
+                return False
+            if op == "array_contains" and value not in (current or []):
+                return False
+            if op == "array_contains_any" and not set(value) & set(current or []):
+                return False
+        return True
+
+    def _compare(self, left: tuple, right: tuple) -> int:
+        # Documents missing an ordered field are excluded before sorting, ties are broken by ID
+        directions = [direction for _, direction in self._orders] + [self._orders[-1][1] if self._orders else self.ASCENDING]
+        for left_value, right_value, direction in zip(left, right, directions):
+            if left_value == right_value:
+                continue
+            result = -1 if left_value < right_value else 1
+            return -result if direction == self.DESCENDING else result
+        return 0
+
+    def _sort_key(self, doc_id: str, data: Dict) -> tuple:
+        return tuple(get_path(data, field_path) for field_path, _ in self._orders) + (doc_id,)
+
+    def _cursor_key(self) -> tuple:
+        cursor = self._cursor
+        if isinstance(cursor, MemoryDocumentSnapshot):
+            return tuple(cursor.get(field_path) for field_path, _ in self._orders) + (cursor.id,)
+        return tuple(cursor[field_path] for field_path, _ in self._orders)
+
+    def _candidates(self):
+        # Equality filters are served by a single-field index, like in Firestore, so the cost of a
+        # query depends on its matches rather than on the size of the collection
+        collection = self._client._collection(self._path)
+        for field_path, op, value in self._filters:
+            if op == "==" and isinstance(value, (str, int, float, bool)):
+                return [(doc_id, collection[doc_id]) for doc_id in self._client._equality_index(self._path, field_path).get(value, ())]
+        return collection.items()
+
+    def _run(self, transaction=None) -> List[MemoryDocumentSnapshot]:
+        documents = [
+            (doc_id, data) for doc_id, data in self._candidates()
+            if self._matches(data)
+            and all(get_path(data, field_path, _MISSING) is not _MISSING for field_path, _ in self._orders)
+        ]
+        directions = {direction for _, direction in self._orders}
+        if len(directions) <= 1:
+            # Single direction: documents are sorted on their key tuple, computed once per document
+            descending = directions == {self.DESCENDING}
+            keys = {doc_id: self._sort_key(doc_id, data) for doc_id, data in documents}
+            order = (lambda document: _Reversed(keys[document[0]])) if descending else (lambda document: keys[document[0]])
+        else:
+            order = functools.cmp_to_key(lambda left, right: self._compare(self._sort_key(*left), self._sort_key(*right)))
+
+        if self._cursor is not None:
+            cursor_key = self._cursor_key()
+            documents = [
+                document for document in documents
+                if self._compare(self._sort_key(*document)[:len(cursor_key)], cursor_key) > 0
+            ]
+        if self._limit is not None:
+            documents = heapq.nsmallest(self._limit, documents, key=order)
+        else:
+            documents.sort(key=order)
+
+        snapshots = []
+        for doc_id, data in documents:
+            data = project(data, self._fields)
+            self._client.stats.record("reads", data)
+            if transaction is not None:
+                transaction._record_read(f"{self._path}/{doc_id}")
+            snapshots.append(MemoryDocumentSnapshot(MemoryDocumentReference(self._client, f"{self._path}/{doc_id}"), data))
+        return snapshots
+
+    async def stream(self, transaction=None):
+        for snapshot in self._run(transaction):
+            yield snapshot
+
+    async def get(self, transaction=None) -> List[MemoryDocumentSnapshot]:
+        return self._run(transaction)
+
+
+class MemoryCollectionReference(MemoryQuery):
+    def __init__(self, client, path: str):
+        super().__init__(client, path)
+        self.id = path.rsplit("/", 1)[-1]
+
+    def document(self, document_id: Optional[str] = None) -> MemoryDocumentReference:
+        return MemoryDocumentReference(self._client, f"{self._path}/{document_id or uuid.uuid4().hex[:20]}")
+
+    async def add(self, document_data: Dict, document_id: Optional[str] = None):
+        reference = self.document(document_id)
+        await reference.set(document_data)
+        return None, reference
+
+
+class MemoryWriteBatch:
+    """
+    Buffers writes and applies them atomically on commit, like a Firestore batch.
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self._writes = []
+
+    def set(self, reference, document_data: Dict, merge: bool = False):
+        self._writes.append(("set_merge" if merge else "set", reference, document_data))
+
+    def update(self, reference, field_updates: Dict, option=None):
+        self._writes.append(("update", reference, field_updates))
+
+    def delete(self, reference, option=None):
+        self._writes.append(("delete", reference, None))
+
+    def create(self, reference, document_data: Dict):
+        self._writes.append(("create", reference, document_data))
+
+    async def commit(self):
+        await asyncio.sleep(0)
+        writes, self._writes = self._writes, []
+        self._client._apply(writes)
+
+
+class MemoryTransaction(MemoryWriteBatch):
+    def __init__(self, client, max_attempts: int = 5):
+        super().__init__(client)
+        self.max_attempts = max_attempts
+        self._read_versions: Dict[str, int] = {}
+
+    def _record_read(self, path: str):
+        # The first read of a document in the attempt is the one the writes are based on
+        self._read_versions.setdefault(path, self._client._versions.get(path, 0))
+
+    def _begin(self):
+        self._writes = []
+        self._read_versions = {}
+
+    async def commit(self):
+        # Validated and applied without yielding, so no write can slip in between
+        writes, self._writes = self._writes, []
+        for path, version in self._read_versions.items():
+            if self._client._versions.get(path, 0) != version:
+                self._client.stats.record("aborted_transactions", None)
+                raise Aborted(f"Transaction aborted, {path} was written concurrently")
+        self._client._apply(writes)
+
+
+def async_transactional(to_wrap):
+    """
+    Counterpart of `firestore.async_transactional`: the wrapped coroutine is run again when its
+    commit is aborted by a concurrent write, up to the `max_attempts` of the transaction.
+    """
+    @functools.wraps(to_wrap)
+    async def wrapper(transaction: MemoryTransaction, *args, **kwargs):
+        last_error = None
+        for _ in range(transaction.max_attempts):
+            transaction._begin()
+            result = await to_wrap(transaction, *args, **kwargs)
+            try:
+                await transaction.commit()
+                return result
+            except Aborted as e:
+                last_error = e
+        raise ValueError(f"Failed to commit transaction in {transaction.max_attempts} attempts.") from last_error
+    return wrapper
+
+
+class MemoryClient:
+    def __init__(self):
+        self._collections: Dict[str, Dict[str, Dict]] = defaultdict(dict)
+        self._indexes: Dict[str, Dict[str, Dict[Any, set]]] = defaultdict(dict)  # Collection path: field path: value: IDs
+        self._versions: Dict[str, int] = defaultdict(int)  # Document path: number of writes, for the transactions
+        self.stats = MemoryStats()
+
+    def collection(self, name: str) -> MemoryCollectionReference:
+        return MemoryCollectionReference(self, name)
+
+    def batch(self) -> MemoryWriteBatch:
+        return MemoryWriteBatch(self)
+
+    def transaction(self, max_attempts: int = 5) -> MemoryTransaction:
+        return MemoryTransaction(self, max_attempts=max_attempts)
+
+    def close(self):
+        pass
+
+    def reset(self):
+        self._collections.clear()
+        self._indexes.clear()
+        self._versions.clear()
+        self.stats.reset()
+
+    def _collection(self, path: str) -> Dict[str, Dict]:
+        return self._collections[path]
+
+    def _equality_index(self, collection_path: str, field_path: str) -> Dict[Any, set]:
+        # Built on the first query filtering on the field, then maintained by the writes
+        index = self._indexes[collection_path].get(field_path)
+        if index is None:
+            index = self._indexes[collection_path][field_path] = defaultdict(set)
+            for doc_id, data in self._collections[collection_path].items():
+                self._index_document(index, field_path, doc_id, data, True)
+        return index
+
+    @staticmethod
+    def _index_document(index: Dict[Any, set], field_path: str, doc_id: str, data: Optional[Dict], add: bool):
+        value = get_path(data, field_path, _MISSING) if data is not None else _MISSING
+        if value is _MISSING or not isinstance(value, (str, int, float, bool)):
+            return
+        if add:
+            index[value].add(doc_id)
+        else:
+            index[value].discard(doc_id)
+            if not index[value]:
+                del index[value]
+
+    def _read(self, path: str, field_paths: Optional[List[str]] = None) -> Optional[Dict]:
+        collection_path, doc_id = path.rsplit("/", 1)
+        data = self._collections[collection_path].get(doc_id)
+        if data is not None:
+            data = project(data, field_paths)
+        self.stats.record("reads", data)
+        return data
+
+    def _apply(self, writes):
+        # Validate every write before applying any, so a failed precondition leaves the data untouched
+        staged = {}
+        payloads = []
+        for operation, reference, data in writes:
+            collection_path, doc_id = reference.parent_path, reference.id
+            current = staged.get(reference.path, self._collections[collection_path].get(doc_id))
+
+            if operation == "update" and current is None:
+                raise NotFound(f"No document to update: {reference.path}")
+            if operation == "create" and current is not None:
+                raise AlreadyExists(f"Document already exists: {reference.path}")
+
+            if operation == "delete":
+                updated = None
+            elif operation in ("set", "create"):
+                updated = {}
+                merge(updated, copy.deepcopy(data))
+            else:  # set_merge, update
+                updated = copy.deepcopy(current) if current is not None else {}
+                if operation == "update":
+                    for field_path, value in data.items():
+                        set_path(updated, field_path, value)
+                else:
+                    merge(updated, data)
+
+            if updated is not None and document_size(updated) > MAX_DOCUMENT_BYTES:
+                raise InvalidArgument(f"Document exceeds {MAX_DOCUMENT_BYTES} bytes: {reference.path}")
+            staged[reference.path] = updated
+            payloads.append(data)
+
+        for path, data in staged.items():
+            collection_path, doc_id = path.rsplit("/", 1)
+            for field_path, index in self._indexes.get(collection_path, {}).items():
+                self._index_document(index, field_path, doc_id, self._collections[collection_path].get(doc_id), False)
+                self._index_document(index, field_path, doc_id, data, True)
+            self._versions[path] += 1
+            if data is None:
+                self._collections[collection_path].pop(doc_id, None)
+            else:
+                self._collections[collection_path][doc_id] = data
+
+        # Writes are accounted with the data sent (e.g. only the updated fields), not the resulting document
+        for payload in payloads:
+            self.stats.record("writes", payload)
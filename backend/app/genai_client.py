@@ -0,0 +1,164 @@
+import asyncio
+import json
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable, Optional, Tuple
+import httpx
+from app.metrics import span
+from app.config import (
+    GENAI_API_URL,
+    GENAI_BACKEND,
+    GENAI_CONNECT_TIMEOUT_SECONDS,
+    GENAI_HTTP2,
+    GENAI_KEEPALIVE_EXPIRY_SECONDS,
+    GENAI_MAX_CONNECTIONS,
+    GENAI_MAX_KEEPALIVE_CONNECTIONS,
+    GENAI_MAX_RETRIES,
+    GENAI_RETRY_BACKOFF_SECONDS,
+)
+
+# Upstream statuses worth retrying. A 502/504 may come after the call already ran upstream, so
+# non-idempotent calls (LLM invocations) only retry a 503, the call was then refused
+RETRYABLE_STATUS_CODES = {502, 503, 504}
+NON_IDEMPOTENT_RETRYABLE_STATUS_CODES = {503}
+
+# Errors worth retrying. Only the ones raised before the request was sent are safe for non-idempotent
+# calls: a dropped connection (RemoteProtocolError) may come after the call was processed upstream
+RETRYABLE_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout, httpx.RemoteProtocolError)
+NON_IDEMPOTENT_RETRYABLE_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+_client: Optional[httpx.AsyncClient] = None
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        print("GENAI_HTTP2 is enabled but the 'h2' package is not installed, falling back to HTTP/1.1")
+        return False
+    return True
+
+
+def start_genai_client() -> httpx.AsyncClient:
+    """
+    Creates the shared connection-pooled client for the GenAI service, called on application startup.
+    """
+    global _client
+    if _client is None and GENAI_BACKEND == "fake":
+        from app.fake_genai import app as fake_genai_app
+        _client = httpx.AsyncClient(transport=httpx.ASGITransport(app=fake_genai_app), base_url="http://fake-genai")
+    if _client is None:
+        _client = httpx.AsyncClient(
+            base_url=GENAI_API_URL,
+            http2=GENAI_HTTP2 and _http2_available(),
+            limits=httpx.Limits(
+                max_connections=GENAI_MAX_CONNECTIONS,
+                max_keepalive_connections=GENAI_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=GENAI_KEEPALIVE_EXPIRY_SECONDS,
+            ),
+            timeout=httpx.Timeout(GENAI_CONNECT_TIMEOUT_SECONDS),
+        )
+    return _client
+
+
+async def close_genai_client():
+    """
+    Closes the pooled connections, called on application shutdown.
+    """
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def get_genai_client() -> httpx.AsyncClient:
+    # Created lazily when used outside of the application lifespan (scripts, tests)
+    return _client or start_genai_client()
+
+
+def genai_timeout(seconds: float) -> httpx.Timeout:
+    """
+    Builds a per-endpoint timeout, keeping the shorter connect timeout of the pool.
+    """
+    return httpx.Timeout(seconds, connect=GENAI_CONNECT_TIMEOUT_SECONDS)
+
+
+async def genai_post(
+    path: str,
+    payload: Optional[dict] = None,
+    timeout: float = GENAI_CONNECT_TIMEOUT_SECONDS,
+    retries: int = GENAI_MAX_RETRIES,
+    content: Optional[Callable[[], AsyncIterator[bytes]]] = None,
+    idempotent: bool = True
+) -> httpx.Response:
+    """
+    POSTs a JSON payload to the GenAI service over the shared client, retrying connection
+    failures and gateway errors with exponential backoff. Large bodies can be streamed by
+    passing `content`, a factory of the already JSON encoded body chunks (called once per attempt).
+    Non-idempotent calls are only retried when the request cannot have been processed upstream.
+    """
+    client = get_genai_client()
+    retryable_status_codes = RETRYABLE_STATUS_CODES if idempotent else NON_IDEMPOTENT_RETRYABLE_STATUS_CODES
+    retryable_errors = RETRYABLE_ERRORS if idempotent else NON_IDEMPOTENT_RETRYABLE_ERRORS
+    for attempt in range(retries + 1):
+        is_last_attempt = attempt == retries
+        try:
+            with span("genai", path):
+                if content is not None:
+                    response = await client.post(
+                        path,
+                        content=content(),
+                        headers={"Content-Type": "application/json"},
+                        timeout=genai_timeout(timeout)
+                    )
+                else:
+                    response = await client.post(path, json=payload, timeout=genai_timeout(timeout))
+            if response.status_code not in retryable_status_codes or is_last_attempt:
+                return response
+            print(f"GenAI {path} returned {response.status_code}, retrying (attempt {attempt + 1}/{retries})")
+        except retryable_errors as e:
+            if is_last_attempt:
+                raise
+            print(f"GenAI {path} connection error: {e}, retrying (attempt {attempt + 1}/{retries})")
+
+        await asyncio.sleep(GENAI_RETRY_BACKOFF_SECONDS * (2 ** attempt))
+
+
+@asynccontextmanager
+async def genai_stream(path: str, payload: dict, timeout: float) -> AsyncIterator[httpx.Response]:
+    """
+    Opens a streamed POST to the GenAI service over the shared client. Streams are not
+    retried, as a partially consumed response cannot be replayed.
+    """
+    client = get_genai_client()
+    with span("genai", path):
+        async with client.stream("POST", path, json=payload, timeout=genai_timeout(timeout)) as response:
+            response.raise_for_status()
+            yield response
+
+
+async def iter_sse_events(response: httpx.Response) -> AsyncIterator[Tuple[str, object]]:
+    """
+    Parses a Server-Sent Events response into (event, data) pairs, data being JSON decoded when possible.
+    """
+    event, data_lines = "message", []
+    async for line in response.aiter_lines():
+        if line == "":
+            if data_lines:
+                data = "\n".join(data_lines)
+                try:
+                    data = json.loads(data)
+                except json.JSONDecodeError:
+                    pass
+                yield event, data
+            event, data_lines = "message", []
+        elif line.startswith("event:"):
+            event = line[len("event:"):].strip()
+        elif line.startswith("data:"):
+            data_lines.append(line[len("data:"):].lstrip())
+
+
+def format_sse(event: str, data) -> str:
+    """
+    Formats a single Server-Sent Event with a JSON encoded payload.
+    """
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
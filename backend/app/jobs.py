@@ -0,0 +1,127 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, List, Optional
+from app.config import JOB_BACKEND, JOB_QUEUE_MAX_SIZE, JOB_WORKERS, SHUTDOWN_TIMEOUT_SECONDS
+
+# Job handlers by name, jobs are submitted by name with a JSON-serializable payload
+# so they can be executed by out-of-process backends as well
+JOB_HANDLERS: Dict[str, Callable[..., Awaitable]] = {}
+
+# Failure handlers by job name, called with the exception and the job payload when a job raises
+JOB_FAILURE_HANDLERS: Dict[str, Callable[..., Awaitable]] = {}
+
+
+class JobQueueFull(Exception):
+    """Raised when a job cannot be accepted because the backend is at capacity."""
+
+
+def register_job(name: str, on_failure: Optional[Callable[..., Awaitable]] = None):
+    """
+    Decorator registering an async function as the handler of the jobs named `name`. `on_failure`
+    is awaited with the exception and the job payload when the handler raises, to record the failure.
+    """
+    def decorator(handler: Callable[..., Awaitable]):
+        JOB_HANDLERS[name] = handler
+        if on_failure is not None:
+            JOB_FAILURE_HANDLERS[name] = on_failure
+        return handler
+    return decorator
+
+
+async def run_job(name: str, payload: dict):
+    """
+    Runs a job and, when it fails, its failure handler. Never raises, for the backend workers.
+    """
+    try:
+        await JOB_HANDLERS[name](**payload)
+    except Exception as e:
+        print(f"Job {name} failed: {e}")
+        on_failure = JOB_FAILURE_HANDLERS.get(name)
+        if on_failure is None:
+            return
+        try:
+            await on_failure(e, **payload)
+        except Exception as failure_error:
+            print(f"Failure handler of job {name} failed: {failure_error}")
+
+
+class JobBackend:
+    """
+    Interface of the job backends, `submit` must not wait for the job to run.
+    """
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    def submit(self, name: str, payload: dict):
+        raise NotImplementedError
+
+
+class InProcessJobBackend(JobBackend):
+    """
+    Runs jobs on a fixed pool of asyncio workers fed by a bounded queue, a full queue
+    rejects new jobs (backpressure) instead of buffering them without limit.
+    """
+
+    def __init__(self, workers: int = JOB_WORKERS, max_queue_size: int = JOB_QUEUE_MAX_SIZE):
+        self.workers = workers
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue_size)
+        self._tasks: List[asyncio.Task] = []
+
+    async def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        # Let the queued jobs finish before stopping the workers, for at most the shutdown timeout
+        try:
+            await asyncio.wait_for(self.queue.join(), SHUTDOWN_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            print(f"Job queue not drained after {SHUTDOWN_TIMEOUT_SECONDS}s, {self.queue.qsize()} queued jobs are dropped")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, name: str, payload: dict):
+        if name not in JOB_HANDLERS:
+            raise ValueError(f"Unknown job: {name}")
+        try:
+            self.queue.put_nowait((name, payload))
+        except asyncio.QueueFull:
+            raise JobQueueFull(f"Job queue is full ({self.queue.maxsize} jobs)")
+
+    async def _worker(self):
+        while True:
+            name, payload = await self.queue.get()
+            try:
+                await run_job(name, payload)
+            finally:
+                self.queue.task_done()
+
+
+# Available backends by name, selected with the JOB_BACKEND setting
+JOB_BACKENDS: Dict[str, Callable[[], JobBackend]] = {
+    "inprocess": InProcessJobBackend,
+}
+
+_backend: Optional[JobBackend] = None
+
+
+def get_job_backend() -> JobBackend:
+    global _backend
+    if _backend is None:
+        _backend = JOB_BACKENDS[JOB_BACKEND]()
+    return _backend
+
+
+async def start_job_backend():
+    await get_job_backend().start()
+
+
+async def stop_job_backend():
+    global _backend
+    if _backend is not None:
+        await _backend.stop()
+        _backend = None
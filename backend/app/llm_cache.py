@@ -0,0 +1,96 @@
+"""
+Opt-in cache of LLM answers (LLM_CACHE_ENABLED), for questions re-asked or double-submitted.
+
+Answers are keyed by user, conversation (the GenAI session), conversation state and normalized
+question, kept for LLM_CACHE_TTL_SECONDS in a bounded LRU, and answers larger than LLM_CACHE_MAX_ENTRY_BYTES are not
+cached. Identical questions in flight at the same time share a single upstream call (single-flight).
+The conversation state is the last earlier message asking something else (see
+`app.utils.conversation_context_id`): a question asked again once the conversation has moved on is
+answered again, with its new context, while double submits and immediate re-asks share an answer.
+"""
+import asyncio
+import copy
+import json
+import unicodedata
+from typing import Awaitable, Callable, Dict, Hashable, Optional, Tuple
+from app.cache import TTLCache
+from app.config import LLM_CACHE_ENABLED, LLM_CACHE_MAX_ENTRY_BYTES, LLM_CACHE_MAX_SIZE, LLM_CACHE_TTL_SECONDS
+from app.dependencies import normalize_username
+from app.metrics import LLM_CACHE_REQUESTS
+
+
+def normalize_question(message: str) -> str:
+    """
+    Canonical form of a question: Unicode composition, whitespace and case are not significant.
+    """
+    return " ".join(unicodedata.normalize("NFKC", message).split()).casefold()
+
+
+class AnswerCache:
+    def __init__(self, enabled: bool, maxsize: int, ttl: float, max_entry_bytes: int):
+        self.enabled = enabled
+        self.max_entry_bytes = max_entry_bytes
+        self.answers = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.in_flight: Dict[Hashable, asyncio.Task] = {}
+        self.stats = {"hit": 0, "miss": 0, "coalesced": 0}
+
+    @staticmethod
+    def key(user_name: str, session_id: str, message: str, context_id: str = "") -> Tuple[str, str, str, str]:
+        return normalize_username(user_name), session_id, context_id, normalize_question(message)
+
+    def _record(self, result: str):
+        self.stats[result] += 1
+        LLM_CACHE_REQUESTS[0].inc((result,))
+
+    def get(self, key: Hashable) -> Optional[dict]:
+        """
+        Returns a copy of the cached answer, None when disabled or not cached.
+        """
+        if not self.enabled:
+            return None
+        output = self.answers.get(key)
+        self._record("miss" if output is None else "hit")
+        return copy.deepcopy(output)
+
+    def set(self, key: Hashable, output: dict):
+        if self.enabled and len(json.dumps(output, default=str)) <= self.max_entry_bytes:
+            self.answers.set(key, copy.deepcopy(output))
+
+    async def get_or_call(self, key: Hashable, call: Callable[[], Awaitable[dict]]) -> Tuple[dict, bool]:
+        """
+        Returns the answer of `key` and whether it was shared (cached or from another request's call),
+        calling `call` when it is neither cached nor in flight. Failures are not cached, they are
+        raised to every request waiting on the call.
+        """
+        if not self.enabled:
+            return await call(), False
+
+        output = self.answers.get(key)
+        if output is not None:
+            self._record("hit")
+            return copy.deepcopy(output), True
+
+        task = self.in_flight.get(key)
+        if task is not None:
+            self._record("coalesced")
+            return copy.deepcopy(await asyncio.shield(task)), True
+
+        self._record("miss")
+        # The upstream call runs in its own task, so a cancelled request doesn't fail the ones waiting on it
+        task = asyncio.ensure_future(call())
+        self.in_flight[key] = task
+        task.add_done_callback(lambda done: self._call_done(key, done))
+        return await asyncio.shield(task), False
+
+    def _call_done(self, key: Hashable, task: asyncio.Task):
+        self.in_flight.pop(key, None)
+        if not task.cancelled() and task.exception() is None:
+            self.set(key, task.result())
+
+
+answer_cache = AnswerCache(
+    enabled=LLM_CACHE_ENABLED,
+    maxsize=LLM_CACHE_MAX_SIZE,
+    ttl=LLM_CACHE_TTL_SECONDS,
+    max_entry_bytes=LLM_CACHE_MAX_ENTRY_BYTES,
+)
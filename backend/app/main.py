@@ -1,17 +1,65 @@
+import asyncio
 import os
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from app.routers.auth import router as auth_router
 from app.routers.conversations import router as conversations_router
 from app.routers.messages import router as messages_router
+from app.routers.metrics import router as metrics_router
+from app.routers.stats import router as stats_router
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
-from app.config import BACKEND_URL, FRONTEND_URL, GENAI_API_URL
+from app.config import BACKEND_URL, COMPRESSION_ENABLED, FRONTEND_URL, GENAI_API_URL, METRICS_ENABLED, STARTUP_WARMUP
+from app.compression import CompressionMiddleware
+from app.dependencies import USERS_COLLECTION, check_signing_key, client
+from app.genai_client import close_genai_client, get_genai_client, start_genai_client
+from app.jobs import start_job_backend, stop_job_backend
+from app.passwords import close_password_hasher, get_password_hasher
+from app.storage import check_blob_store
+from app.metrics import MetricsMiddleware
+
+
+async def warm_up():
+    """
+    Opens the Firestore channel and a GenAI connection before the worker takes traffic, so the first
+    requests don't pay for them. Failures are only logged, the services may come up later.
+    """
+    try:
+        await asyncio.wait_for(client.collection(USERS_COLLECTION).select([]).limit(1).get(), timeout=10)
+    except Exception as e:
+        print(f"Firestore warm-up failed: {e}")
+
+    try:
+        await get_genai_client().get("/", timeout=5)  # Any response leaves a pooled connection open
+    except Exception as e:
+        print(f"GenAI warm-up failed: {e}")
+
+    get_password_hasher()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Shared resources, created once per worker process
+    check_signing_key()
+    check_blob_store()
+    client.start()
+    start_genai_client()
+    await start_job_backend()
+    if STARTUP_WARMUP:
+        await warm_up()
+    yield
+    # Requests are drained by the server before the shutdown, then the queued jobs by the job backend
+    await stop_job_backend()
+    await close_genai_client()
+    close_password_hasher()
+    await client.close()
 
 
 app = FastAPI(
     title="Users & Conversations Management API",
     description="API for handling authentication, user management, and conversations.",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 
@@ -38,4 +86,14 @@ load_dotenv() # Comment this line if you don't want to read the environment vari
 app.include_router(auth_router, prefix="/api/v1/auth", tags=["Authentication"])
 app.include_router(conversations_router, prefix="/api/v1/conversations", tags=["Conversations"])
 app.include_router(messages_router, prefix="/api/v1/conversations", tags=["Messages"])
+app.include_router(stats_router, prefix="/api/v1/stats", tags=["Stats"])
+
+# Compression of the JSON responses above COMPRESSION_MIN_SIZE (streamed responses are left alone)
+if COMPRESSION_ENABLED:
+    app.add_middleware(CompressionMiddleware)
+
+# Instrumentation, the middleware is added last so it wraps the whole request
+if METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+    app.include_router(metrics_router, tags=["Metrics"])
 
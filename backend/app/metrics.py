@@ -0,0 +1,269 @@
+"""
+Request, Firestore and GenAI instrumentation, enabled with METRICS_ENABLED.
+
+The middleware opens a trace per request; Firestore operations (through the instrumented client
+proxy) and GenAI calls record timing spans and document bytes into it. When the request ends the
+trace is aggregated per route into Prometheus metrics (served by /metrics) and, with TRACE_LOGS,
+printed as one JSON line. When disabled the client is not wrapped and spans are no-ops.
+"""
+import json
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional, Tuple
+from app.config import METRICS_ENABLED, TRACE_LOGS
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+# Trace of the request being handled, None outside of requests (e.g. background jobs)
+current_trace: ContextVar[Optional["RequestTrace"]] = ContextVar("current_trace", default=None)
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str):
+        self.name, self.help_text = name, help_text
+        self.values: Dict[Tuple, float] = defaultdict(float)
+
+    def inc(self, labels: Tuple, amount: float = 1):
+        self.values[labels] += amount
+
+    def render(self, label_names: Tuple[str, ...]):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in self.values.items():
+            yield f"{self.name}{format_labels(label_names, labels)} {value}"
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets=LATENCY_BUCKETS):
+        self.name, self.help_text, self.buckets = name, help_text, buckets
+        self.counts: Dict[Tuple, list] = defaultdict(lambda: [0] * (len(self.buckets) + 1))
+        self.sums: Dict[Tuple, float] = defaultdict(float)
+
+    def observe(self, labels: Tuple, value: float):
+        self.counts[labels][bisect_left(self.buckets, value)] += 1
+        self.sums[labels] += value
+
+    def render(self, label_names: Tuple[str, ...]):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, counts in self.counts.items():
+            cumulative = 0
+            for bucket, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                bucket_labels = format_labels(label_names + ("le",), labels + (str(bucket),))
+                yield f"{self.name}_bucket{bucket_labels} {cumulative}"
+            yield f"{self.name}_sum{format_labels(label_names, labels)} {self.sums[labels]}"
+            yield f"{self.name}_count{format_labels(label_names, labels)} {cumulative}"
+
+
+def format_labels(names: Tuple[str, ...], values: Tuple) -> str:
+    pairs = ",".join(f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+                     for name, value in zip(names, values))
+    return "{" + pairs + "}" if pairs else ""
+
+
+# Metrics, with the names of their labels
+REQUEST_DURATION = (Histogram("http_request_duration_seconds", "Latency of the API requests."), ("method", "route", "status"))
+SPAN_DURATION = (Histogram("span_duration_seconds", "Latency of the Firestore operations and GenAI calls."), ("route", "kind", "operation"))
+FIRESTORE_DOCUMENTS = (Counter("firestore_documents_total", "Firestore documents read or written."), ("route", "direction"))
+FIRESTORE_BYTES = (Counter("firestore_bytes_total", "Approximate bytes of the Firestore documents read or written."), ("route", "direction"))
+LLM_CACHE_REQUESTS = (Counter("llm_cache_requests_total", "LLM answer cache lookups, by hit, miss or coalesced."), ("result",))
+RATE_LIMITED_REQUESTS = (Counter("rate_limited_requests_total", "Message requests rejected by a rate or concurrency limit."), ("scope", "limit"))
+METRICS = [REQUEST_DURATION, SPAN_DURATION, FIRESTORE_DOCUMENTS, FIRESTORE_BYTES, LLM_CACHE_REQUESTS, RATE_LIMITED_REQUESTS]
+
+
+class RequestTrace:
+    def __init__(self, scope):
+        self.scope = scope
+        self.method = scope["method"]
+        self.started = time.perf_counter()
+        self.spans = []
+        self.documents = defaultdict(int)
+        self.bytes = defaultdict(int)
+
+    @property
+    def route(self) -> str:
+        # Route template (e.g. /api/v1/conversations/{conversation_id}/), set in the scope by the router
+        route = self.scope.get("route")
+        return getattr(route, "path", "unmatched")
+
+
+def record_span(kind: str, operation: str, duration: float, documents_read: int = 0, bytes_read: int = 0,
+                documents_written: int = 0, bytes_written: int = 0):
+    trace = current_trace.get()
+    route = trace.route if trace is not None else "background"
+    SPAN_DURATION[0].observe((route, kind, operation), duration)
+
+    for direction, documents, size in (("read", documents_read, bytes_read), ("written", documents_written, bytes_written)):
+        if documents:
+            FIRESTORE_DOCUMENTS[0].inc((route, direction), documents)
+            FIRESTORE_BYTES[0].inc((route, direction), size)
+            if trace is not None:
+                trace.documents[direction] += documents
+                trace.bytes[direction] += size
+
+    if trace is not None and TRACE_LOGS:
+        trace.spans.append({"kind": kind, "operation": operation, "duration_ms": round(duration * 1000, 2)})
+
+
+@contextmanager
+def span(kind: str, operation: str):
+    """
+    Times a block as a span of the current request, a no-op when metrics are disabled.
+    """
+    if not METRICS_ENABLED:
+        yield
+        return
+
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(kind, operation, time.perf_counter() - started)
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware tracing every HTTP request.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        trace = RequestTrace(scope)
+        token = current_trace.set(trace)
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            current_trace.reset(token)
+            duration = time.perf_counter() - trace.started
+            REQUEST_DURATION[0].observe((trace.method, trace.route, status), duration)
+            if TRACE_LOGS:
+                print(json.dumps({
+                    "method": trace.method,
+                    "route": trace.route,
+                    "status": status,
+                    "duration_ms": round(duration * 1000, 2),
+                    "firestore": {"documents": dict(trace.documents), "bytes": dict(trace.bytes)},
+                    "spans": trace.spans,
+                }))
+
+
+def render_metrics() -> str:
+    lines = []
+    for metric, label_names in METRICS:
+        lines.extend(metric.render(label_names))
+    return "\n".join(lines) + "\n"
+
+
+def document_size(data: Optional[dict]) -> int:
+    return len(json.dumps(data, default=str)) if data else 0
+
+
+class InstrumentedFirestore:
+    """
+    Proxy of a Firestore client object (client, collection, query, document, batch) recording a span
+    for each operation, and wrapping the objects it returns so the whole call chain is instrumented.
+    Anything else is delegated, so the proxies are accepted wherever the wrapped objects are.
+    """
+
+    CHAINED = {"collection", "document", "where", "order_by", "limit", "select", "start_after"}
+    OPERATIONS = {"get", "set", "update", "delete", "add", "create"}
+
+    def __init__(self, target):
+        self._target = target
+
+    def __getattr__(self, name):
+        attribute = getattr(self._target, name)
+        if name in self.CHAINED:
+            return lambda *args, **kwargs: InstrumentedFirestore(attribute(*args, **kwargs))
+        if name == "batch":
+            return lambda *args, **kwargs: InstrumentedBatch(attribute(*args, **kwargs))
+        if name == "stream":
+            return lambda *args, **kwargs: self._stream(attribute(*args, **kwargs))
+        if name in self.OPERATIONS:
+            return lambda *args, **kwargs: self._call(name, attribute, *args, **kwargs)
+        return attribute
+
+    def _operation(self, name: str) -> str:
+        return f"{type(self._target).__name__}.{name}"
+
+    async def _call(self, name, method, *args, **kwargs):
+        started = time.perf_counter()
+        result = await method(*args, **kwargs)
+        duration = time.perf_counter() - started
+
+        if name == "get":
+            snapshots = result if isinstance(result, list) else [result]
+            found = [snapshot.to_dict() for snapshot in snapshots if snapshot.exists]
+            record_span("firestore", self._operation(name), duration,
+                        documents_read=len(found), bytes_read=sum(map(document_size, found)))
+        else:
+            data = args[0] if args else next(iter(kwargs.values()), None)
+            record_span("firestore", self._operation(name), duration,
+                        documents_written=1, bytes_written=document_size(data if isinstance(data, dict) else None))
+
+        if name == "add":
+            return result[0], InstrumentedFirestore(result[1])
+        return result
+
+    async def _stream(self, iterator):
+        started = time.perf_counter()
+        documents, size = 0, 0
+        try:
+            async for snapshot in iterator:
+                documents += 1
+                size += document_size(snapshot.to_dict())
+                yield snapshot
+        finally:
+            record_span("firestore", self._operation("stream"), time.perf_counter() - started,
+                        documents_read=documents, bytes_read=size)
+
+
+class InstrumentedBatch:
+    """
+    Proxy of a write batch, the queued writes are recorded when the batch is committed.
+    """
+
+    def __init__(self, target):
+        self._target = target
+        self._writes = 0
+        self._bytes = 0
+
+    def __getattr__(self, name):
+        attribute = getattr(self._target, name)
+        if name in ("set", "update", "delete", "create"):
+            def queue_write(reference, data=None, *args, **kwargs):
+                self._writes += 1
+                self._bytes += document_size(data if isinstance(data, dict) else None)
+                return attribute(reference, data, *args, **kwargs) if data is not None else attribute(reference, *args, **kwargs)
+            return queue_write
+        return attribute
+
+    async def commit(self):
+        started = time.perf_counter()
+        result = await self._target.commit()
+        record_span("firestore", f"{type(self._target).__name__}.commit", time.perf_counter() - started,
+                    documents_written=self._writes, bytes_written=self._bytes)
+        self._writes, self._bytes = 0, 0
+        return result
+
+
+def instrument_firestore(client):
+    return InstrumentedFirestore(client) if METRICS_ENABLED else client
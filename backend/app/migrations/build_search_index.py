@@ -0,0 +1,67 @@
+"""
+Builds the search index entries (`app.search`) of the messages stored before the index existed,
+or while SEARCH_INDEX_ENABLED was off. New messages are indexed as they are written.
+
+The migration is idempotent: messages already indexed are skipped, an interrupted run is resumed
+by running it again.
+
+Usage:
+    python -m app.migrations.build_search_index [--dry-run]
+"""
+import argparse
+import asyncio
+from google.cloud import firestore
+from app.dependencies import CONVERSATIONS_COLLECTION, MESSAGES_COLLECTION, USERS_COLLECTION, client
+from app.search import MESSAGE_TEXT_FIELDS, field_frequencies, field_texts, index_key, index_writes, indexed_messages_collection
+from app.utils import FIRESTORE_BATCH_SIZE
+
+
+async def index_conversation(user_ref, conversation_ref, dry_run: bool = False) -> int:
+    """
+    Indexes the messages of a conversation not indexed yet, returns the number of indexed messages.
+    """
+    indexed_keys = {
+        indexed_doc.id async for indexed_doc in indexed_messages_collection(user_ref)
+        .where(filter=firestore.FieldFilter("conversation_id", "==", conversation_ref.id)).select([]).stream()
+    }
+
+    writes = []
+    indexed_messages = 0
+    query = conversation_ref.collection(MESSAGES_COLLECTION).select(MESSAGE_TEXT_FIELDS + ["message_id", "timestamp"])
+    async for message_doc in query.stream():
+        if index_key(conversation_ref.id, message_doc.id) in indexed_keys:
+            continue
+
+        message = message_doc.to_dict()
+        writes += index_writes(
+            user_ref, conversation_ref.id, message_doc.id, message.get("timestamp", ""),
+            field_frequencies(field_texts(message))
+        )
+        indexed_messages += 1
+
+    # Writes of a message may span two batches, a message whose entry (its last write) is missing is indexed again
+    for start in range(0, len(writes), FIRESTORE_BATCH_SIZE):
+        if not dry_run:
+            batch = client.batch()
+            for _, reference, data in writes[start:start + FIRESTORE_BATCH_SIZE]:
+                batch.set(reference, data)
+            await batch.commit()
+
+    return indexed_messages
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Index the stored messages for the full-text search.")
+    parser.add_argument("--dry-run", action="store_true", help="Report what would be indexed without writing.")
+    args = parser.parse_args()
+
+    indexed_messages = 0
+    async for user_doc in client.collection(USERS_COLLECTION).select(["username"]).stream():
+        async for conversation_doc in user_doc.reference.collection(CONVERSATIONS_COLLECTION).select([]).stream():
+            indexed_messages += await index_conversation(user_doc.reference, conversation_doc.reference, dry_run=args.dry_run)
+
+    print(f"Done, {indexed_messages} messages indexed{' (dry run)' if args.dry_run else ''}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
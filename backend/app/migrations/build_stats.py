@@ -0,0 +1,96 @@
+"""
+Rebuilds the feedback and usage counters (`app.stats`) from the stored messages, for messages
+stored before the counters existed or while STATS_ENABLED was off. New messages and feedback are
+counted as they are written.
+
+Every counter is recomputed and written as a single shard, replacing its current shards, so the
+migration can be run again at any time. Messages written while it runs may be missed: run it while
+the API is stopped, or with STATS_ENABLED off and enable the counters right after.
+
+Usage:
+    python -m app.migrations.build_stats [--dry-run]
+"""
+import argparse
+import asyncio
+from collections import Counter
+from app.dependencies import CONVERSATIONS_COLLECTION, MESSAGES_COLLECTION, USERS_COLLECTION, client
+from app.stats import (
+    COUNTED_FIELDS,
+    TOOL_COUNTED_FIELDS,
+    counter_id,
+    global_stats_collection,
+    message_day,
+    message_increments,
+    tool_names,
+    user_stats_collection,
+)
+from app.utils import FIRESTORE_BATCH_SIZE, delete_collection
+
+MESSAGE_FIELDS = ["question.type", "feedback", "timestamp", "tools"]
+
+
+def counter_documents(collection, counters: dict) -> list:
+    """
+    Shard 0 of each counter, holding its whole value.
+    """
+    return [
+        (collection.document(f"{counter_id(scope, key)}~0"), {"counter": counter_id(scope, key), "scope": scope, "key": key, **counts})
+        for (scope, key), counts in counters.items()
+    ]
+
+
+async def write_documents(documents: list):
+    for start in range(0, len(documents), FIRESTORE_BATCH_SIZE):
+        batch = client.batch()
+        for reference, data in documents[start:start + FIRESTORE_BATCH_SIZE]:
+            batch.set(reference, data)
+        await batch.commit()
+
+
+async def count_user(user_ref, global_counters: dict) -> tuple:
+    """
+    Counts the messages of a user, returns the user's counters and the number of messages.
+    """
+    counters = {}
+    messages = 0
+    async for conversation_doc in user_ref.collection(CONVERSATIONS_COLLECTION).select([]).stream():
+        query = conversation_doc.reference.collection(MESSAGES_COLLECTION).select(MESSAGE_FIELDS)
+        async for message_doc in query.stream():
+            message = message_doc.to_dict()
+            increments = message_increments(message)
+            day = message_day(message.get("timestamp"))
+            user_keys = [("total", None), ("conversation", conversation_doc.id)] + ([("day", day)] if day else [])
+            global_keys = [("total", None)] + ([("day", day)] if day else [])
+            global_keys += [("tool", tool) for tool in tool_names(message.get("tools"))]
+            for key in user_keys:
+                counters.setdefault(key, Counter()).update(increments)
+            for scope, key in global_keys:
+                fields = TOOL_COUNTED_FIELDS if scope == "tool" else COUNTED_FIELDS
+                global_counters.setdefault((scope, key), Counter()).update({field: increments[field] for field in fields})
+            messages += 1
+    return counters, messages
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Rebuild the feedback and usage counters from the stored messages.")
+    parser.add_argument("--dry-run", action="store_true", help="Report the counts without writing.")
+    args = parser.parse_args()
+
+    global_counters = {}
+    counted_messages = 0
+    async for user_doc in client.collection(USERS_COLLECTION).select(["username"]).stream():
+        counters, messages = await count_user(user_doc.reference, global_counters)
+        counted_messages += messages
+        if not args.dry_run:
+            await delete_collection(user_stats_collection(user_doc.reference))
+            await write_documents(counter_documents(user_stats_collection(user_doc.reference), counters))
+
+    if not args.dry_run:
+        await delete_collection(global_stats_collection())
+        await write_documents(counter_documents(global_stats_collection(), global_counters))
+
+    print(f"Done, {counted_messages} messages counted{' (dry run)' if args.dry_run else ''}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
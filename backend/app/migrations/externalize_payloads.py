@@ -0,0 +1,73 @@
+"""
+Moves the large result tables (`data`) and generated charts of existing messages out of line, to
+the blob store (`app.payloads`), leaving their references in the messages. New answers are stored
+this way when written by the API.
+
+The migration is idempotent, payloads already moved (or small enough to stay inline) are skipped.
+
+Usage:
+    python -m app.migrations.externalize_payloads [--dry-run]
+"""
+import argparse
+import asyncio
+from google.api_core.exceptions import NotFound
+from app.config import PAYLOAD_INLINE_MAX_BYTES
+from app.dependencies import CONVERSATIONS_COLLECTION, MESSAGES_COLLECTION, USERS_COLLECTION, client
+from app.payloads import delete_blobs, externalize_payloads, json_size, replaced_blob_ids
+from app.responses import parse_generated_chart
+
+
+def large_payload_fields(message: dict) -> dict:
+    """
+    The payload fields of a message (as update fields) larger than PAYLOAD_INLINE_MAX_BYTES.
+    """
+    fields = {}
+    if isinstance(message.get("data"), list) and json_size(message["data"]) > PAYLOAD_INLINE_MAX_BYTES:
+        fields["data"] = message["data"]
+    chart = parse_generated_chart((message.get("answer") or {}).get("generated_chart"))
+    if chart is not None and json_size(chart) > PAYLOAD_INLINE_MAX_BYTES:
+        fields["answer.generated_chart"] = chart
+    return fields
+
+
+async def migrate_conversation(conversation_ref, dry_run: bool = False) -> int:
+    """
+    Moves the large payloads of the messages of a conversation, returns the number of migrated messages.
+    """
+    migrated_messages = 0
+    query = conversation_ref.collection(MESSAGES_COLLECTION).select(["data", "answer.generated_chart"])
+    async for message_doc in query.stream():
+        fields = large_payload_fields(message_doc.to_dict())
+        if not fields:
+            continue
+
+        if not dry_run:
+            # A message answered again inline may still reference the blobs of its previous payloads
+            previous_blob_ids = await replaced_blob_ids(message_doc.reference, fields)
+            fields, blob_ids = await externalize_payloads(fields)
+            try:
+                await message_doc.reference.update(fields)
+            except NotFound:
+                await delete_blobs(blob_ids)  # Deleted in the meantime
+                continue
+            await delete_blobs(previous_blob_ids)
+        migrated_messages += 1
+
+    return migrated_messages
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Move the large tables and charts of the messages to the blob store.")
+    parser.add_argument("--dry-run", action="store_true", help="Report what would be migrated without writing.")
+    args = parser.parse_args()
+
+    migrated_messages = 0
+    async for user_doc in client.collection(USERS_COLLECTION).select(["username"]).stream():
+        async for conversation_doc in user_doc.reference.collection(CONVERSATIONS_COLLECTION).select([]).stream():
+            migrated_messages += await migrate_conversation(conversation_doc.reference, dry_run=args.dry_run)
+
+    print(f"Done, {migrated_messages} messages migrated{' (dry run)' if args.dry_run else ''}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
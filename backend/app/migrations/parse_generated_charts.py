@@ -0,0 +1,54 @@
+"""
+Stores the `generated_chart` of existing messages parsed, as a map, instead of the JSON string the
+message list used to decode on every read. Charts Firestore cannot store as a map (arrays of arrays)
+stay strings and are still decoded when read.
+
+The migration is idempotent, only string charts are rewritten.
+
+Usage:
+    python -m app.migrations.parse_generated_charts [--dry-run]
+"""
+import argparse
+import asyncio
+from app.dependencies import CONVERSATIONS_COLLECTION, MESSAGES_COLLECTION, USERS_COLLECTION, client
+from app.responses import storable_generated_chart
+
+
+async def migrate_conversation(conversation_ref, dry_run: bool = False) -> int:
+    """
+    Rewrites the string charts of the messages of a conversation, returns the number of rewritten charts.
+    """
+    migrated_charts = 0
+    query = conversation_ref.collection(MESSAGES_COLLECTION).select(["answer.generated_chart"])
+    async for message_doc in query.stream():
+        generated_chart = (message_doc.to_dict().get("answer") or {}).get("generated_chart")
+        if not isinstance(generated_chart, str):
+            continue
+
+        parsed_chart = storable_generated_chart(generated_chart)
+        if isinstance(parsed_chart, str):
+            continue  # Not valid JSON, or not storable as a map
+
+        # One write per message, charts can be close to the document size limit
+        if not dry_run:
+            await message_doc.reference.update({"answer.generated_chart": parsed_chart})
+        migrated_charts += 1
+
+    return migrated_charts
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Store the generated charts of the messages as maps.")
+    parser.add_argument("--dry-run", action="store_true", help="Report what would be migrated without writing.")
+    args = parser.parse_args()
+
+    migrated_charts = 0
+    async for user_doc in client.collection(USERS_COLLECTION).select(["username"]).stream():
+        async for conversation_doc in user_doc.reference.collection(CONVERSATIONS_COLLECTION).select([]).stream():
+            migrated_charts += await migrate_conversation(conversation_doc.reference, dry_run=args.dry_run)
+
+    print(f"Done, {migrated_charts} charts parsed{' (dry run)' if args.dry_run else ''}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
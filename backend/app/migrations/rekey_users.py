@@ -0,0 +1,128 @@
+"""
+Re-keys the user documents by normalized username:
+
+    users/{auto-generated id}  ->  users/{normalize_username(username)}
+
+with all their subcollections (conversations and their messages, the search index, the counters...)
+so users are read by document ID instead of queried by field. Subcollections are listed with
+`collections()`, at every level, so none is left behind under the old ID. Run it after `split_conversations` (users still holding embedded conversations are
+skipped) and right when deploying, users not re-keyed yet cannot log in.
+
+The migration is idempotent: the subcollections and the user document are copied with `set` before
+anything is deleted, so an interrupted run is resumed by running it again. Usernames colliding once
+normalized (e.g. "Alice" and "alice") are reported and left untouched, for manual resolution.
+
+Usage:
+    python -m app.migrations.rekey_users [--dry-run]
+"""
+import argparse
+import asyncio
+from collections import Counter
+from app.dependencies import USERS_COLLECTION, client, get_user_document_reference, invalidate_user
+from app.utils import FIRESTORE_BATCH_SIZE, delete_collection
+
+
+class BatchedWrites:
+    """
+    Accumulates writes in a batch, committed every `FIRESTORE_BATCH_SIZE` writes.
+    """
+
+    def __init__(self, dry_run: bool = False):
+        self.dry_run = dry_run
+        self.batch = client.batch()
+        self.pending_writes = 0
+
+    async def set(self, reference, data: dict):
+        self.batch.set(reference, data)
+        self.pending_writes += 1
+        if self.pending_writes >= FIRESTORE_BATCH_SIZE:
+            await self.commit()
+
+    async def commit(self):
+        if self.pending_writes and not self.dry_run:
+            await self.batch.commit()
+        self.batch = client.batch()
+        self.pending_writes = 0
+
+
+async def copy_subcollections(source_ref, target_ref, writes: BatchedWrites, copied: Counter):
+    """
+    Copies every subcollection of a document under another document, recursively. `copied` counts
+    the documents copied by collection name.
+    """
+    async for collection_ref in source_ref.collections():
+        async for doc in collection_ref.stream():
+            target_doc_ref = target_ref.collection(collection_ref.id).document(doc.id)
+            await writes.set(target_doc_ref, doc.to_dict())
+            copied[collection_ref.id] += 1
+            await copy_subcollections(doc.reference, target_doc_ref, writes, copied)
+
+
+async def delete_subcollections(reference):
+    """
+    Deletes every subcollection of a document, recursively.
+    """
+    collection_refs = [collection_ref async for collection_ref in reference.collections()]
+    for collection_ref in collection_refs:
+        async for doc in collection_ref.select([]).stream():
+            await delete_subcollections(doc.reference)
+        await delete_collection(collection_ref)
+
+
+async def rekey_user(user_doc, dry_run: bool = False) -> str:
+    """
+    Moves a user document and its subcollections under the normalized username.
+    Returns the outcome, reported by `main`.
+    """
+    data = user_doc.to_dict()
+    username = data.get("username", "")
+    if "conversations" in data:
+        return "skipped, run app.migrations.split_conversations first"
+
+    target_ref = get_user_document_reference(username)
+    if target_ref is None:
+        return "skipped, the username cannot be used as a document ID"
+
+    # An identical target is a copy made by an interrupted run, anything else is another user
+    target_doc = await target_ref.get()
+    if target_doc.exists and target_doc.to_dict() != data:
+        return f"conflict with the existing user {target_ref.id!r}, resolve it manually"
+
+    # Copy the subcollections first, then the user document, so a user that can log in has all its data
+    writes = BatchedWrites(dry_run)
+    copied = Counter()
+    await copy_subcollections(user_doc.reference, target_ref, writes, copied)
+    await writes.set(target_ref, data)
+    await writes.commit()
+
+    if not dry_run:
+        await delete_subcollections(user_doc.reference)
+        await user_doc.reference.delete()
+        invalidate_user(username)
+
+    copied_documents = ", ".join(f"{count} {name}" for name, count in sorted(copied.items())) or "no documents"
+    return f"re-keyed to {target_ref.id!r} with {copied_documents}"
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Re-key the user documents by normalized username.")
+    parser.add_argument("--dry-run", action="store_true", help="Report what would be re-keyed without writing.")
+    args = parser.parse_args()
+
+    # Collect first, the migration adds documents to the collection being listed
+    user_docs = [user_doc async for user_doc in client.collection(USERS_COLLECTION).stream()]
+
+    rekeyed_users = 0
+    for user_doc in user_docs:
+        target_ref = get_user_document_reference(user_doc.to_dict().get("username", ""))
+        if target_ref is not None and target_ref.id == user_doc.id:
+            continue  # Already keyed by normalized username
+        outcome = await rekey_user(user_doc, dry_run=args.dry_run)
+        rekeyed_users += outcome.startswith("re-keyed")
+        print(f"User {user_doc.to_dict().get('username')} ({user_doc.id}): {outcome}")
+
+    print(f"Done, {rekeyed_users} users re-keyed{' (dry run)' if args.dry_run else ''}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,86 @@
+"""
+Moves the conversations embedded in each user document into the subcollection layout:
+
+    users/{user}/conversations/{conversation_id}
+    users/{user}/conversations/{conversation_id}/messages/{message_id}
+
+The migration is idempotent, documents are written with `set` and the embedded
+`conversations` field is only removed once everything has been copied, so it can
+safely be re-run (e.g. once before and once after deploying).
+
+Usage:
+    python -m app.migrations.split_conversations [--dry-run]
+"""
+import argparse
+import asyncio
+from google.cloud import firestore
+from app.dependencies import USERS_COLLECTION, client, invalidate_user
+from app.utils import (
+    FIRESTORE_BATCH_SIZE, conversation_list_version, get_conversation_reference, get_message_reference, message_preview
+)
+
+
+async def migrate_user(user_doc, dry_run: bool = False) -> int:
+    """
+    Copies the embedded conversations of a user document into subcollections.
+    Returns the number of migrated messages.
+    """
+    conversations = user_doc.to_dict().get("conversations")
+    if conversations is None:
+        return 0  # Already migrated
+
+    user_ref = user_doc.reference
+    batch = client.batch()
+    pending_writes = 0
+    migrated_messages = 0
+
+    for conversation in conversations:
+        messages = conversation.pop("messages", [])
+        conversation_ref = get_conversation_reference(user_ref, conversation["conversation_id"])
+
+        # Summary fields served by the conversation list
+        conversation["message_count"] = len(messages)
+        last_message = max(messages, key=lambda message: message["timestamp"], default={})
+        conversation["last_message_preview"] = message_preview(last_message)
+
+        batch.set(conversation_ref, conversation, merge=True)
+        pending_writes += 1
+
+        for message in messages:
+            batch.set(get_message_reference(conversation_ref, message["message_id"]), message)
+            pending_writes += 1
+            migrated_messages += 1
+
+            if pending_writes >= FIRESTORE_BATCH_SIZE - 1:
+                if not dry_run:
+                    await batch.commit()
+                batch = client.batch()
+                pending_writes = 0
+
+    # Drop the embedded array last, so an interrupted run leaves the user migratable again
+    batch.update(user_ref, {"conversations": firestore.DELETE_FIELD, **conversation_list_version()})
+    if not dry_run:
+        await batch.commit()
+        invalidate_user(user_doc.to_dict().get("username"))
+
+    return migrated_messages
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Split embedded conversations into Firestore subcollections.")
+    parser.add_argument("--dry-run", action="store_true", help="Report what would be migrated without writing.")
+    args = parser.parse_args()
+
+    migrated_users = 0
+    async for user_doc in client.collection(USERS_COLLECTION).stream():
+        if "conversations" not in (user_doc.to_dict() or {}):
+            continue
+        migrated_messages = await migrate_user(user_doc, dry_run=args.dry_run)
+        migrated_users += 1
+        print(f"Migrated user {user_doc.to_dict().get('username')}: {migrated_messages} messages")
+
+    print(f"Done, {migrated_users} users migrated{' (dry run)' if args.dry_run else ''}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
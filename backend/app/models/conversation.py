@@ -2,10 +2,15 @@ from typing import List, Optional
 from pydantic import BaseModel
 from app.models.message import Message
 
-class Conversation(BaseModel):
+class ConversationSummary(BaseModel):
     conversation_id: str
     title: str
     last_interaction: Optional[str]
+    message_count: int = 0  # Maintained on every stored message
+    last_message_preview: Optional[str] = None  # Beginning of the last question
+
+
+class Conversation(ConversationSummary):
     messages: List[Message] = []  # List of messages in the conversation
 
 
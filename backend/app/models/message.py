@@ -1,17 +1,36 @@
-from typing import Dict, List, Optional, Union
+from datetime import datetime
+from typing import Dict, List, Literal, Optional, Union
 from pydantic import BaseModel
 
+FeedbackValue = Literal["LIKE", "DISLIKE"]
+
 
 class Question(BaseModel):
     type: str  # Can be 'AUDIO', 'TEXT', etc.
     content: str  # The actual content of the question
     transcription: Optional[str] = None # Optional transcription if the type is AUDIO
+    audio_id: Optional[str] = None  # Blob holding the audio if the type is AUDIO, the content is then empty
+    audio_content_type: Optional[str] = None
+
+
+class ChartReference(BaseModel):
+    size: int  # Compressed size in bytes
+    title: Optional[str] = None
+    trace_types: List[str] = []
 
 
 class Answer(BaseModel):
     type: str  # Type is always 'TEXT', since the genai module always return text responses.
     content: Union[str, Dict, List[Dict]]  # The actual content of the answer
     generated_chart: Optional[Union[str, Dict,]] = None # Optional for the visualization agent responses
+    chart_ref: Optional[ChartReference] = None  # Set instead of generated_chart for large charts, fetched from the chart endpoint
+
+
+class TableReference(BaseModel):
+    rows: int
+    columns: List[str]
+    preview: List[Dict]  # The first rows of the table
+    size: int  # Compressed size in bytes
 
 
 class Message(BaseModel):
@@ -22,12 +41,26 @@ class Message(BaseModel):
     feedback: Optional[str] = None  # Feedback can be 'LIKE' or 'DISLIKE'
     tools: Optional[Dict] = None    # Added field
     data: Optional[List[Dict]] = None  # Added field
+    data_ref: Optional[TableReference] = None  # Set instead of data for large tables, fetched from the data endpoint
+    status: Optional[str] = None  # 'PENDING', 'TRANSCRIBING', 'ANSWERING', 'DONE' or 'FAILED' for background messages
+    error: Optional[str] = None  # Why a background message FAILED, when its processing raised
 
 
 class MessageCreate(BaseModel):
     question: Question  # The new structure for creating messages with question type and content
 
 
+class BatchMessage(MessageCreate):
+    conversation_id: str
+    answer: Optional[Answer] = None  # Answer of imported history, otherwise filled by the GenAI module
+    timestamp: Optional[datetime] = None  # Defaults to the ingestion time, in the order of the batch
+    feedback: Optional[FeedbackValue] = None
+
+
+class BatchMessageCreate(BaseModel):
+    messages: List[Dict]  # Validated one by one against BatchMessage, so invalid items get their own error
+
+
 class FeedbackUpdate(BaseModel):
     feedback: str  # Feedback for messages, 'LIKE' or 'DISLIKE'
 
@@ -0,0 +1,71 @@
+"""
+Password hashing and verification off the event loop.
+
+bcrypt costs ~100-300 ms of CPU per call, run inline it freezes every other request of the worker.
+The calls run on a dedicated, bounded thread pool instead (bcrypt releases the GIL while hashing),
+and a burst of logins beyond the pool and its waiting room is rejected right away (PasswordHasherBusy)
+rather than queued behind seconds of hashing.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+from app.config import PASSWORD_HASH_MAX_PENDING, PASSWORD_HASH_WORKERS
+from app.dependencies import get_password_hash, verify_password
+from app.metrics import span
+
+
+class PasswordHasherBusy(Exception):
+    """Raised when a password operation cannot be accepted because the pool is at capacity."""
+
+
+class PasswordHasher:
+    """
+    Runs the bcrypt calls on `workers` threads, with at most `max_pending` calls admitted
+    (running or waiting for a thread) at a time.
+    """
+
+    def __init__(self, workers: int = PASSWORD_HASH_WORKERS, max_pending: int = PASSWORD_HASH_MAX_PENDING):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-hasher")
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    async def _run(self, operation: str, function, *args):
+        # Admission is decided on the event loop thread, so the counter needs no lock
+        if self.pending >= self.max_pending:
+            raise PasswordHasherBusy(f"Password hashing is at capacity ({self.max_pending} pending)")
+
+        self.pending += 1
+        try:
+            with span("password", operation):
+                return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+        finally:
+            self.pending -= 1
+
+    async def hash(self, password: str) -> str:
+        return await self._run("hash", get_password_hash, password)
+
+    async def verify(self, plain_password: str, hashed_password: Optional[str]) -> bool:
+        if not hashed_password:
+            return False
+        return await self._run("verify", verify_password, plain_password, hashed_password)
+
+
+_hasher: Optional[PasswordHasher] = None
+
+
+def get_password_hasher() -> PasswordHasher:
+    global _hasher
+    if _hasher is None:
+        _hasher = PasswordHasher()
+    return _hasher
+
+
+def close_password_hasher():
+    global _hasher
+    if _hasher is not None:
+        _hasher.close()
+        _hasher = None
@@ -0,0 +1,208 @@
+"""
+Out-of-line storage of the large answer payloads: the result tables (`data`) and the generated charts.
+
+Payloads whose JSON exceeds PAYLOAD_INLINE_MAX_BYTES are written to the blob store and the message
+only keeps a reference, so listing messages reads and sends a few hundred bytes per message instead
+of whole tables and Plotly specs, which the client only needs once a message is expanded:
+- tables are stored column by column (the column names once, then the values of each column),
+  gzip compressed, in chunks of DATA_TABLE_CHUNK_ROWS rows, so a page of a large table only reads
+  and decodes the chunks it spans. `data_ref` holds the row count, the columns, a preview of the
+  first DATA_PREVIEW_ROWS rows and the chunk blobs;
+- charts are stored as gzip compressed JSON, sent as is to the clients accepting gzip.
+  `answer.chart_ref` holds the blob, the size and the title and trace types of the chart.
+
+Payloads under the threshold, and the ones written by the GenAI module before the API sees them,
+stay inline until moved by `app.migrations.externalize_payloads`.
+"""
+import gzip
+import json
+from typing import Any, Dict, List, Tuple
+from app.config import (
+    DATA_PREVIEW_ROWS,
+    DATA_TABLE_CHUNK_ROWS,
+    PAYLOAD_COMPRESSION_LEVEL,
+    PAYLOAD_INLINE_MAX_BYTES,
+    PAYLOAD_STORAGE_ENABLED,
+)
+from app.responses import json_loads, parse_generated_chart
+from app.storage import get_blob_store, iter_bytes, new_blob_id
+
+# Message fields holding the references, and the fields read to find the blobs of a message
+DATA_REF_FIELD = "data_ref"
+CHART_REF_FIELD = "answer.chart_ref"
+PAYLOAD_BLOB_FIELD_PATHS = ["data_ref.chunks", "answer.chart_ref.blob_id"]
+# Payload fields being written: the field read to find the blobs they replace
+REPLACED_BLOB_FIELD_PATHS = {"data": "data_ref.chunks", "answer.generated_chart": "answer.chart_ref.blob_id"}
+
+
+def json_size(value: Any) -> int:
+    return len(json.dumps(value, separators=(",", ":"), default=str).encode())
+
+
+def table_columns(rows: List[Dict]) -> List[str]:
+    # Columns in order of first appearance, rows of a result table usually share them all
+    return list(dict.fromkeys(column for row in rows for column in row))
+
+
+def encode_table_chunk(rows: List[Dict], columns: List[str]) -> bytes:
+    """
+    Column-major encoding of rows: the values of each column, and the positions of the rows missing
+    a column (told apart from null values).
+    """
+    missing = {}
+    values = []
+    for index, column in enumerate(columns):
+        values.append([row.get(column) for row in rows])
+        absent = [position for position, row in enumerate(rows) if column not in row]
+        if absent:
+            missing[str(index)] = absent
+    chunk = {"rows": len(rows), "values": values, **({"missing": missing} if missing else {})}
+    return gzip.compress(json.dumps(chunk, separators=(",", ":"), default=str).encode(), compresslevel=PAYLOAD_COMPRESSION_LEVEL)
+
+
+def decode_table_chunk(data: bytes, columns: List[str]) -> List[Dict]:
+    chunk = json_loads(gzip.decompress(data))
+    values = chunk["values"]
+    rows = [dict(zip(columns, row_values)) for row_values in zip(*values)] if values else [{} for _ in range(chunk["rows"])]
+    for index, positions in chunk.get("missing", {}).items():
+        for position in positions:
+            rows[position].pop(columns[int(index)], None)
+    return rows
+
+
+async def write_blob(data: bytes) -> str:
+    blob_id = new_blob_id()
+    await get_blob_store().write(blob_id, iter_bytes(data))
+    return blob_id
+
+
+async def read_blob(blob_id: str) -> bytes:
+    return b"".join([chunk async for chunk in get_blob_store().read(blob_id)])
+
+
+async def store_table(rows: List[Dict]) -> Dict:
+    """
+    Writes a table to the blob store, returns its `data_ref`.
+    """
+    columns = table_columns(rows)
+    chunks, size = [], 0
+    try:
+        for start in range(0, len(rows), DATA_TABLE_CHUNK_ROWS):
+            data = encode_table_chunk(rows[start:start + DATA_TABLE_CHUNK_ROWS], columns)
+            chunks.append(await write_blob(data))
+            size += len(data)
+    except BaseException:
+        await delete_blobs(chunks)
+        raise
+    return {
+        "rows": len(rows),
+        "columns": columns,
+        "preview": rows[:DATA_PREVIEW_ROWS],
+        "size": size,
+        "chunk_rows": DATA_TABLE_CHUNK_ROWS,
+        "chunks": chunks,
+    }
+
+
+async def read_table_rows(data_ref: Dict, offset: int, limit: int) -> List[Dict]:
+    """
+    Rows `offset` to `offset + limit` of a stored table, only the chunks holding them are read.
+    """
+    chunk_rows = data_ref["chunk_rows"]
+    end = min(offset + limit, data_ref["rows"])
+    rows = []
+    for chunk_index in range(offset // chunk_rows, (end - 1) // chunk_rows + 1 if end > offset else 0):
+        chunk = decode_table_chunk(await read_blob(data_ref["chunks"][chunk_index]), data_ref["columns"])
+        chunk_start = chunk_index * chunk_rows
+        rows += chunk[max(offset - chunk_start, 0):end - chunk_start]
+    return rows
+
+
+def chart_summary(chart: Any) -> Dict:
+    """
+    Title and trace types of a Plotly figure, shown until the chart itself is fetched.
+    """
+    if not isinstance(chart, dict):
+        return {"title": None, "trace_types": []}
+    title = (chart.get("layout") or {}).get("title")
+    if isinstance(title, dict):
+        title = title.get("text")
+    traces = chart.get("data") if isinstance(chart.get("data"), list) else []
+    trace_types = list(dict.fromkeys(trace.get("type", "scatter") for trace in traces if isinstance(trace, dict)))
+    return {"title": title if isinstance(title, str) else None, "trace_types": trace_types}
+
+
+async def store_chart(chart: Any) -> Dict:
+    """
+    Writes a chart to the blob store, returns its `chart_ref`.
+    """
+    data = gzip.compress(json.dumps(chart, separators=(",", ":"), default=str).encode(), compresslevel=PAYLOAD_COMPRESSION_LEVEL)
+    return {"blob_id": await write_blob(data), "size": len(data), **chart_summary(chart)}
+
+
+async def read_chart(chart_ref: Dict, decompress: bool = True) -> bytes:
+    """
+    The JSON of a stored chart, or its gzip encoding as stored.
+    """
+    data = await read_blob(chart_ref["blob_id"])
+    return gzip.decompress(data) if decompress else data
+
+
+async def externalize_payloads(fields: Dict) -> Tuple[Dict, List[str]]:
+    """
+    Moves the large payloads of message fields being written (dotted paths, as passed to
+    `update_message_fields`) to the blob store, replacing them with their references. Returns the
+    fields to write and the blobs written, to delete if the write fails.
+    """
+    if not PAYLOAD_STORAGE_ENABLED:
+        return fields, []
+
+    fields = dict(fields)
+    blob_ids = []
+    data = fields.get("data")
+    if "data" in fields:
+        if isinstance(data, list) and data and json_size(data) > PAYLOAD_INLINE_MAX_BYTES:
+            fields["data"], fields[DATA_REF_FIELD] = None, await store_table(data)
+            blob_ids += fields[DATA_REF_FIELD]["chunks"]
+        else:
+            fields[DATA_REF_FIELD] = None
+
+    if "answer.generated_chart" in fields:
+        chart = parse_generated_chart(fields["answer.generated_chart"])
+        if chart is not None and json_size(chart) > PAYLOAD_INLINE_MAX_BYTES:
+            fields["answer.generated_chart"], fields[CHART_REF_FIELD] = None, await store_chart(chart)
+            blob_ids.append(fields[CHART_REF_FIELD]["blob_id"])
+        else:
+            fields[CHART_REF_FIELD] = None
+
+    return fields, blob_ids
+
+
+def payload_blob_ids(message: Dict) -> List[str]:
+    """
+    Blobs of the payloads of a message, read with PAYLOAD_BLOB_FIELD_PATHS.
+    """
+    data_ref = message.get("data_ref") or {}
+    chart_ref = (message.get("answer") or {}).get("chart_ref") or {}
+    return list(data_ref.get("chunks") or []) + ([chart_ref["blob_id"]] if chart_ref.get("blob_id") else [])
+
+
+async def replaced_blob_ids(message_ref, fields: Dict) -> List[str]:
+    """
+    Blobs of the current payloads of a message that the fields being written replace (its table
+    when `data` is written, its chart when `answer.generated_chart` is), to delete once the write
+    is committed. Only reads the message when payload fields are written.
+    """
+    if not PAYLOAD_STORAGE_ENABLED:
+        return []
+    field_paths = [field_path for field, field_path in REPLACED_BLOB_FIELD_PATHS.items() if field in fields]
+    if not field_paths:
+        return []
+    message_doc = await message_ref.get(field_paths=field_paths)
+    return payload_blob_ids(message_doc.to_dict() or {})
+
+
+async def delete_blobs(blob_ids: List[str]):
+    for blob_id in blob_ids:
+        await get_blob_store().delete(blob_id)
+
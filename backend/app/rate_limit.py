@@ -0,0 +1,246 @@
+"""
+Rate limits of the GenAI-backed message endpoints, per user and global: a token bucket (requests
+per minute with a burst) and a cap on the requests in flight. Requests over a limit are rejected
+with a 429 and a Retry-After header.
+
+The limiter state lives in a RateLimitStore selected with RATE_LIMIT_BACKEND. The in-memory store
+limits each worker process on its own, a store shared by the workers (e.g. Redis) applies the limits
+to the whole deployment and only has to implement the three atomic operations of the interface.
+"""
+import math
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+from fastapi import Depends, HTTPException, status
+from app.config import (
+    RATE_LIMIT_BACKEND,
+    RATE_LIMIT_CONCURRENCY_RETRY_AFTER_SECONDS,
+    RATE_LIMIT_ENABLED,
+    RATE_LIMIT_GLOBAL_BURST,
+    RATE_LIMIT_GLOBAL_MAX_CONCURRENT,
+    RATE_LIMIT_GLOBAL_PER_MINUTE,
+    RATE_LIMIT_SLOT_TTL_SECONDS,
+    RATE_LIMIT_USER_BURST,
+    RATE_LIMIT_USER_MAX_CONCURRENT,
+    RATE_LIMIT_USER_PER_MINUTE,
+)
+from app.dependencies import get_current_user, normalize_username
+from app.metrics import RATE_LIMITED_REQUESTS
+
+GLOBAL_KEY = "global"
+
+
+class RateLimited(Exception):
+    """Raised when a request exceeds a rate or concurrency limit."""
+
+    def __init__(self, scope: str, limit: str, retry_after: float):
+        super().__init__(f"{scope} {limit} limit exceeded, retry after {retry_after:.1f}s")
+        self.scope = scope
+        self.limit = limit
+        self.retry_after = retry_after
+
+
+class RateLimitStore:
+    """
+    Interface of the rate limiter stores. Each operation must be atomic, so a store shared by
+    several processes enforces the limits across all of them.
+    """
+
+    async def take_token(self, key: str, per_minute: float, burst: int, cost: int = 1) -> float:
+        """
+        Takes `cost` tokens (at most `burst`) from the bucket `key`, refilled at `per_minute` tokens
+        per minute up to `burst`. Returns 0 when they were taken, the seconds until they are available otherwise.
+        """
+        raise NotImplementedError
+
+    async def acquire_slot(self, key: str, limit: int, ttl: float) -> bool:
+        """
+        Takes one of the `limit` slots of `key`, returns whether one was free. Shared stores expire
+        the slots after `ttl` seconds, so the slots of a crashed process are eventually given back.
+        """
+        raise NotImplementedError
+
+    async def release_slot(self, key: str):
+        raise NotImplementedError
+
+
+class MemoryRateLimitStore(RateLimitStore):
+    """
+    Limiter state of the worker process. Operations don't await, so they are atomic on the event loop.
+    """
+
+    def __init__(self, max_buckets: int = 10000):
+        self.max_buckets = max_buckets
+        self.buckets: Dict[str, Tuple[float, float]] = {}  # Key: (tokens, monotonic time of the last refill)
+        self.slots: Dict[str, int] = {}
+
+    async def take_token(self, key: str, per_minute: float, burst: int, cost: int = 1) -> float:
+        now = time.monotonic()
+        rate = per_minute / 60
+        tokens, refilled_at = self.buckets.get(key, (burst, now))
+        tokens = min(burst, tokens + (now - refilled_at) * rate)
+
+        if tokens >= cost:
+            self.buckets[key] = (tokens - cost, now)
+            if len(self.buckets) > self.max_buckets:
+                self._drop_full_buckets(now, rate, burst)
+            return 0.0
+
+        self.buckets[key] = (tokens, now)
+        return (cost - tokens) / rate
+
+    def _drop_full_buckets(self, now: float, rate: float, burst: int):
+        # A bucket refilled to its burst is the same as no bucket, so idle users don't accumulate
+        for key, (tokens, refilled_at) in list(self.buckets.items()):
+            if tokens + (now - refilled_at) * rate >= burst:
+                del self.buckets[key]
+
+    async def acquire_slot(self, key: str, limit: int, ttl: float) -> bool:
+        in_use = self.slots.get(key, 0)
+        if in_use >= limit:
+            return False
+        self.slots[key] = in_use + 1
+        return True
+
+    async def release_slot(self, key: str):
+        in_use = self.slots.get(key, 0) - 1
+        if in_use > 0:
+            self.slots[key] = in_use
+        else:
+            self.slots.pop(key, None)
+
+
+class RateLimiter:
+    """
+    Applies the per-user and global limits, a limit of 0 is disabled.
+    """
+
+    def __init__(
+        self,
+        store: RateLimitStore,
+        user_per_minute: float = RATE_LIMIT_USER_PER_MINUTE,
+        user_burst: int = RATE_LIMIT_USER_BURST,
+        user_max_concurrent: int = RATE_LIMIT_USER_MAX_CONCURRENT,
+        global_per_minute: float = RATE_LIMIT_GLOBAL_PER_MINUTE,
+        global_burst: int = RATE_LIMIT_GLOBAL_BURST,
+        global_max_concurrent: int = RATE_LIMIT_GLOBAL_MAX_CONCURRENT,
+    ):
+        self.store = store
+        self.rates = [("user", user_per_minute, user_burst), ("global", global_per_minute, global_burst)]
+        self.concurrency = [("user", user_max_concurrent), ("global", global_max_concurrent)]
+
+    @staticmethod
+    def _key(scope: str, username: str, kind: str) -> str:
+        return f"{kind}:{GLOBAL_KEY}" if scope == "global" else f"{kind}:user:{normalize_username(username)}"
+
+    def max_cost(self) -> Optional[int]:
+        """
+        Most tokens a single request can take, the smallest burst of the enabled rates (None when unlimited).
+        """
+        bursts = [max(burst, 1) for _, per_minute, burst in self.rates if per_minute > 0]
+        return min(bursts) if bursts else None
+
+    async def acquire(self, username: str, cost: int = 1) -> "RateLimitLease":
+        """
+        Takes an in-flight slot of the user and of the service, then `cost` tokens (one per message,
+        at most `max_cost`) from their buckets. Raises RateLimited when a limit is reached, the slots
+        are to be given back with the lease.
+        """
+        lease = RateLimitLease(self.store)
+        try:
+            # Slots first: a request turned away for concurrency doesn't spend a token
+            for scope, max_concurrent in self.concurrency:
+                if max_concurrent <= 0:
+                    continue
+                key = self._key(scope, username, "inflight")
+                if not await self.store.acquire_slot(key, max_concurrent, RATE_LIMIT_SLOT_TTL_SECONDS):
+                    raise RateLimited(scope, "concurrency", RATE_LIMIT_CONCURRENCY_RETRY_AFTER_SECONDS)
+                lease.keys.append(key)
+
+            for scope, per_minute, burst in self.rates:
+                if per_minute <= 0:
+                    continue
+                retry_after = await self.store.take_token(self._key(scope, username, "rate"), per_minute, max(burst, 1), cost)
+                if retry_after > 0:
+                    raise RateLimited(scope, "rate", retry_after)
+
+        except RateLimited as e:
+            RATE_LIMITED_REQUESTS[0].inc((e.scope, e.limit))
+            await lease.release()
+            raise
+
+        return lease
+
+
+class RateLimitLease:
+    """
+    In-flight slots held by a request, released once (further calls are no-ops).
+    """
+
+    def __init__(self, store: Optional[RateLimitStore] = None):
+        self.store = store
+        self.keys: List[str] = []
+
+    async def release(self):
+        keys, self.keys = self.keys, []
+        for key in keys:
+            await self.store.release_slot(key)
+
+
+# Available stores by name, selected with the RATE_LIMIT_BACKEND setting
+RATE_LIMIT_STORES: Dict[str, Callable[[], RateLimitStore]] = {
+    "memory": MemoryRateLimitStore,
+}
+
+_limiter: Optional[RateLimiter] = None
+
+
+def get_rate_limiter() -> RateLimiter:
+    global _limiter
+    if _limiter is None:
+        _limiter = RateLimiter(RATE_LIMIT_STORES[RATE_LIMIT_BACKEND]())
+    return _limiter
+
+
+def rate_limited_exception(e: RateLimited) -> HTTPException:
+    scope = "You are" if e.scope == "user" else "The service is"
+    reason = "sending too many messages" if e.limit == "rate" else "processing too many messages at once"
+    return HTTPException(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        detail=f"{scope} {reason}, please try again shortly",
+        headers={"Retry-After": str(max(1, math.ceil(e.retry_after)))},
+    )
+
+
+def max_messages_per_request() -> Optional[int]:
+    """
+    Most messages a single request may send under the rate limits (None when unlimited), a larger
+    request could never get its tokens.
+    """
+    return get_rate_limiter().max_cost() if RATE_LIMIT_ENABLED else None
+
+
+async def acquire_message_limits(current_user: dict, messages: int = 1) -> RateLimitLease:
+    """
+    Applies the limits of the message endpoints, raising a 429 when one is reached. Requests sending
+    several `messages` (batches) take a token per message. The returned lease must be released when
+    the request is done, endpoints whose response outlives the endpoint function (streams) release
+    it once the response is sent.
+    """
+    if not RATE_LIMIT_ENABLED:
+        return RateLimitLease()
+    try:
+        return await get_rate_limiter().acquire(current_user["username"], messages)
+    except RateLimited as e:
+        raise rate_limited_exception(e)
+
+
+async def limit_messages(current_user: dict = Depends(get_current_user)):
+    """
+    Dependency applying the limits of the message endpoints, the in-flight slots are held until
+    the endpoint function returns.
+    """
+    lease = await acquire_message_limits(current_user)
+    try:
+        yield
+    finally:
+        await lease.release()
@@ -0,0 +1,152 @@
+"""
+Response helpers of the read endpoints.
+
+Opt-in fast JSON path (FAST_JSON_RESPONSES): stored documents are shaped like their response models
+and serialized directly with orjson, skipping the model validation and the jsonable_encoder pass of
+FastAPI. Requires the optional `orjson` package.
+
+Conditional GET: the endpoints compute a weak ETag (and Last-Modified when they can) before reading
+their heavy data, and answer 304 when the client copy is still current. HTTP dates have a one second
+granularity, so Last-Modified is rounded up to the next second and only sent once that second is
+over: a later write then always falls in a later second, and If-Modified-Since cannot hide it.
+"""
+import hashlib
+import json
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Any, Dict, Iterable, Optional, Type, Union, get_args, get_origin
+from fastapi import Request, Response
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel
+from app.config import FAST_JSON_RESPONSES
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if FAST_JSON_RESPONSES and orjson is None:
+    raise RuntimeError("FAST_JSON_RESPONSES=true requires the 'orjson' package")
+
+json_loads = orjson.loads if orjson is not None else json.loads
+
+
+def optional_type(annotation: Any) -> Any:
+    # Optional[Model] is shaped like Model
+    if get_origin(annotation) is Union:
+        args = [arg for arg in get_args(annotation) if arg is not type(None)]
+        if len(args) == 1:
+            return args[0]
+    return annotation
+
+
+def shape(model: Type[BaseModel], data: Dict) -> Dict:
+    """
+    Projects a stored document on the fields of a response model, with the model defaults for the
+    missing fields, without validating it. Nested models are shaped recursively.
+    """
+    shaped = {}
+    for name, field in model.model_fields.items():
+        value = data.get(name)
+        annotation = optional_type(field.annotation)
+        if value is None and name not in data:
+            value = None if field.is_required() else field.get_default(call_default_factory=True)
+        elif isinstance(value, dict) and isinstance(annotation, type) and issubclass(annotation, BaseModel):
+            value = shape(annotation, value)
+        shaped[name] = value
+    return shaped
+
+
+def json_response(content: Any, headers: Optional[Dict[str, str]] = None) -> ORJSONResponse:
+    return ORJSONResponse(content, headers=headers)
+
+
+def parse_generated_chart(generated_chart: Any) -> Optional[Any]:
+    """
+    Decodes a chart stored as a JSON string (older messages, or charts Firestore cannot store as a map),
+    None if it is not valid JSON. Charts stored as maps are returned as is.
+    """
+    if not isinstance(generated_chart, str):
+        return generated_chart
+    try:
+        return json_loads(generated_chart)
+    except ValueError:
+        return None
+
+
+def firestore_compatible(value: Any) -> bool:
+    """
+    Whether a decoded JSON value can be stored as a Firestore map, which has no arrays of arrays.
+    """
+    if isinstance(value, dict):
+        return all(firestore_compatible(item) for item in value.values())
+    if isinstance(value, list):
+        return all(not isinstance(item, list) and firestore_compatible(item) for item in value)
+    return True
+
+
+def storable_generated_chart(generated_chart: Any) -> Any:
+    """
+    Chart to store in a message, parsed once at write time when Firestore can hold it as a map
+    so reads don't decode it again, kept as a JSON string otherwise.
+    """
+    if not isinstance(generated_chart, str):
+        return generated_chart
+    parsed = parse_generated_chart(generated_chart)
+    return parsed if isinstance(parsed, dict) and firestore_compatible(parsed) else generated_chart
+
+
+def weak_etag(*parts: Any) -> str:
+    digest = hashlib.sha1("|".join(map(str, parts)).encode()).hexdigest()[:32]
+    return f'W/"{digest}"'
+
+
+def parse_timestamp(timestamp: Optional[str]) -> Optional[datetime]:
+    """
+    Parses the stored timestamps (`str(datetime.utcnow())`) as UTC datetimes.
+    """
+    try:
+        return datetime.fromisoformat(timestamp).replace(tzinfo=timezone.utc)
+    except (TypeError, ValueError):
+        return None
+
+
+def latest_timestamp(timestamps: Iterable[Optional[str]]) -> Optional[datetime]:
+    return max(filter(None, map(parse_timestamp, timestamps)), default=None)
+
+
+def last_modified_second(last_modified: datetime) -> datetime:
+    # The HTTP date covering the whole second of the modification
+    if last_modified.microsecond:
+        return last_modified.replace(microsecond=0) + timedelta(seconds=1)
+    return last_modified
+
+
+def validator_headers(etag: str, last_modified: Optional[datetime] = None) -> Dict[str, str]:
+    # Clients must revalidate every time, but may keep the body for a 304
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if last_modified is not None and last_modified_second(last_modified) <= datetime.now(timezone.utc):
+        headers["Last-Modified"] = format_datetime(last_modified_second(last_modified), usegmt=True)
+    return headers
+
+
+def is_not_modified(request: Request, etag: str, last_modified: Optional[datetime] = None) -> bool:
+    """
+    Evaluates If-None-Match (weak comparison) and, only when it is absent, If-Modified-Since.
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        candidates = {candidate.strip().removeprefix("W/") for candidate in if_none_match.split(",")}
+        return "*" in candidates or etag.removeprefix("W/") in candidates
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and last_modified is not None:
+        try:
+            return last_modified_second(last_modified) <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def not_modified_response(headers: Dict[str, str]) -> Response:
+    return Response(status_code=304, headers=headers)
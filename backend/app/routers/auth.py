@@ -1,21 +1,39 @@
 from datetime import timedelta
 from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordRequestForm
-from app.dependencies import client, USERS_COLLECTION, get_password_hash, verify_password, create_access_token
+from google.api_core.exceptions import AlreadyExists
+from app.dependencies import get_user_document_reference, invalidate_user, create_access_token
 from app.models.token import Token
-from app.config import ACCESS_TOKEN_EXPIRE_MINUTES
+from app.config import ACCESS_TOKEN_EXPIRE_MINUTES, PASSWORD_HASH_RETRY_AFTER_SECONDS
+from app.passwords import PasswordHasherBusy, get_password_hasher
 from app.models.user import User, UserResponse
 
 router = APIRouter()
 
+
+def password_hasher_busy() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Too many authentication requests are being processed, please try again shortly",
+        headers={"Retry-After": str(PASSWORD_HASH_RETRY_AFTER_SECONDS)},
+    )
+
+
 @router.post("/token/", response_model=Token)
 async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
-    # Query Firestore for the user document based on the username
-    user_query = client.collection(USERS_COLLECTION).where("username", "==", form_data.username).limit(1).stream()
-    user_docs = list(user_query)
+    # Read the user document, keyed by the normalized username
+    user_ref = get_user_document_reference(form_data.username)
+    user_doc = await user_ref.get() if user_ref is not None else None
 
-    # Check if user exists and verify password
-    if not user_docs or not verify_password(form_data.password, user_docs[0].to_dict().get("hashed_password")):
+    # Check if user exists and verify password, bcrypt runs on the password hashing pool
+    try:
+        valid = user_doc is not None and user_doc.exists and await get_password_hasher().verify(
+            form_data.password, user_doc.get("hashed_password")
+        )
+    except PasswordHasherBusy:
+        raise password_hasher_busy()
+
+    if not valid:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
@@ -23,7 +41,7 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
         )
     
     # Extract user data
-    user = user_docs[0].to_dict()
+    user = user_doc.to_dict()
     access_token = create_access_token(
         data={"sub": user["username"]},
         expires_delta=timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
@@ -32,25 +50,32 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
 
 
 @router.post("/register/", response_model=UserResponse)
-def register(user: User):
-    # Check if user already exists in Firestore
-    user_query = client.collection(USERS_COLLECTION).where("username", "==", user.username).limit(1).stream()
-    existing_user = list(user_query)
-    
-    if existing_user:  # If the user already exists
+async def register(user: User):
+    user_ref = get_user_document_reference(user.username)
+    if user_ref is None:
+        raise HTTPException(status_code=400, detail="Invalid username")
+
+    # Cheap check first, so taken usernames don't cost a password hash (the create below is what enforces uniqueness)
+    if (await user_ref.get(["username"])).exists:
         raise HTTPException(status_code=400, detail="Username already registered")
     
     # Hash the password
-    hashed_password = get_password_hash(user.password)
+    try:
+        hashed_password = await get_password_hasher().hash(user.password)
+    except PasswordHasherBusy:
+        raise password_hasher_busy()
     
     # Prepare user data
     user_data = {
         "username": user.username,
-        "hashed_password": hashed_password,
-        "conversations": []
+        "hashed_password": hashed_password
     }
     
-    # Insert new user into Firestore
-    client.collection(USERS_COLLECTION).add(user_data)
+    # Insert new user into Firestore, failing if a concurrent registration took the username
+    try:
+        await user_ref.create(user_data)
+    except AlreadyExists:
+        raise HTTPException(status_code=400, detail="Username already registered")
+    invalidate_user(user.username)
     
     return UserResponse(username=user.username)
@@ -1,17 +1,29 @@
 from datetime import datetime
-import json
 import uuid
-from fastapi import APIRouter, Depends, HTTPException
-from app.models.conversation import Conversation, ConversationCreate
-from app.models.message import FeedbackUpdate, MessageCreate, Message
-from app.utils import call_llm_invoke, call_speech_to_text, store_message
+from datetime import timezone
+from typing import List, Literal, Optional
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
 from google.cloud import firestore
-from app.dependencies import client, get_current_user, USERS_COLLECTION
+from app.config import CONVERSATIONS_PAGE_MAX_LIMIT, FAST_JSON_RESPONSES, SEARCH_INDEX_ENABLED, SEARCH_PAGE_MAX_LIMIT
+from app.export import csv_lines, export_columns, iter_export_records, ndjson_lines
+from app.payloads import PAYLOAD_BLOB_FIELD_PATHS, delete_blobs, payload_blob_ids
+from app.responses import is_not_modified, json_response, not_modified_response, shape, validator_headers, weak_etag
+from app.search import conversation_index_queries, search_messages
+from app.stats import conversation_counter_query
+from app.storage import get_blob_store
+from app.models.conversation import Conversation, ConversationCreate, ConversationSummary
+from app.models.message import FeedbackUpdate, MessageCreate, Message
+from app.utils import (
+    CONVERSATIONS_VERSION_FIELD, conversation_list_version, delete_collection, get_conversation_reference,
+    get_user_reference
+)
+from app.dependencies import client, get_current_user, CONVERSATIONS_COLLECTION, MESSAGES_COLLECTION
 
 router = APIRouter()
 
 @router.post("/")
-def create_conversation(
+async def create_conversation(
     conversation_create: ConversationCreate,
     current_user: dict = Depends(get_current_user)
 ):
@@ -25,72 +37,190 @@ def create_conversation(
         last_interaction=str(datetime.utcnow()),
         messages=[]
     )
-    conversation_dict = conversation_data.dict()
-
-    # Query Firestore for the user document based on username
-    user_ref = client.collection(USERS_COLLECTION).where("username", "==", current_user["username"]).limit(1).stream()
-    user_docs = list(user_ref)
-
-    if not user_docs:
-        raise HTTPException(status_code=404, detail="User not found")
-
-    # Reference to the user's document
-    user_doc = user_docs[0].reference
+    conversation_dict = conversation_data.dict(exclude={"messages"})
 
-    # Update the user's conversations by appending the new conversation
-    user_doc.update({
-        "conversations": firestore.ArrayUnion([conversation_dict])
-    })
+    # Messages are stored as separate documents, so the conversation document only holds its metadata
+    user_ref = await get_user_reference(current_user)
+    batch = client.batch()
+    batch.set(get_conversation_reference(user_ref, conv_id), conversation_dict)
+    batch.update(user_ref, conversation_list_version())
+    await batch.commit()
 
     return {"conversation_id": conversation_dict["conversation_id"], "title": conversation_dict["title"]}
 
 @router.get("/")
-def get_conversations(
+async def get_conversations(
+    request: Request,
+    http_response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=CONVERSATIONS_PAGE_MAX_LIMIT),
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
-    # Query Firestore to retrieve the user document based on username
-    user_query = client.collection(USERS_COLLECTION).where("username", "==", current_user["username"]).limit(1).stream()
-    user_docs = list(user_query)
+    """
+    Lists the conversation summaries of the user, most recently active first. Pass the
+    returned `next_cursor` as `cursor` to get the following page.
+
+    The ETag is derived from the version of the conversation list kept on the user document, so
+    an unchanged list is answered without querying the summaries. There is no Last-Modified,
+    deleting a conversation does not move any timestamp.
+    """
+    user_ref = await get_user_reference(current_user)
+
+    # Read fresh (the user entry is cached), the version is bumped by every write that changes a summary
+    user_doc = await user_ref.get(field_paths=[CONVERSATIONS_VERSION_FIELD])
+    version = (user_doc.to_dict() or {}).get(CONVERSATIONS_VERSION_FIELD, 0)
+    validators = validator_headers(weak_etag(user_ref.id, version, limit, cursor))
+    if is_not_modified(request, validators["ETag"]):
+        return not_modified_response(validators)
+
+    query = (
+        user_ref.collection(CONVERSATIONS_COLLECTION)
+        .select(list(ConversationSummary.model_fields))
+        .order_by("last_interaction", direction=firestore.Query.DESCENDING)
+    )
 
-    # Handle case where the user is not found
-    if not user_docs:
-        raise HTTPException(status_code=404, detail="User not found")
+    if cursor:
+        cursor_doc = await get_conversation_reference(user_ref, cursor).get(field_paths=["last_interaction"])
+        if not cursor_doc.exists:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        query = query.start_after(cursor_doc)
+    if limit is not None:
+        query = query.limit(limit + 1)  # One extra conversation tells whether there is a next page
+
+    # Only the stored summary fields are read, never the messages
+    conversations = [conversation_doc.to_dict() async for conversation_doc in query.stream()]
+
+    next_cursor = None
+    if limit is not None and len(conversations) > limit:
+        conversations = conversations[:limit]
+        next_cursor = conversations[-1]["conversation_id"]
+
+    if FAST_JSON_RESPONSES:
+        return json_response({
+            "conversations": [shape(ConversationSummary, conversation) for conversation in conversations],
+            "next_cursor": next_cursor,
+        }, headers=validators)
+
+    http_response.headers.update(validators)
+    return {
+        "conversations": [ConversationSummary(**conversation) for conversation in conversations],
+        "next_cursor": next_cursor,
+    }
+
+
+@router.get("/search/")
+async def search_conversations(
+    q: str = Query(..., min_length=1, max_length=500),
+    limit: int = Query(20, ge=1, le=SEARCH_PAGE_MAX_LIMIT),
+    cursor: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Searches the questions, transcriptions and answers of the user's messages, best matches first.
+    Each result holds the conversation and message IDs, the matched terms and a snippet of the
+    matching field. Pass the returned `next_cursor` as `cursor` to get the following page.
+    """
+    if not SEARCH_INDEX_ENABLED:
+        raise HTTPException(status_code=404, detail="Search is not enabled")
+    try:
+        offset = int(cursor) if cursor else 0
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if offset < 0:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    user_ref = await get_user_reference(current_user)
+    results, has_more = await search_messages(user_ref, q, limit, offset)
+
+    return {"results": results, "next_cursor": str(offset + limit) if has_more else None}
+
+
+def export_timestamp(value: Optional[datetime]) -> Optional[str]:
+    # Stored timestamps are naive UTC, `str(datetime.utcnow())`
+    if value is not None and value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return str(value) if value is not None else None
+
+
+@router.get("/export/")
+async def export_messages(
+    request: Request,
+    format: Literal["ndjson", "csv"] = "ndjson",
+    conversation_id: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    feedback: Optional[Literal["LIKE", "DISLIKE", "NONE"]] = None,
+    include: List[Literal["generated_chart", "data", "tools"]] = Query([]),
+    audio: Literal["reference", "exclude"] = "reference",
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Streams the messages of a conversation, or of every conversation of the user, as NDJSON (one
+    message per line) or CSV, in chronological order within each conversation. Messages can be
+    filtered by timestamp (`since` inclusive, `until` exclusive) and by feedback (`NONE` for the
+    messages without feedback). The large fields are exported on request (`include`), the tables
+    and charts stored out of line as the URL of their endpoint. Audio is referenced by its download
+    URL unless `audio=exclude`.
+    """
+    user_ref = await get_user_reference(current_user)
+    if conversation_id and not (await get_conversation_reference(user_ref, conversation_id).get(field_paths=[])).exists:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+
+    def message_url(route_name: str):
+        url_template = request.app.url_path_for(route_name, conversation_id="{c}", message_id="{m}")
+
+        def url(conversation_id: str, message_id: str) -> str:
+            return url_template.replace("{c}", conversation_id).replace("{m}", message_id)
+        return url
 
-    # Retrieve conversations from the user document
-    user_entity = user_docs[0].to_dict()
-    conversations = user_entity.get("conversations", [])
+    audio_url = message_url("download_message_audio") if audio == "reference" else None
+    payload_urls = {"data": message_url("get_message_data"), "generated_chart": message_url("get_message_chart")}
+    pages = iter_export_records(
+        user_ref, conversation_id, include, audio_url, payload_urls,
+        since=export_timestamp(since), until=export_timestamp(until), feedback=feedback,
+    )
+    if format == "csv":
+        body, media_type = csv_lines(pages, export_columns(include, audio_url)), "text/csv; charset=utf-8"
+    else:
+        body, media_type = ndjson_lines(pages), "application/x-ndjson"
 
-    return {"conversations": conversations}
+    filename = f"{conversation_id or 'conversations'}.{format}"
+    return StreamingResponse(body, media_type=media_type, headers={"Content-Disposition": f'attachment; filename="{filename}"'})
 
 
 @router.delete("/{conversation_id}/")
-def delete_conversation(
+async def delete_conversation(
     conversation_id: str,
     current_user: dict = Depends(get_current_user)
 ):
-    # Query Firestore to retrieve the user document based on username
-    user_query = client.collection(USERS_COLLECTION).where("username", "==", current_user["username"]).limit(1).stream()
-    user_docs = list(user_query)
-
-    # Check if the user was found
-    if not user_docs:
-        raise HTTPException(status_code=404, detail="User not found")
-
-    # Get the user document reference and data
-    user_doc = user_docs[0].reference
-    user_data = user_docs[0].to_dict()
-
-    # Retrieve the current conversations and filter out the one to delete
-    original_conversations = user_data.get("conversations", [])
-    updated_conversations = [conv for conv in original_conversations if conv["conversation_id"] != conversation_id]
+    user_ref = await get_user_reference(current_user)
+    conversation_ref = get_conversation_reference(user_ref, conversation_id)
 
-    # Check if a conversation was actually removed
-    if len(updated_conversations) == len(original_conversations):
+    # Check if the conversation exists
+    if not (await conversation_ref.get()).exists:
         raise HTTPException(status_code=404, detail="Conversation not found")
 
-    # Update Firestore with the modified conversations list
-    user_doc.update({
-        "conversations": updated_conversations
-    })
+    # Audio, large tables and charts are stored out of line, remove their blobs first
+    messages_ref = conversation_ref.collection(MESSAGES_COLLECTION)
+    async for message_doc in messages_ref.select(["question.audio_id"] + PAYLOAD_BLOB_FIELD_PATHS).stream():
+        message = message_doc.to_dict() or {}
+        audio_id = message.get("question", {}).get("audio_id")
+        if audio_id:
+            await get_blob_store().delete(audio_id)
+        await delete_blobs(payload_blob_ids(message))
+
+    # Firestore does not delete subcollections with their parent, so remove the messages first
+    await delete_collection(conversation_ref.collection(MESSAGES_COLLECTION))
+    batch = client.batch()
+    batch.delete(conversation_ref)
+    batch.update(user_ref, conversation_list_version())
+    await batch.commit()
+
+    # The search index entries of the conversation are stored under the user document
+    for index_query in conversation_index_queries(user_ref, conversation_id):
+        await delete_collection(index_query)
+
+    # The counters of the conversation go with it, the user and global counters keep its messages
+    await delete_collection(conversation_counter_query(user_ref, conversation_id))
 
     return {"message": "Conversation deleted successfully"}
@@ -1,17 +1,68 @@
-from datetime import datetime
-import json
+import asyncio
+from datetime import datetime, timedelta, timezone
 import uuid
-from fastapi import APIRouter, Depends, HTTPException
+import anyio
+from typing import AsyncIterator, Optional, Tuple, get_args
+from fastapi import APIRouter, Depends, File, HTTPException, Query, Request, Response, UploadFile, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
+from pydantic import ValidationError
 from app.models.conversation import Conversation, ConversationCreate
-from app.models.message import FeedbackUpdate, MessageCreate, Message
-from app.utils import call_llm_invoke, call_speech_to_text, store_message
-from google.cloud import firestore
-from app.dependencies import client, get_current_user, USERS_COLLECTION
+from app.models.message import BatchMessage, BatchMessageCreate, FeedbackUpdate, FeedbackValue, MessageCreate, Message
+from app.config import (
+    AUDIO_MAX_UPLOAD_BYTES,
+    BLOB_CHUNK_SIZE,
+    DATA_PAGE_MAX_LIMIT,
+    DATA_TABLE_CHUNK_ROWS,
+    FAST_JSON_RESPONSES,
+    JOB_RETRY_AFTER_SECONDS,
+    MESSAGES_BATCH_MAX_SIZE,
+    MESSAGES_PAGE_MAX_LIMIT,
+)
+from app.compression import accepted_encodings
+from app.genai_client import format_sse
+from app.jobs import JobQueueFull, get_job_backend
+from app.payloads import CHART_REF_FIELD, delete_blobs, externalize_payloads, read_chart, read_table_rows, table_columns
+from app.rate_limit import RateLimitLease, acquire_message_limits, limit_messages, max_messages_per_request
+from app.responses import (
+    is_not_modified,
+    json_response,
+    latest_timestamp,
+    not_modified_response,
+    parse_generated_chart,
+    shape,
+    storable_generated_chart,
+    validator_headers,
+    weak_etag,
+)
+from app.stats import FEEDBACK_COUNTER_FIELD_PATHS, feedback_counter_writes
+from app.storage import BlobTooLarge, get_blob_store, new_blob_id
+from app.utils import (
+    LLM_ERR_MSG,
+    STT_ERR_MSG,
+    call_llm_invoke,
+    call_speech_to_text,
+    get_conversation_reference,
+    get_message_page,
+    get_message_reference,
+    get_user_reference,
+    store_base64_audio,
+    store_message,
+    store_messages,
+    stream_llm_invoke,
+    update_message_fields,
+    update_message_transactionally,
+)
+from app.dependencies import authenticate_token, get_current_user
 
 router = APIRouter()
 
+# Close codes of the conversation WebSocket, mirroring the HTTP statuses
+WS_CLOSE_UNAUTHORIZED = 4401
+WS_CLOSE_NOT_FOUND = 4404
 
-@router.post("/{conversation_id}/text/")
+
+@router.post("/{conversation_id}/text/", dependencies=[Depends(limit_messages)])
 async def create_text_message(
     conversation_id: str,
     message_create: MessageCreate,
@@ -41,7 +92,7 @@ async def create_text_message(
     }
 
     # Store the new message in Firestore
-    store_message(conversation_id, current_user, message_data)
+    await store_message(conversation_id, current_user, message_data)
 
     # Now call LLM invoke, passing message_id
     # response = await call_llm_invoke(
@@ -59,24 +110,225 @@ async def create_text_message(
 
 
 
-@router.post("/{conversation_id}/audio/")
+@router.post("/messages/batch/")
+async def create_messages_batch(
+    batch_create: BatchMessageCreate,
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Stores many TEXT messages, across one or more conversations, in batched writes (history imports,
+    offline replays). Each item is a `MessageCreate` with its `conversation_id` and, optionally, the
+    `answer`, `timestamp` and `feedback` of imported messages. Items are validated and stored
+    independently: the response holds one result per item, in the order of the request. Each
+    message takes a token of the message rate limits, so a batch holds at most the burst of the limits.
+    """
+    max_messages = min(MESSAGES_BATCH_MAX_SIZE, max_messages_per_request() or MESSAGES_BATCH_MAX_SIZE)
+    if len(batch_create.messages) > max_messages:
+        raise HTTPException(status_code=413, detail=f"At most {max_messages} messages per batch")
+
+    lease = await acquire_message_limits(current_user, len(batch_create.messages))
+    try:
+        return await store_messages_batch(batch_create, current_user)
+    finally:
+        await lease.release()
+
+
+async def store_messages_batch(batch_create: BatchMessageCreate, current_user: dict) -> dict:
+
+    results = [None] * len(batch_create.messages)
+    messages_by_conversation = {}
+    blob_ids_by_index = {}
+    now = datetime.utcnow()
+
+    for index, item in enumerate(batch_create.messages):
+        try:
+            message = BatchMessage.model_validate(item)
+        except ValidationError as e:
+            results[index] = {"index": index, "status": 422, "detail": e.errors(include_url=False, include_context=False)}
+            continue
+        if message.question.type != "TEXT":
+            results[index] = {"index": index, "status": 422, "detail": "Only TEXT messages can be ingested in batch"}
+            continue
+        if not message.conversation_id or "/" in message.conversation_id:
+            results[index] = {"index": index, "status": 404, "detail": "Conversation not found",
+                              "conversation_id": message.conversation_id}
+            continue
+
+        # Only the client-provided fields are kept, the server-managed ones (audio blobs, payload
+        # references, status) are never taken from the request
+        answer = {
+            "type": "TEXT",
+            "content": "",  # To be filled by GenAI module
+            "generated_chart": None
+        }
+        if message.answer:
+            payload_fields, blob_ids_by_index[index] = await externalize_payloads(
+                {"answer.generated_chart": storable_generated_chart(message.answer.generated_chart)}
+            )
+            answer = {
+                "type": message.answer.type,
+                "content": message.answer.content,
+                "generated_chart": payload_fields["answer.generated_chart"],
+                **({"chart_ref": payload_fields[CHART_REF_FIELD]} if payload_fields.get(CHART_REF_FIELD) else {})
+            }
+
+        timestamp = message.timestamp
+        if timestamp is not None and timestamp.tzinfo is not None:
+            timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+        message_data = {
+            "message_id": str(uuid.uuid4()),
+            "question": message.question.model_dump(include={"type", "content", "transcription"}, exclude_none=True),
+            "answer": answer,
+            "data": None,
+            "tools": None,
+            "feedback": message.feedback,
+            # Stored like the timestamps of the other messages, distinct ones keep the order of the batch
+            "timestamp": str(timestamp or now + timedelta(microseconds=index))
+        }
+        messages_by_conversation.setdefault(message.conversation_id, []).append((index, message_data))
+
+    # One existence check per conversation, then the messages of each conversation in batched writes
+    user_ref = await get_user_reference(current_user)
+    conversation_refs = {
+        conversation_id: get_conversation_reference(user_ref, conversation_id)
+        for conversation_id in messages_by_conversation
+    }
+    conversation_docs = await asyncio.gather(*(
+        conversation_ref.get(field_paths=["conversation_id"]) for conversation_ref in conversation_refs.values()
+    ))
+
+    for (conversation_id, items), conversation_doc in zip(messages_by_conversation.items(), conversation_docs):
+        if not conversation_doc.exists:
+            errors = ["Conversation not found"] * len(items)
+        else:
+            errors = await store_messages(user_ref, conversation_id, [message_data for _, message_data in items])
+
+        for (index, message_data), error in zip(items, errors):
+            if error is None:
+                results[index] = {"index": index, "status": 201, "message_id": message_data["message_id"],
+                                  "conversation_id": conversation_id}
+            else:
+                await delete_blobs(blob_ids_by_index.get(index, []))
+                results[index] = {"index": index, "status": 404 if error == "Conversation not found" else 500,
+                                  "detail": error, "conversation_id": conversation_id}
+
+    return {
+        "stored": sum(result["status"] == 201 for result in results),
+        "failed": sum(result["status"] != 201 for result in results),
+        "results": results
+    }
+
+
+@router.post("/{conversation_id}/audio/", dependencies=[Depends(limit_messages)])
 async def create_audio_message(
     conversation_id: str,
     message_create: MessageCreate,
+    http_response: Response,
+    background: bool = False,
     current_user: dict = Depends(get_current_user)
 ):
     # Generate a unique message ID
     message_id = str(uuid.uuid4())
 
-    # Set up the initial question data for an audio message
+    # The audio is stored out of line, the message only references it
+    audio_id = await store_base64_audio(message_create.question.content)
     question_data = {
         "type": message_create.question.type,
-        "content": message_create.question.content  # Use actual audio content
+        "content": "",
+        "audio_id": audio_id,
+        "audio_content_type": "application/octet-stream"
     }
 
+    return await answer_audio_question(conversation_id, message_id, question_data, http_response, background, current_user)
+
+
+@router.post("/{conversation_id}/audio/upload/", dependencies=[Depends(limit_messages)])
+async def upload_audio_message(
+    conversation_id: str,
+    http_response: Response,
+    file: UploadFile = File(...),
+    background: bool = False,
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Multipart variant of the audio endpoint, the uploaded audio is streamed chunk by chunk
+    to the blob store instead of being sent as base64 JSON.
+    """
+    # Generate a unique message ID
+    message_id = str(uuid.uuid4())
+
+    async def upload_chunks():
+        while chunk := await file.read(BLOB_CHUNK_SIZE):
+            yield chunk
+
+    audio_id = new_blob_id()
+    try:
+        await get_blob_store().write(audio_id, upload_chunks(), max_size=AUDIO_MAX_UPLOAD_BYTES)
+    except BlobTooLarge:
+        raise HTTPException(status_code=413, detail=f"Audio exceeds {AUDIO_MAX_UPLOAD_BYTES} bytes")
+
+    question_data = {
+        "type": "AUDIO",
+        "content": "",
+        "audio_id": audio_id,
+        "audio_content_type": file.content_type or "application/octet-stream"
+    }
+
+    return await answer_audio_question(conversation_id, message_id, question_data, http_response, background, current_user)
+
+
+async def answer_audio_question(
+    conversation_id: str,
+    message_id: str,
+    question_data: dict,
+    http_response: Response,
+    background: bool,
+    current_user: dict
+):
+    """
+    Transcribes and answers a stored audio question, shared by the JSON and multipart audio endpoints.
+    """
+    # In background mode the message is stored right away and processed by the job workers,
+    # the client polls the status endpoint for the transcription and answer
+    if background:
+        question_data["transcription"] = None
+        message_data = {
+            "message_id": message_id,
+            "question": question_data,
+            "answer": {
+                "type": "TEXT",
+                "content": "",
+                "generated_chart": None
+            },
+            "data": None,
+            "tools": None,
+            "feedback": None,
+            "status": "PENDING",
+            "timestamp": str(datetime.utcnow())
+        }
+        await store_message(conversation_id, current_user, message_data)
+
+        try:
+            get_job_backend().submit("process_audio_message", {
+                "conversation_id": conversation_id,
+                "username": current_user["username"],
+                "message_id": message_id
+            })
+        except JobQueueFull:
+            user_ref = await get_user_reference(current_user)
+            await get_message_reference(get_conversation_reference(user_ref, conversation_id), message_id).delete()
+            await get_blob_store().delete(question_data["audio_id"])
+            raise HTTPException(
+                status_code=503,
+                detail="Too many audio messages are being processed, please try again shortly",
+                headers={"Retry-After": str(JOB_RETRY_AFTER_SECONDS)},
+            )
+
+        http_response.status_code = 202
+        return {"message_id": message_id, "status": "PENDING"}
+
     # Attempt speech-to-text conversion on the audio content
-    stt_result = await call_speech_to_text(question_data['content'])
-    STT_ERR_MSG="Hmm, I had a little trouble understanding that. Could you give it another try? 😊"
+    stt_result = await call_speech_to_text(audio_id=question_data["audio_id"])
     if stt_result:
         question_data["transcription"] = stt_result
     else:
@@ -100,7 +352,7 @@ async def create_audio_message(
     # Store the initial message in Firestore
     response=None
     if stt_result:
-        store_message(conversation_id, current_user, message_data)
+        await store_message(conversation_id, current_user, message_data)
         # Call the LLM invoke function with transcription
         response = await call_llm_invoke(
             message=question_data["transcription"],
@@ -111,7 +363,7 @@ async def create_audio_message(
         )
     else:
         message_data["answer"]["content"] = STT_ERR_MSG
-        store_message(conversation_id, current_user, message_data)
+        await store_message(conversation_id, current_user, message_data)
 
     # Return the message ID to the client, indicating that message has been created
     if response:
@@ -120,103 +372,528 @@ async def create_audio_message(
         return {"message_id": message_id, "genai_response": STT_ERR_MSG}
 
 
-@router.get("/{conversation_id}/messages/")
-def get_conversation_messages(
+@router.post("/{conversation_id}/stream/")
+async def create_streamed_message(
     conversation_id: str,
+    message_create: MessageCreate,
     current_user: dict = Depends(get_current_user)
 ):
-    # Query Firestore to retrieve the user document
-    user_query = client.collection(USERS_COLLECTION).where("username", "==", current_user["username"]).limit(1).stream()
-    user_docs = list(user_query)
-
-    # Handle case where the user is not found
-    if not user_docs:
-        raise HTTPException(status_code=404, detail="User not found")
-
-    # Retrieve the user entity and find the specific conversation
-    user_entity = user_docs[0].to_dict()
-    conversation = next(
-        (conv for conv in user_entity.get("conversations", []) if conv["conversation_id"] == conversation_id),
-        None
+    """
+    Creates a TEXT or AUDIO message and streams the LLM answer back as Server-Sent Events:
+    `transcription` (AUDIO only), `token` for each content delta, `error`, and a final `end`
+    event with the complete answer. The answer is persisted once, when the stream ends.
+    """
+    # The in-flight slots are held until the stream is over, not only until the endpoint returns
+    lease = await acquire_message_limits(current_user)
+    try:
+        return await start_message_stream(conversation_id, message_create, current_user, lease)
+    except BaseException:
+        await lease.release()
+        raise
+
+
+async def start_message_stream(
+    conversation_id: str,
+    message_create: MessageCreate,
+    current_user: dict,
+    lease: RateLimitLease
+) -> StreamingResponse:
+    """
+    Stores the message and returns the stream of its answer, which releases the lease once sent.
+    """
+    message_data, llm_input = await create_streamed_message_data(conversation_id, message_create, current_user)
+
+    async def event_stream():
+        async for event, data in answer_events(conversation_id, current_user, message_data, llm_input):
+            yield format_sse(event, data)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        background=BackgroundTask(lease.release),  # Also run when the client disconnects
     )
 
+
+async def create_streamed_message_data(
+    conversation_id: str,
+    message_create: MessageCreate,
+    current_user: dict
+) -> Tuple[dict, str]:
+    """
+    Stores a message whose answer is streamed, returns the message and the input of the LLM
+    (the question, or the transcription of an audio question, empty when it failed).
+    """
+    # Generate a unique message ID
+    message_id = str(uuid.uuid4())
+
+    question_data = {
+        "type": message_create.question.type,
+        "content": message_create.question.content
+    }
+
+    # Audio questions are transcribed before the stream starts, the LLM is asked the transcription
+    llm_input = question_data["content"]
+    if question_data["type"] == "AUDIO":
+        audio_id = await store_base64_audio(question_data["content"])
+        question_data.update({"content": "", "audio_id": audio_id, "audio_content_type": "application/octet-stream"})
+        llm_input = await call_speech_to_text(audio_id=audio_id)
+        question_data["transcription"] = llm_input
+
+    # Prepare initial message data, the answer is filled once the stream completes
+    message_data = {
+        "message_id": message_id,
+        "question": question_data,
+        "answer": {
+            "type": "TEXT",
+            "content": "" if llm_input else STT_ERR_MSG,
+            "generated_chart": None
+        },
+        "data": None,
+        "tools": None,
+        "feedback": None,
+        "timestamp": str(datetime.utcnow())
+    }
+
+    # Store the message before streaming, so a 404 is still returned as a regular HTTP error
+    await store_message(conversation_id, current_user, message_data)
+    return message_data, llm_input
+
+
+async def answer_events(
+    conversation_id: str,
+    current_user: dict,
+    message_data: dict,
+    llm_input: str
+) -> AsyncIterator[Tuple[str, dict]]:
+    """
+    Streams the answer of a stored message as (event, data) pairs: `transcription` (AUDIO only),
+    `token` for each content delta, `error`, and a final `end` with the complete answer. The answer
+    is persisted once, when the stream ends or is closed early.
+    """
+    message_id = message_data["message_id"]
+    answer = message_data["answer"]
+    extra_fields = {}
+
+    if message_data["question"]["type"] == "AUDIO":
+        yield "transcription", {"message_id": message_id, "transcription": llm_input}
+    if not llm_input:
+        yield "end", {"message_id": message_id, "answer": answer}
+        return
+
+    try:
+        async for chunk in stream_llm_invoke(
+            message=llm_input,
+            session_id=conversation_id,
+            user_name=current_user["username"],
+            create_time=message_data["timestamp"],
+            message_id=message_id
+        ):
+            content = chunk.pop("content", None)
+            if isinstance(content, str):
+                answer["content"] += content
+                yield "token", {"content": content}
+            elif content is not None:
+                answer["content"] = content  # Structured answers are sent whole
+
+            if "generated_chart" in chunk:
+                answer["generated_chart"] = chunk["generated_chart"]
+            extra_fields.update({key: chunk[key] for key in ("data", "tools") if key in chunk})
+
+    except Exception as e:
+        print(f"An error occurred while streaming the LLM answer: {e}")
+        answer["content"] = LLM_ERR_MSG
+        yield "error", {"detail": LLM_ERR_MSG}
+
+    finally:
+        # Persist the final (or partial, if the client went away) answer in a single write,
+        # shielded so a client disconnect does not cancel it
+        with anyio.CancelScope(shield=True):
+            try:
+                await update_message_fields(conversation_id, current_user, message_id, {
+                    "answer.content": answer["content"],
+                    "answer.generated_chart": storable_generated_chart(answer["generated_chart"]),
+                    **extra_fields
+                })
+            except HTTPException:
+                print(f"Message {message_id} was deleted before its answer could be stored")
+
+    yield "end", {"message_id": message_id, "answer": answer}
+
+
+@router.get("/{conversation_id}/messages/")
+async def get_conversation_messages(
+    conversation_id: str,
+    request: Request,
+    http_response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=MESSAGES_PAGE_MAX_LIMIT),
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    since: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Returns the messages of a conversation in chronological order. Without parameters every
+    message is returned; `limit` returns the newest page, `before`/`after` (message IDs taken
+    from `cursors`) page to older/newer messages and `since` (a timestamp) returns only the
+    messages created after it, for incremental refreshes.
+
+    Supports conditional requests: the ETag and Last-Modified validators are derived from the
+    conversation version, so an unchanged conversation is answered 304 without reading its messages.
+    """
+    if sum(param is not None for param in (before, after, since)) > 1:
+        raise HTTPException(status_code=400, detail="Only one of before, after and since can be used")
+
+    user_ref = await get_user_reference(current_user)
+    conversation_ref = get_conversation_reference(user_ref, conversation_id)
+    conversation_doc = await conversation_ref.get(field_paths=["last_interaction", "updated_at"])
+
     # Handle case where the conversation is not found
-    if not conversation:
+    if not conversation_doc.exists:
         raise HTTPException(status_code=404, detail="Conversation not found")
+    conversation = conversation_doc.to_dict()
 
-    # Sort the messages by timestamp
-    messages = sorted(conversation.get("messages", []), key=lambda msg: msg["timestamp"])
+    # The version changes with every stored or updated message, the page parameters select the representation
+    version = conversation.get("updated_at") or conversation.get("last_interaction")
+    etag = weak_etag(conversation_id, version, limit, before, after, since)
+    last_modified = latest_timestamp([conversation.get("last_interaction"), version])
+    validators = validator_headers(etag, last_modified)
+    if is_not_modified(request, etag, last_modified):
+        return not_modified_response(validators)
 
-    # Process each message to ensure `generated_chart` is properly decoded from JSON string if necessary
+    # Retrieve the requested messages, ordered by the timestamp index
+    messages, has_more = await get_message_page(conversation_ref, limit=limit, before=before, after=after, since=since)
+
+    # Charts are stored parsed, only the ones still stored as JSON strings are decoded
     for msg in messages:
-        answer = msg.get("answer", {})
-        generated_chart = answer.get("generated_chart")
-        if isinstance(generated_chart, str):
-            try:
-                # Decode `generated_chart` from JSON string to dictionary
-                answer["generated_chart"] = json.loads(generated_chart)
-            except json.JSONDecodeError:
-                answer["generated_chart"] = None  # Set to None if decoding fails
+        answer = msg.get("answer") or {}
+        if isinstance(answer.get("generated_chart"), str):
+            answer["generated_chart"] = parse_generated_chart(answer["generated_chart"])
+
+    response = {
+        "conversation_id": conversation_id,
+        "last_interaction": conversation.get("last_interaction"),
+        "has_more": has_more,
+        "cursors": {
+            "before": messages[0]["message_id"] if messages else before,
+            "after": messages[-1]["message_id"] if messages else after
+        }
+    }
+
+    if FAST_JSON_RESPONSES:
+        # Stored documents serialized as they are, shaped like `Message` but not validated
+        return json_response({**response, "messages": [shape(Message, msg) for msg in messages]}, headers=validators)
 
     # Use Pydantic models to format and validate the messages
-    formatted_messages = [Message(**msg) for msg in messages]
-    last_interaction = conversation.get("last_interaction")
+    http_response.headers.update(validators)
+    return {**response, "messages": [Message(**msg) for msg in messages]}
+
+
+
+@router.get("/{conversation_id}/messages/{message_id}/status/")
+async def get_message_status(
+    conversation_id: str,
+    message_id: str,
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Polling endpoint of the messages processed in the background, messages created
+    synchronously have no status field and are reported as DONE.
+    """
+    user_ref = await get_user_reference(current_user)
+    message_ref = get_message_reference(get_conversation_reference(user_ref, conversation_id), message_id)
+    message_doc = await message_ref.get(field_paths=["status", "error", "question.transcription", "answer"])
+
+    if not message_doc.exists:
+        raise HTTPException(status_code=404, detail="Message not found")
+    message = message_doc.to_dict()
 
     return {
-        "conversation_id": conversation_id,
-        "last_interaction": last_interaction,
-        "messages": formatted_messages  # Return the messages in the new structure
+        "message_id": message_id,
+        "status": message.get("status", "DONE"),
+        "transcription": message.get("question", {}).get("transcription"),
+        "answer": message.get("answer"),
+        "error": message.get("error")
     }
 
 
+@router.get("/{conversation_id}/messages/{message_id}/audio/")
+async def download_message_audio(
+    conversation_id: str,
+    message_id: str,
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Streams the audio of an AUDIO message from the blob store.
+    """
+    user_ref = await get_user_reference(current_user)
+    message_ref = get_message_reference(get_conversation_reference(user_ref, conversation_id), message_id)
+    message_doc = await message_ref.get(field_paths=["question.audio_id", "question.audio_content_type"])
+
+    question = (message_doc.to_dict() or {}).get("question", {}) if message_doc.exists else {}
+    if not question.get("audio_id"):
+        raise HTTPException(status_code=404, detail="Audio not found")
+
+    return StreamingResponse(
+        get_blob_store().read(question["audio_id"]),
+        media_type=question.get("audio_content_type") or "application/octet-stream"
+    )
+
+
+@router.get("/{conversation_id}/messages/{message_id}/data/")
+async def get_message_data(
+    conversation_id: str,
+    message_id: str,
+    request: Request,
+    http_response: Response,
+    offset: int = Query(0, ge=0),
+    limit: int = Query(DATA_TABLE_CHUNK_ROWS, ge=1, le=DATA_PAGE_MAX_LIMIT),
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Rows of the result table of a message, `limit` rows from `offset`, with the offset of the next
+    page. Tables stored out of line are immutable and only the chunks holding the requested rows are read.
+    """
+    user_ref = await get_user_reference(current_user)
+    message_ref = get_message_reference(get_conversation_reference(user_ref, conversation_id), message_id)
+    message_doc = await message_ref.get(field_paths=["data", "data_ref"])
+    message = message_doc.to_dict() if message_doc.exists else {}
+
+    data_ref = message.get("data_ref")
+    validators = {}
+    if data_ref:
+        validators = validator_headers(weak_etag(data_ref["chunks"][0] if data_ref["chunks"] else message_id, offset, limit))
+        if is_not_modified(request, validators["ETag"]):
+            return not_modified_response(validators)
+        columns, total_rows = data_ref["columns"], data_ref["rows"]
+        rows = await read_table_rows(data_ref, offset, limit)
+    elif isinstance(message.get("data"), list):
+        columns, total_rows = table_columns(message["data"]), len(message["data"])
+        rows = message["data"][offset:offset + limit]
+    else:
+        raise HTTPException(status_code=404, detail="Data not found")
+
+    http_response.headers.update(validators)
+    return {
+        "message_id": message_id,
+        "columns": columns,
+        "total_rows": total_rows,
+        "offset": offset,
+        "rows": rows,
+        "next_offset": offset + limit if offset + limit < total_rows else None,
+    }
+
+
+@router.get("/{conversation_id}/messages/{message_id}/chart/")
+async def get_message_chart(
+    conversation_id: str,
+    message_id: str,
+    request: Request,
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    The generated chart of a message. Charts stored out of line are sent as stored, gzip encoded,
+    to the clients accepting it.
+    """
+    user_ref = await get_user_reference(current_user)
+    message_ref = get_message_reference(get_conversation_reference(user_ref, conversation_id), message_id)
+    message_doc = await message_ref.get(field_paths=["answer.generated_chart", "answer.chart_ref"])
+    answer = (message_doc.to_dict() or {}).get("answer") or {} if message_doc.exists else {}
+
+    chart_ref = answer.get("chart_ref")
+    if chart_ref:
+        validators = {**validator_headers(weak_etag(chart_ref["blob_id"])), "Vary": "Accept-Encoding"}
+        if is_not_modified(request, validators["ETag"]):
+            return not_modified_response(validators)
+        if "gzip" in accepted_encodings(request.headers.get("accept-encoding", "")):
+            return Response(await read_chart(chart_ref, decompress=False), media_type="application/json",
+                            headers={**validators, "Content-Encoding": "gzip"})
+        return Response(await read_chart(chart_ref), media_type="application/json", headers=validators)
+
+    chart = parse_generated_chart(answer.get("generated_chart"))
+    if chart is None:
+        raise HTTPException(status_code=404, detail="Chart not found")
+    return chart
+
 
 @router.put("/{conversation_id}/messages/{message_id}/feedback/")
-def update_feedback(
+async def update_feedback(
     conversation_id: str,
     message_id: str,
     feedback_update: FeedbackUpdate,
     current_user: dict = Depends(get_current_user)
 ):
+    await set_message_feedback(conversation_id, current_user, message_id, feedback_update.feedback)
+
+    return {"message": "Feedback updated successfully"}
+
+
+async def set_message_feedback(conversation_id: str, current_user: dict, message_id: str, feedback: str):
     # Validate feedback value
-    feedback = feedback_update.feedback
-    if feedback not in ["LIKE", "DISLIKE"]:
+    if feedback not in get_args(FeedbackValue):
         raise HTTPException(status_code=400, detail="Invalid feedback value")
 
-    # Query Firestore to retrieve the user document based on username
-    user_query = client.collection(USERS_COLLECTION).where("username", "==", current_user["username"]).limit(1).stream()
-    user_docs = list(user_query)
-
-    if not user_docs:
-        raise HTTPException(status_code=404, detail="User not found")
-
-    user_doc = user_docs[0].reference  # Reference to the user's document
-    user_data = user_docs[0].to_dict()
-
-    conversation_found = False
-    message_found = False
-
-    # Locate the conversation and message within user's conversations
-    conversations = user_data.get("conversations", [])
-    for conversation in conversations:
-        if conversation["conversation_id"] == conversation_id:
-            conversation_found = True
-            for message in conversation["messages"]:
-                if message["message_id"] == message_id:
-                    message["feedback"] = feedback  # Update feedback
-                    message_found = True
-                    break
-            break
-
-    # Error handling if conversation or message not found
-    if not conversation_found:
-        raise HTTPException(status_code=404, detail="Conversation not found")
-    if not message_found:
-        raise HTTPException(status_code=404, detail="Message not found")
+    # Update only the feedback field of the message document, in a transaction so
+    # concurrent clicks are serialized and an unchanged feedback is not rewritten.
+    # The feedback counters are moved in the same transaction
+    user_ref = await get_user_reference(current_user)
+    await update_message_transactionally(
+        conversation_id,
+        current_user,
+        message_id,
+        lambda message: None if message.get("feedback") == feedback else {"feedback": feedback},
+        field_paths=FEEDBACK_COUNTER_FIELD_PATHS,
+        counters=lambda message, fields: feedback_counter_writes(user_ref, conversation_id, message, fields["feedback"])
+    )
 
-    # Save the updated conversations list back to Firestore
-    user_doc.update({
-        "conversations": conversations
-    })
 
-    return {"message": "Feedback updated successfully"}
+class ConversationChannel:
+    """
+    Events side of a conversation WebSocket. Questions are answered concurrently, each in its own
+    task, their events are sent one at a time.
+    """
+
+    def __init__(self, websocket: WebSocket, conversation_id: str, current_user: dict, expires_at: Optional[datetime]):
+        self.websocket = websocket
+        self.conversation_id = conversation_id
+        self.current_user = current_user
+        self.expires_at = expires_at
+        self.send_lock = asyncio.Lock()
+        self.tasks = set()
 
+    async def send(self, event: str, **data):
+        async with self.send_lock:
+            try:
+                await self.websocket.send_json({"type": event, **data})
+            except (WebSocketDisconnect, RuntimeError):
+                pass  # The client went away, the receive loop ends the channel
+
+    async def send_error(self, e: HTTPException, **data):
+        retry_after = (e.headers or {}).get("Retry-After")
+        await self.send("error", status=e.status_code, detail=e.detail,
+                        **({"retry_after": int(retry_after)} if retry_after else {}), **data)
+
+    def expired(self) -> bool:
+        return self.expires_at is not None and datetime.utcnow() >= self.expires_at
+
+    def start(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def close(self):
+        # Answers in progress are closed, their partial answer is persisted as on a dropped stream
+        for task in list(self.tasks):
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    async def answer_question(self, payload: dict):
+        request_id = payload.get("request_id")
+        try:
+            message_create = MessageCreate.model_validate(payload)
+        except ValidationError as e:
+            await self.send("error", status=422, detail=e.errors(include_url=False, include_context=False),
+                            request_id=request_id)
+            return
+
+        try:
+            lease = await acquire_message_limits(self.current_user)
+        except HTTPException as e:
+            await self.send_error(e, request_id=request_id)
+            return
+
+        try:
+            message_data, llm_input = await create_streamed_message_data(
+                self.conversation_id, message_create, self.current_user
+            )
+            message_id = message_data["message_id"]
+            await self.send("message_created", request_id=request_id, message_id=message_id,
+                            timestamp=message_data["timestamp"])
+            events = answer_events(self.conversation_id, self.current_user, message_data, llm_input)
+            try:
+                async for event, data in events:
+                    await self.send(event, request_id=request_id, **{"message_id": message_id, **data})
+            finally:
+                await events.aclose()
+        except HTTPException as e:
+            await self.send_error(e, request_id=request_id)
+        finally:
+            with anyio.CancelScope(shield=True):
+                await lease.release()
+
+    async def update_feedback(self, payload: dict):
+        request_id = payload.get("request_id")
+        message_id, feedback = payload.get("message_id"), payload.get("feedback")
+        if not isinstance(message_id, str) or not message_id or "/" in message_id:
+            await self.send("error", status=404, detail="Message not found", request_id=request_id)
+            return
+
+        try:
+            await set_message_feedback(self.conversation_id, self.current_user, message_id, feedback)
+        except HTTPException as e:
+            await self.send_error(e, request_id=request_id, message_id=message_id)
+            return
+        await self.send("feedback", request_id=request_id, message_id=message_id, feedback=feedback)
+
+
+@router.websocket("/{conversation_id}/ws")
+async def conversation_websocket(websocket: WebSocket, conversation_id: str, token: Optional[str] = None):
+    """
+    Two-way channel of a conversation, replacing the polling of the status endpoint and the
+    authentication of every request. The client authenticates once, with its access token as the
+    `token` query parameter (browsers cannot set headers on WebSockets) or a Bearer Authorization
+    header, then sends JSON messages:
+    - `{"type": "question", "question": {...}, "request_id": ...}`: a TEXT or AUDIO question, answered
+      as on the stream endpoint; several questions may be in progress at once;
+    - `{"type": "feedback", "message_id": ..., "feedback": "LIKE" | "DISLIKE", "request_id": ...}`;
+    - `{"type": "ping"}`.
+    Events are JSON objects with a `type`: `ready` once authenticated, then for each question
+    `message_created`, `transcription` (AUDIO only), `token`, `end` (the complete answer) or `error`,
+    tagged with the `request_id` of the question and the `message_id`; `feedback` once a feedback is
+    stored; `pong`. The connection is closed with code 4401 when the token is invalid or expires and
+    4404 when the conversation does not exist.
+    """
+    await websocket.accept()
+
+    authorization = websocket.headers.get("authorization", "")
+    if not token and authorization.lower().startswith("bearer "):
+        token = authorization[len("bearer "):]
+    try:
+        current_user, expires_at = await authenticate_token(token or "")
+    except HTTPException:
+        await websocket.close(code=WS_CLOSE_UNAUTHORIZED, reason="Could not validate credentials")
+        return
+
+    user_ref = await get_user_reference(current_user)
+    conversation_doc = await get_conversation_reference(user_ref, conversation_id).get(field_paths=["conversation_id"])
+    if not conversation_doc.exists:
+        await websocket.close(code=WS_CLOSE_NOT_FOUND, reason="Conversation not found")
+        return
+
+    channel = ConversationChannel(websocket, conversation_id, current_user, expires_at)
+    await channel.send("ready", conversation_id=conversation_id)
+    try:
+        while True:
+            try:
+                payload = await websocket.receive_json()
+            except (ValueError, KeyError):  # Not JSON, or a binary frame
+                await channel.send("error", status=400, detail="Messages must be JSON objects")
+                continue
+            if channel.expired():
+                await websocket.close(code=WS_CLOSE_UNAUTHORIZED, reason="Token expired")
+                break
+
+            message_type = payload.get("type") if isinstance(payload, dict) else None
+            if message_type == "question":
+                channel.start(channel.answer_question(payload))
+            elif message_type == "feedback":
+                channel.start(channel.update_feedback(payload))
+            elif message_type == "ping":
+                await channel.send("pong")
+            else:
+                await channel.send("error", status=400, detail="Unknown message type",
+                                   request_id=payload.get("request_id") if isinstance(payload, dict) else None)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        await channel.close()
@@ -0,0 +1,41 @@
+from typing import Optional
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from app.config import STATS_ADMIN_USERS, STATS_ENABLED, STATS_MAX_DAYS
+from app.dependencies import get_current_user, normalize_username
+from app.stats import global_stats, user_stats
+from app.utils import get_user_reference
+
+router = APIRouter()
+
+
+def check_stats_enabled():
+    if not STATS_ENABLED:
+        raise HTTPException(status_code=404, detail="Stats are not enabled")
+
+
+@router.get("/", dependencies=[Depends(check_stats_enabled)])
+async def get_user_stats(
+    days: int = Query(7, ge=1, le=STATS_MAX_DAYS),
+    conversation_id: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Message and feedback counts of the user: totals, one entry per day over the last `days` days
+    (UTC, oldest first) and, with `conversation_id`, the counts of that conversation. Served from
+    the maintained counters, the cost does not depend on the number of messages.
+    """
+    user_ref = await get_user_reference(current_user)
+    return await user_stats(user_ref, days, conversation_id)
+
+
+@router.get("/global/", dependencies=[Depends(check_stats_enabled)])
+async def get_global_stats(
+    days: int = Query(7, ge=1, le=STATS_MAX_DAYS),
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Message and feedback counts of all the users, per day and per tool, for the users listed in STATS_ADMIN_USERS.
+    """
+    if normalize_username(current_user["username"]) not in {normalize_username(username) for username in STATS_ADMIN_USERS}:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not allowed to read the global stats")
+    return await global_stats(days)
@@ -0,0 +1,298 @@
+"""
+Full-text search over the messages of a user: question content, transcriptions and answers.
+
+The inverted index lives under each user document and is maintained incrementally by the message
+writes of `app.utils`, in the same batch as the message whenever possible:
+- `search_postings/{term}~{conversation_id}~{message_id}`: one posting per distinct term of a message,
+  holding the weight of the term in the message (BM25 term frequency) and the message timestamp;
+- `search_messages/{conversation_id}~{message_id}`: the term frequencies of each indexed field of a
+  message, so updating one field re-weights the message and drops its stale postings with one read.
+
+A query reads at most SEARCH_CANDIDATES_PER_TERM postings per term, the best weighted first (composite
+index on `term` ascending, `weight` descending), so its cost depends on the query and not on the
+size of the history. Terms are weighted by their rarity among those candidates.
+"""
+import asyncio
+import math
+import re
+import unicodedata
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+from google.cloud import firestore
+from app.config import (
+    SEARCH_CANDIDATES_PER_TERM,
+    SEARCH_INDEX_ENABLED,
+    SEARCH_MAX_QUERY_TERMS,
+    SEARCH_MAX_TERMS_PER_MESSAGE,
+    SEARCH_SNIPPET_LENGTH,
+)
+from app.dependencies import CONVERSATIONS_COLLECTION, MESSAGES_COLLECTION
+
+SEARCH_POSTINGS_COLLECTION = "search_postings"  # Subcollection of each user document
+SEARCH_MESSAGES_COLLECTION = "search_messages"  # Subcollection of each user document
+
+# Indexed fields: their path in the message document and their weight in the ranking
+INDEXED_FIELDS = {
+    "question": ("question.content", 1.5),
+    "transcription": ("question.transcription", 1.5),
+    "answer": ("answer.content", 1.0),
+}
+
+# Message fields read to index a message or to build its snippet
+MESSAGE_TEXT_FIELDS = ["question.type", "question.content", "question.transcription", "answer.content"]
+
+# BM25 term frequency saturation and length normalization, against a typical message length in terms
+BM25_K1 = 1.2
+BM25_B = 0.75
+AVERAGE_MESSAGE_TERMS = 60
+
+TERM_PATTERN = re.compile(r"[^\W_]+")  # Letters and digits, snake_case is split in words
+MAX_TERM_LENGTH = 40
+STOPWORDS = frozenset("""
+    a an and are as at be but by can do does for from had has have how i if in is it its me my no not
+    of on or so than that the their them then there these they this to was we were what when where
+    which who why will with you your
+""".split())
+
+# Writes to apply to a batch: ("set" | "delete", reference, data)
+IndexWrites = List[Tuple[str, object, Optional[Dict]]]
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Terms of a text: Unicode composition and case are not significant, stopwords are dropped.
+    """
+    return [
+        term for term in TERM_PATTERN.findall(unicodedata.normalize("NFKC", text).casefold())
+        if term not in STOPWORDS and 1 < len(term) <= MAX_TERM_LENGTH
+    ]
+
+
+def field_texts(message: Dict) -> Dict[str, str]:
+    """
+    Indexed texts of a message document, audio questions are indexed by their transcription.
+    """
+    question = message.get("question") or {}
+    answer = message.get("answer") or {}
+    texts = {
+        "question": question.get("content") if question.get("type") != "AUDIO" else None,
+        "transcription": question.get("transcription"),
+        "answer": answer.get("content"),
+    }
+    return {field: text for field, text in texts.items() if isinstance(text, str)}
+
+
+def updated_field_texts(fields: Dict) -> Dict[str, str]:
+    """
+    Indexed texts changed by a field update (dotted paths, as passed to `update_message_fields`).
+    """
+    return {field: fields[path] for field, (path, _) in INDEXED_FIELDS.items() if isinstance(fields.get(path), str)}
+
+
+def field_frequencies(texts: Dict[str, str]) -> Dict[str, Dict[str, int]]:
+    return {field: dict(Counter(tokenize(text))) for field, text in texts.items()}
+
+
+def term_weights(frequencies: Dict[str, Dict[str, int]]) -> Dict[str, float]:
+    """
+    BM25 weight of each term of a message, from the frequencies of its fields. Only the
+    SEARCH_MAX_TERMS_PER_MESSAGE best weighted terms are kept, bounding the writes of a message.
+    """
+    weighted = Counter()
+    for field, terms in frequencies.items():
+        for term, count in terms.items():
+            weighted[term] += INDEXED_FIELDS[field][1] * count
+
+    length = sum(sum(terms.values()) for terms in frequencies.values())
+    norm = BM25_K1 * (1 - BM25_B + BM25_B * length / AVERAGE_MESSAGE_TERMS)
+    return {
+        term: round(frequency * (BM25_K1 + 1) / (frequency + norm), 6)
+        for term, frequency in weighted.most_common(SEARCH_MAX_TERMS_PER_MESSAGE)
+    }
+
+
+def index_key(conversation_id: str, message_id: str) -> str:
+    return f"{conversation_id}~{message_id}"
+
+
+def postings_collection(user_ref):
+    return user_ref.collection(SEARCH_POSTINGS_COLLECTION)
+
+
+def indexed_messages_collection(user_ref):
+    return user_ref.collection(SEARCH_MESSAGES_COLLECTION)
+
+
+def index_writes(
+    user_ref,
+    conversation_id: str,
+    message_id: str,
+    timestamp: str,
+    frequencies: Dict[str, Dict[str, int]],
+    previous_terms: Tuple[str, ...] = ()
+) -> IndexWrites:
+    """
+    Writes indexing a message with the given field frequencies, replacing the postings of its
+    `previous_terms`.
+    """
+    key = index_key(conversation_id, message_id)
+    weights = term_weights(frequencies)
+    postings = postings_collection(user_ref)
+
+    writes: IndexWrites = [
+        ("set", postings.document(f"{term}~{key}"), {
+            "term": term,
+            "conversation_id": conversation_id,
+            "message_id": message_id,
+            "weight": weight,
+            "timestamp": timestamp,
+        })
+        for term, weight in weights.items()
+    ]
+    writes += [("delete", postings.document(f"{term}~{key}"), None) for term in previous_terms if term not in weights]
+    writes.append(("set", indexed_messages_collection(user_ref).document(key), {
+        "conversation_id": conversation_id,
+        "message_id": message_id,
+        "timestamp": timestamp,
+        "fields": frequencies,
+        "terms": list(weights),
+    }))
+    return writes
+
+
+def new_message_index_writes(user_ref, conversation_id: str, message_data: Dict) -> IndexWrites:
+    """
+    Writes indexing a message being created, nothing has to be read.
+    """
+    if not SEARCH_INDEX_ENABLED:
+        return []
+    return index_writes(
+        user_ref, conversation_id, message_data["message_id"], message_data["timestamp"],
+        field_frequencies(field_texts(message_data))
+    )
+
+
+async def updated_message_index_writes(
+    user_ref, conversation_id: str, message_id: str, fields: Dict, transaction=None
+) -> IndexWrites:
+    """
+    Writes re-indexing a message whose fields are being updated, none when no indexed field changes.
+    The other fields are taken from the index entry of the message, or from the message itself when
+    it was never indexed (stored before the index, or while it was disabled). Within a `transaction`
+    these are read in it, so the writes are retried with the update when a concurrent one conflicts.
+    """
+    texts = updated_field_texts(fields)
+    if not SEARCH_INDEX_ENABLED or not texts:
+        return []
+
+    key = index_key(conversation_id, message_id)
+    indexed_doc = await indexed_messages_collection(user_ref).document(key).get(transaction=transaction)
+    if indexed_doc.exists:
+        indexed = indexed_doc.to_dict()
+        frequencies = {**indexed.get("fields", {}), **field_frequencies(texts)}
+        return index_writes(
+            user_ref, conversation_id, message_id, indexed["timestamp"], frequencies, tuple(indexed.get("terms", ()))
+        )
+
+    message_ref = (
+        user_ref.collection(CONVERSATIONS_COLLECTION).document(conversation_id)
+        .collection(MESSAGES_COLLECTION).document(message_id)
+    )
+    message_doc = await message_ref.get(field_paths=MESSAGE_TEXT_FIELDS + ["timestamp"], transaction=transaction)
+    if not message_doc.exists:
+        return []  # The update fails as well
+    message = message_doc.to_dict()
+    frequencies = {**field_frequencies(field_texts(message)), **field_frequencies(texts)}
+    return index_writes(user_ref, conversation_id, message_id, message.get("timestamp", ""), frequencies)
+
+
+def add_index_writes(batch, writes: IndexWrites):
+    for operation, reference, data in writes:
+        if operation == "set":
+            batch.set(reference, data)
+        else:
+            batch.delete(reference)
+
+
+def conversation_index_queries(user_ref, conversation_id: str) -> list:
+    """
+    Queries of the index entries of a conversation, to delete along with it.
+    """
+    return [
+        collection.where(filter=firestore.FieldFilter("conversation_id", "==", conversation_id))
+        for collection in (postings_collection(user_ref), indexed_messages_collection(user_ref))
+    ]
+
+
+def snippet(text: str, terms: List[str], length: int = SEARCH_SNIPPET_LENGTH) -> str:
+    """
+    Excerpt of a text around the first occurrence of one of the terms.
+    """
+    folded = unicodedata.normalize("NFKC", text).casefold()
+    positions = [match.start() for match in TERM_PATTERN.finditer(folded) if match.group() in terms]
+    start = max(0, positions[0] - length // 4) if positions else 0
+    excerpt = text[start:start + length].strip()
+    return ("…" if start > 0 else "") + excerpt + ("…" if start + length < len(text) else "")
+
+
+async def search_messages(user_ref, query: str, limit: int, offset: int = 0) -> Tuple[List[Dict], bool]:
+    """
+    Ranked search of the messages of a user, returns a page of results and whether more follow.
+    Messages are scored by the sum, over the query terms they contain, of the term weight in the
+    message times the rarity of the term; ties go to the most recent message.
+    """
+    terms = list(dict.fromkeys(tokenize(query)))[:SEARCH_MAX_QUERY_TERMS]
+    if not terms:
+        return [], False
+
+    postings = postings_collection(user_ref)
+    candidates = await asyncio.gather(*(
+        postings.where(filter=firestore.FieldFilter("term", "==", term))
+        .order_by("weight", direction=firestore.Query.DESCENDING)
+        .limit(SEARCH_CANDIDATES_PER_TERM)
+        .select(["conversation_id", "message_id", "weight", "timestamp"])
+        .get()
+        for term in terms
+    ))
+
+    scores: Dict[Tuple[str, str], float] = {}
+    matches: Dict[Tuple[str, str], Dict] = {}
+    for term, posting_docs in zip(terms, candidates):
+        rarity = math.log(1 + SEARCH_CANDIDATES_PER_TERM / len(posting_docs)) if posting_docs else 0
+        for posting_doc in posting_docs:
+            posting = posting_doc.to_dict()
+            key = (posting["conversation_id"], posting["message_id"])
+            scores[key] = scores.get(key, 0) + rarity * posting["weight"]
+            match = matches.setdefault(key, {"timestamp": posting["timestamp"], "terms": []})
+            match["terms"].append(term)
+
+    ranked = sorted(scores, key=lambda key: (scores[key], matches[key]["timestamp"]), reverse=True)
+    page = ranked[offset:offset + limit]
+
+    # Only the messages of the page are read, for their snippets
+    message_docs = await asyncio.gather(*(
+        user_ref.collection(CONVERSATIONS_COLLECTION).document(conversation_id)
+        .collection(MESSAGES_COLLECTION).document(message_id)
+        .get(field_paths=MESSAGE_TEXT_FIELDS)
+        for conversation_id, message_id in page
+    ))
+
+    results = []
+    for (conversation_id, message_id), message_doc in zip(page, message_docs):
+        if not message_doc.exists:
+            continue  # Deleted since it was indexed
+        key = (conversation_id, message_id)
+        texts = field_texts(message_doc.to_dict())
+        matched_terms = matches[key]["terms"]
+        field = next((field for field, text in texts.items() if set(tokenize(text)) & set(matched_terms)), None)
+        results.append({
+            "conversation_id": conversation_id,
+            "message_id": message_id,
+            "timestamp": matches[key]["timestamp"],
+            "score": round(scores[key], 4),
+            "matched_terms": matched_terms,
+            "field": field,
+            "snippet": snippet(texts[field], matched_terms) if field else "",
+        })
+
+    return results, len(ranked) > offset + limit
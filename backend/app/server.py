@@ -0,0 +1,39 @@
+"""
+Production entry point, serving the API with WEB_CONCURRENCY uvicorn worker processes (default:
+one per core). Each worker runs the application lifespan: it creates its Firestore, GenAI and
+password hashing resources and warms them up on startup, and on shutdown (SIGTERM) stops accepting
+connections, lets the in-flight requests and queued jobs finish for up to SHUTDOWN_TIMEOUT_SECONDS,
+then closes them.
+
+Tokens signed by one worker must be accepted by the others, so several workers require SECRET_KEY
+to be set, and each worker checks on startup that its key is the one of the server.
+
+Usage (from the backend directory):
+    python -m app.server
+"""
+import os
+import sys
+import uvicorn
+from app.config import SECRET_KEY_GENERATED, SERVER_HOST, SERVER_PORT, SHUTDOWN_TIMEOUT_SECONDS, WEB_CONCURRENCY
+from app.dependencies import signing_key_fingerprint
+
+
+def main():
+    if WEB_CONCURRENCY > 1 and SECRET_KEY_GENERATED:
+        sys.exit(f"SECRET_KEY must be set to run {WEB_CONCURRENCY} workers, each would otherwise sign tokens with its own random key")
+
+    # Inherited by the worker processes, which compare it with their own key (app.dependencies.check_signing_key)
+    os.environ["SECRET_KEY_FINGERPRINT"] = signing_key_fingerprint()
+
+    uvicorn.run(
+        "app.main:app",
+        host=SERVER_HOST,
+        port=SERVER_PORT,
+        workers=WEB_CONCURRENCY,
+        lifespan="on",
+        timeout_graceful_shutdown=SHUTDOWN_TIMEOUT_SECONDS,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+"""
+Feedback and usage counters, maintained by the message and feedback writes of the API in the same
+batch (or transaction) as the write they count, so reports never scan the messages.
+
+Counters are sharded: each counter is spread over STATS_COUNTER_SHARDS documents, a write increments
+one of them at random and a read sums them all. Busy counters (the global ones, a day's total) then
+take concurrent increments without contending on a single document. Shard documents are named
+`{counter}~{shard}` and hold the `counter` ID, its `scope` and `key` and the counted fields:
+- under each user document (`users/{user}/stats`): the user's `total`, each `day` and each
+  `conversation` (deleted with the conversation);
+- in the top level `stats` collection: the global `total`, each `day` and each `tool` (the tools
+  used by the answers, taken from the keys of their `tools` field).
+
+Days are the UTC day of the message (not of the feedback), so a feedback change moves the counts
+of the day the message was sent.
+"""
+import asyncio
+import random
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+from google.cloud import firestore
+from app.config import STATS_COUNTER_SHARDS, STATS_ENABLED
+from app.dependencies import client
+
+STATS_COLLECTION = "stats"  # Top level collection of the global counters, and subcollection of each user document
+
+COUNTED_FIELDS = ("messages", "audio_messages", "likes", "dislikes")
+TOOL_COUNTED_FIELDS = ("messages", "likes", "dislikes")
+FEEDBACK_FIELDS = {"LIKE": "likes", "DISLIKE": "dislikes"}
+
+# Message fields read to update the counters of a feedback change
+FEEDBACK_COUNTER_FIELD_PATHS = ["feedback", "timestamp", "tools"]
+
+# Counter updates to apply to a batch or transaction: (shard reference, data merged into the shard)
+CounterWrites = List[Tuple[object, Dict]]
+
+
+def message_day(timestamp: Optional[str]) -> Optional[str]:
+    # Stored timestamps are `str(datetime.utcnow())`, their first 10 characters are the day
+    day = (timestamp or "")[:10]
+    return day if len(day) == 10 else None
+
+
+def tool_names(tools) -> List[str]:
+    return [name for name in tools if isinstance(name, str) and name] if isinstance(tools, dict) else []
+
+
+def user_stats_collection(user_ref):
+    return user_ref.collection(STATS_COLLECTION)
+
+
+def global_stats_collection():
+    return client.collection(STATS_COLLECTION)
+
+
+def counter_id(scope: str, key: Optional[str] = None) -> str:
+    return f"{scope}~{key}" if key else scope
+
+
+def counter_writes(collection, scope: str, key: Optional[str], increments: Dict[str, int]) -> CounterWrites:
+    """
+    Increments of one counter, applied to one of its shards picked at random.
+    """
+    increments = {field: value for field, value in increments.items() if value}
+    if not increments:
+        return []
+    counter = counter_id(scope, key)
+    shard_ref = collection.document(f"{counter}~{random.randrange(STATS_COUNTER_SHARDS)}")
+    return [(shard_ref, {
+        "counter": counter,
+        "scope": scope,
+        "key": key,
+        **{field: firestore.Increment(value) for field, value in increments.items()},
+    })]
+
+
+def usage_counter_writes(user_ref, conversation_id: str, day: Optional[str], increments: Dict[str, int]) -> CounterWrites:
+    """
+    Increments of the counters of a user, one of their conversations and a day, and of the global counters.
+    """
+    if not STATS_ENABLED:
+        return []
+    user_stats, global_stats = user_stats_collection(user_ref), global_stats_collection()
+    writes = counter_writes(user_stats, "total", None, increments)
+    writes += counter_writes(user_stats, "conversation", conversation_id, increments)
+    writes += counter_writes(global_stats, "total", None, increments)
+    if day:
+        writes += counter_writes(user_stats, "day", day, increments)
+        writes += counter_writes(global_stats, "day", day, increments)
+    return writes
+
+
+def message_increments(message_data: Dict) -> Counter:
+    question = message_data.get("question") or {}
+    increments = Counter(messages=1, audio_messages=int(question.get("type") == "AUDIO"))
+    if message_data.get("feedback") in FEEDBACK_FIELDS:
+        increments[FEEDBACK_FIELDS[message_data["feedback"]]] += 1
+    return increments
+
+
+def new_messages_counter_writes(user_ref, conversation_id: str, messages: List[Dict]) -> CounterWrites:
+    """
+    Counter writes of messages being created in a conversation, one write per counter whatever the
+    number of messages (see `new_messages_counter_write_count`).
+    """
+    if not STATS_ENABLED or not messages:
+        return []
+    totals, days = Counter(), {}
+    for message_data in messages:
+        increments = message_increments(message_data)
+        totals.update(increments)
+        day = message_day(message_data.get("timestamp"))
+        if day:
+            days.setdefault(day, Counter()).update(increments)
+
+    user_stats, global_stats = user_stats_collection(user_ref), global_stats_collection()
+    writes = usage_counter_writes(user_ref, conversation_id, None, totals)
+    for day, increments in days.items():
+        writes += counter_writes(user_stats, "day", day, increments)
+        writes += counter_writes(global_stats, "day", day, increments)
+    return writes
+
+
+def new_messages_counter_write_count(days: int) -> int:
+    """
+    Most writes of `new_messages_counter_writes` for messages spanning the given number of days.
+    """
+    return 3 + 2 * days if STATS_ENABLED else 0
+
+
+def feedback_counter_writes(user_ref, conversation_id: str, message: Dict, feedback: Optional[str]) -> CounterWrites:
+    """
+    Counter writes of a feedback change, `message` holds the FEEDBACK_COUNTER_FIELD_PATHS of the
+    message before the change.
+    """
+    previous = message.get("feedback")
+    if not STATS_ENABLED or previous == feedback:
+        return []
+    increments = Counter()
+    if previous in FEEDBACK_FIELDS:
+        increments[FEEDBACK_FIELDS[previous]] -= 1
+    if feedback in FEEDBACK_FIELDS:
+        increments[FEEDBACK_FIELDS[feedback]] += 1
+
+    writes = usage_counter_writes(user_ref, conversation_id, message_day(message.get("timestamp")), increments)
+    for tool in tool_names(message.get("tools")):
+        writes += counter_writes(global_stats_collection(), "tool", tool, increments)
+    return writes
+
+
+def tools_counter_writes(fields: Dict) -> CounterWrites:
+    """
+    Counter writes of the tools of an answer being stored (`fields` as passed to `update_message_fields`).
+    """
+    if not STATS_ENABLED:
+        return []
+    return [
+        write for tool in tool_names(fields.get("tools"))
+        for write in counter_writes(global_stats_collection(), "tool", tool, {"messages": 1})
+    ]
+
+
+def add_counter_writes(batch, writes: CounterWrites):
+    for reference, data in writes:
+        batch.set(reference, data, merge=True)
+
+
+def conversation_counter_query(user_ref, conversation_id: str):
+    """
+    Query of the counter shards of a conversation, to delete along with it.
+    """
+    return user_stats_collection(user_ref).where(
+        filter=firestore.FieldFilter("counter", "==", counter_id("conversation", conversation_id))
+    )
+
+
+def sum_shards(shard_docs: Iterable, fields: Tuple[str, ...] = COUNTED_FIELDS) -> Dict[str, Dict[str, int]]:
+    """
+    Sums the shards of the counters they belong to, keyed by counter key (or scope, for the totals).
+    """
+    counters: Dict[str, Dict[str, int]] = {}
+    for shard_doc in shard_docs:
+        shard = shard_doc.to_dict()
+        counts = counters.setdefault(shard.get("key") or shard["scope"], dict.fromkeys(fields, 0))
+        for field in fields:
+            counts[field] += shard.get(field) or 0
+    return counters
+
+
+def with_ratios(counts: Dict[str, int]) -> Dict:
+    rated = counts["likes"] + counts["dislikes"]
+    return {**counts, "like_ratio": round(counts["likes"] / rated, 4) if rated else None}
+
+
+async def read_counter(collection, scope: str, key: Optional[str] = None, fields: Tuple[str, ...] = COUNTED_FIELDS) -> Dict:
+    """
+    Current value of a counter, STATS_COUNTER_SHARDS reads at most.
+    """
+    shard_docs = await collection.where(filter=firestore.FieldFilter("counter", "==", counter_id(scope, key))).get()
+    return with_ratios(sum_shards(shard_docs, fields).get(key or scope, dict.fromkeys(fields, 0)))
+
+
+async def read_days(collection, days: int) -> List[Dict]:
+    """
+    Daily counters of the last `days` days (today included, UTC), oldest first, in one query served
+    by the composite index (scope, key) of the stats shards.
+    """
+    today = datetime.utcnow().date()
+    first_day = str(today - timedelta(days=days - 1))
+    shard_docs = await (
+        collection.where(filter=firestore.FieldFilter("scope", "==", "day"))
+        .where(filter=firestore.FieldFilter("key", ">=", first_day))
+        .get()
+    )
+    counters = sum_shards(shard_docs)
+    return [
+        {"day": day, **with_ratios(counters.get(day, dict.fromkeys(COUNTED_FIELDS, 0)))}
+        for day in (str(today - timedelta(days=offset)) for offset in range(days - 1, -1, -1))
+    ]
+
+
+async def read_tools(collection) -> List[Dict]:
+    shard_docs = await collection.where(filter=firestore.FieldFilter("scope", "==", "tool")).get()
+    counters = sum_shards(shard_docs, TOOL_COUNTED_FIELDS)
+    return sorted(
+        ({"tool": tool, **with_ratios(counts)} for tool, counts in counters.items()),
+        key=lambda tool: tool["messages"], reverse=True
+    )
+
+
+async def user_stats(user_ref, days: int, conversation_id: Optional[str] = None) -> Dict:
+    collection = user_stats_collection(user_ref)
+    reads = [read_counter(collection, "total"), read_days(collection, days)]
+    if conversation_id:
+        reads.append(read_counter(collection, "conversation", conversation_id))
+    totals, daily, *conversation = await asyncio.gather(*reads)
+    return {"totals": totals, "days": daily, **({"conversation": conversation[0]} if conversation else {})}
+
+
+async def global_stats(days: int) -> Dict:
+    collection = global_stats_collection()
+    totals, daily, tools = await asyncio.gather(read_counter(collection, "total"), read_days(collection, days), read_tools(collection))
+    return {"totals": totals, "days": daily, "tools": tools}
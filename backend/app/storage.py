@@ -0,0 +1,166 @@
+import os
+import re
+import uuid
+from typing import AsyncIterator, Callable, Dict, Optional
+import anyio
+from app.config import BLOB_CHUNK_SIZE, BLOB_STORAGE_BACKEND, BLOB_STORAGE_BUCKET, BLOB_STORAGE_PATH, RUNNING_ON_CLOUD_RUN
+
+BLOB_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+
+class BlobTooLarge(Exception):
+    """Raised when a blob being written exceeds the allowed size."""
+
+
+def new_blob_id() -> str:
+    return uuid.uuid4().hex
+
+
+def validate_blob_id(blob_id: str):
+    # Blob IDs are generated by the API, anything else could escape the storage location
+    if not BLOB_ID_PATTERN.match(blob_id or ""):
+        raise ValueError(f"Invalid blob ID: {blob_id!r}")
+
+
+class BlobStore:
+    """
+    Interface of the blob stores holding large payloads (e.g. audio) out of the Firestore documents.
+    Blobs are written and read as streams of chunks, so they never have to fit in memory.
+    """
+
+    async def write(self, blob_id: str, chunks: AsyncIterator[bytes], max_size: Optional[int] = None) -> int:
+        """Writes the chunks to the blob, returning its size in bytes."""
+        raise NotImplementedError
+
+    def read(self, blob_id: str, chunk_size: int = BLOB_CHUNK_SIZE) -> AsyncIterator[bytes]:
+        raise NotImplementedError
+
+    async def delete(self, blob_id: str):
+        raise NotImplementedError
+
+
+class LocalBlobStore(BlobStore):
+    """
+    Stores blobs as files under a local directory, meant for development and tests.
+    """
+
+    def __init__(self, root: str = BLOB_STORAGE_PATH):
+        self.root = root
+
+    def _path(self, blob_id: str) -> str:
+        validate_blob_id(blob_id)
+        return os.path.join(self.root, blob_id[:2], blob_id)
+
+    async def write(self, blob_id: str, chunks: AsyncIterator[bytes], max_size: Optional[int] = None) -> int:
+        path = self._path(blob_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        size = 0
+        try:
+            async with await anyio.open_file(path, "wb") as file:
+                async for chunk in chunks:
+                    size += len(chunk)
+                    if max_size is not None and size > max_size:
+                        raise BlobTooLarge(f"Blob exceeds {max_size} bytes")
+                    await file.write(chunk)
+        except BaseException:
+            await self.delete(blob_id)
+            raise
+        return size
+
+    async def read(self, blob_id: str, chunk_size: int = BLOB_CHUNK_SIZE) -> AsyncIterator[bytes]:
+        async with await anyio.open_file(self._path(blob_id), "rb") as file:
+            while chunk := await file.read(chunk_size):
+                yield chunk
+
+    async def delete(self, blob_id: str):
+        try:
+            os.remove(self._path(blob_id))
+        except FileNotFoundError:
+            pass
+
+
+class GCSBlobStore(BlobStore):
+    """
+    Stores blobs as objects of a Google Cloud Storage bucket, requires the `google-cloud-storage` package.
+    The client is synchronous, so every chunk is transferred on a worker thread.
+    """
+
+    def __init__(self, bucket: str = BLOB_STORAGE_BUCKET):
+        try:
+            from google.cloud import storage
+        except ImportError:
+            raise RuntimeError("BLOB_STORAGE_BACKEND=gcs requires the 'google-cloud-storage' package")
+        if not bucket:
+            raise RuntimeError("BLOB_STORAGE_BACKEND=gcs requires BLOB_STORAGE_BUCKET to be set")
+        self.bucket = storage.Client().bucket(bucket)
+
+    def _blob(self, blob_id: str):
+        validate_blob_id(blob_id)
+        return self.bucket.blob(blob_id)
+
+    async def write(self, blob_id: str, chunks: AsyncIterator[bytes], max_size: Optional[int] = None) -> int:
+        writer = await anyio.to_thread.run_sync(lambda: self._blob(blob_id).open("wb", chunk_size=BLOB_CHUNK_SIZE * 4))
+
+        size = 0
+        try:
+            async for chunk in chunks:
+                size += len(chunk)
+                if max_size is not None and size > max_size:
+                    raise BlobTooLarge(f"Blob exceeds {max_size} bytes")
+                await anyio.to_thread.run_sync(writer.write, chunk)
+            await anyio.to_thread.run_sync(writer.close)
+        except BaseException:
+            await self.delete(blob_id)
+            raise
+        return size
+
+    async def read(self, blob_id: str, chunk_size: int = BLOB_CHUNK_SIZE) -> AsyncIterator[bytes]:
+        reader = await anyio.to_thread.run_sync(lambda: self._blob(blob_id).open("rb", chunk_size=chunk_size))
+        try:
+            while chunk := await anyio.to_thread.run_sync(reader.read, chunk_size):
+                yield chunk
+        finally:
+            await anyio.to_thread.run_sync(reader.close)
+
+    async def delete(self, blob_id: str):
+        from google.api_core.exceptions import NotFound
+        try:
+            await anyio.to_thread.run_sync(self._blob(blob_id).delete)
+        except NotFound:
+            pass
+
+
+# Available blob stores by name, selected with the BLOB_STORAGE_BACKEND setting
+BLOB_STORES: Dict[str, Callable[[], BlobStore]] = {
+    "local": LocalBlobStore,
+    "gcs": GCSBlobStore,
+}
+
+_blob_store: Optional[BlobStore] = None
+
+
+def get_blob_store() -> BlobStore:
+    global _blob_store
+    if _blob_store is None:
+        _blob_store = BLOB_STORES[BLOB_STORAGE_BACKEND]()
+    return _blob_store
+
+
+def check_blob_store():
+    """
+    Fails the startup of a worker whose blob store is misconfigured (e.g. GCS without its package or
+    bucket) rather than its first upload, and of a Cloud Run instance using the local store: its disk
+    is ephemeral and not shared by the other instances, the blobs written to it would be lost.
+    """
+    if BLOB_STORAGE_BACKEND == "local" and RUNNING_ON_CLOUD_RUN:
+        raise RuntimeError("BLOB_STORAGE_BACKEND=local cannot be used on Cloud Run, set BLOB_STORAGE_BACKEND=gcs and BLOB_STORAGE_BUCKET")
+    get_blob_store()
+
+
+async def iter_bytes(data: bytes, chunk_size: int = BLOB_CHUNK_SIZE) -> AsyncIterator[bytes]:
+    """
+    Adapts in-memory bytes to the chunk stream expected by `BlobStore.write`.
+    """
+    for start in range(0, len(data), chunk_size):
+        yield data[start:start + chunk_size]
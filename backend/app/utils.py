@@ -1,18 +1,77 @@
+import base64
+import binascii
 from datetime import datetime
 import os
-from typing import Dict, List
+from typing import AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple
 from fastapi import HTTPException
 import httpx
-from app.dependencies import USERS_COLLECTION, client
-from app.config import GENAI_API_URL
+from google.api_core.exceptions import NotFound
+from google.cloud import firestore
+from app.dependencies import CONVERSATIONS_COLLECTION, MESSAGES_COLLECTION, async_transactional, client, get_user_entry
+from app.config import (
+    AUDIO_MAX_UPLOAD_BYTES,
+    FIRESTORE_TRANSACTION_MAX_ATTEMPTS,
+    GENAI_LLM_STREAM_PATH,
+    GENAI_LLM_TIMEOUT_SECONDS,
+    GENAI_STT_TIMEOUT_SECONDS,
+    LLM_CACHE_CONTEXT_LOOKBACK,
+    MESSAGE_PREVIEW_LENGTH,
+)
+from app.genai_client import genai_post, genai_stream, iter_sse_events
+from app.jobs import register_job
+from app.llm_cache import answer_cache, normalize_question
+from app.responses import storable_generated_chart
+from app.payloads import CHART_REF_FIELD, DATA_REF_FIELD, delete_blobs, externalize_payloads, replaced_blob_ids
+from app.search import add_index_writes, new_message_index_writes, updated_message_index_writes
+from app.stats import (
+    CounterWrites,
+    add_counter_writes,
+    message_day,
+    new_messages_counter_write_count,
+    new_messages_counter_writes,
+    tools_counter_writes,
+)
+from app.storage import get_blob_store, iter_bytes, new_blob_id
 
-async def call_speech_to_text(base64_audio: str) -> str:
-    url = f"{GENAI_API_URL}/speech/speech-to-text"
-    
-    try:        
-        async with httpx.AsyncClient() as client:
-            response = await client.post(url, json={"audio_base64": base64_audio})
-            print(response)
+FIRESTORE_BATCH_SIZE = 500  # Maximum number of writes allowed in a single Firestore batch
+CONVERSATIONS_VERSION_FIELD = "conversations_version"  # User document field the conversation list ETag is derived from
+
+STT_ERR_MSG = "Hmm, I had a little trouble understanding that. Could you give it another try? 😊"
+LLM_ERR_MSG = "Sorry, an error occurred generating the response."
+
+async def base64_json_body(key: str, chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """
+    Encodes a stream of binary chunks as the JSON body `{"<key>": "<base64 data>"}`, chunk by chunk.
+    """
+    yield b'{"' + key.encode() + b'": "'
+    remainder = b""
+    async for chunk in chunks:
+        chunk = remainder + chunk
+        cut = len(chunk) - len(chunk) % 3  # Base64 encodes groups of 3 bytes
+        yield base64.b64encode(chunk[:cut])
+        remainder = chunk[cut:]
+    yield base64.b64encode(remainder) + b'"}'
+
+
+async def call_speech_to_text(base64_audio: Optional[str] = None, audio_id: Optional[str] = None) -> str:
+    """
+    Transcribes audio given either as a base64 string or as the ID of a stored audio blob,
+    in which case the blob is streamed to the GenAI service without being loaded in memory.
+    """
+    try:
+        if audio_id:
+            response = await genai_post(
+                "/speech/speech-to-text",
+                content=lambda: base64_json_body("audio_base64", get_blob_store().read(audio_id)),
+                timeout=GENAI_STT_TIMEOUT_SECONDS
+            )
+        else:
+            response = await genai_post(
+                "/speech/speech-to-text",
+                {"audio_base64": base64_audio},
+                timeout=GENAI_STT_TIMEOUT_SECONDS
+            )
+        print(response)
         if response.status_code == 200:
             transcription = response.json().get("transcription")
             if transcription:
@@ -29,8 +88,39 @@ async def call_speech_to_text(base64_audio: str) -> str:
         return None
     
 
-async def call_llm_invoke(message: str, session_id: str, user_name: str, create_time: str, message_id: str):
-    url = f"{GENAI_API_URL}/llm/invoke"
+async def conversation_context_id(conversation_id: str, current_user, message_id: str, message: str, before: str) -> str:
+    """
+    Conversation state an answer to `message` depends on, for the answer cache: the ID of the last
+    message sent before `before` asking something else ("" at the start of the conversation). Messages
+    asking the same question (double submits, re-asks) are skipped, so they share the state. Only read
+    when the cache is enabled, from the last LLM_CACHE_CONTEXT_LOOKBACK messages.
+    """
+    if not answer_cache.enabled:
+        return ""
+    user_ref = await get_user_reference(current_user)
+    query = (
+        get_conversation_reference(user_ref, conversation_id).collection(MESSAGES_COLLECTION)
+        .where(filter=firestore.FieldFilter("timestamp", "<=", before))
+        .order_by("timestamp", direction=firestore.Query.DESCENDING)
+        .limit(LLM_CACHE_CONTEXT_LOOKBACK)
+        .select(["question.content", "question.transcription"])
+    )
+    question = normalize_question(message)
+    message_docs = await query.get()
+    for message_doc in message_docs:
+        asked = message_doc.to_dict().get("question") or {}
+        if message_doc.id != message_id and normalize_question(asked.get("transcription") or asked.get("content") or "") != question:
+            return message_doc.id
+    # Only the same question within the lookback, the oldest one read stands for what came before it
+    return message_docs[-1].id if len(message_docs) == LLM_CACHE_CONTEXT_LOOKBACK else ""
+
+
+async def call_llm_invoke(message: str, session_id: str, user_name: str, create_time: str, message_id: str, persist: bool = True):
+    """
+    Asks the LLM to answer a message, returns its output or None when it failed (the error message
+    is then stored as the answer). With `persist` False the caller stores the answer itself, along
+    with its own fields, so the answer is written (and its tools counted) once.
+    """
     payload = {
         "input": {
             "message": message,
@@ -40,90 +130,510 @@ async def call_llm_invoke(message: str, session_id: str, user_name: str, create_
             "message_id": message_id
         }
     }
-    ERR_MESSAGE="Sorry, an error occurred generating the response."
-    async with httpx.AsyncClient(timeout=120.0) as client:
-        try:
-            response = await client.post(url, json=payload)
-            response.raise_for_status()
-            data = response.json()
-            return data.get("output", {"content": "No response from LLM"})
-        except httpx.HTTPStatusError as e:
-            update_message_content(session_id, user_name, message_id, ERR_MESSAGE)
-            return None
-            
-        except Exception as e:
-            print(f"An error occurred: {e}")
-            update_message_content(session_id, user_name, message_id, ERR_MESSAGE)
-            return None
 
+    async def invoke():
+        response = await genai_post("/llm/invoke", payload, timeout=GENAI_LLM_TIMEOUT_SECONDS, idempotent=False)
+        response.raise_for_status()
+        data = response.json()
+        return data.get("output", {"content": "No response from LLM"})
 
-def store_message(conversation_id, current_user, message_data):
-    # Query Firestore to retrieve the user document
-    user_query = client.collection(USERS_COLLECTION).where("username", "==", current_user["username"]).limit(1).stream()
-    user_docs = list(user_query)
+    try:
+        # Identical questions in the same conversation state are answered from the cache or share an in-flight call, when enabled
+        context_id = await conversation_context_id(session_id, user_name, message_id, message, create_time)
+        output, shared = await answer_cache.get_or_call(answer_cache.key(user_name, session_id, message, context_id), invoke)
+    except httpx.HTTPStatusError as e:
+        await update_message_content(session_id, user_name, message_id, LLM_ERR_MSG, only_if_empty=True)
+        return None
 
-    if not user_docs:
-        raise HTTPException(status_code=404, detail="User not found")
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        await update_message_content(session_id, user_name, message_id, LLM_ERR_MSG, only_if_empty=True)
+        return None
 
-    user_doc = user_docs[0].reference  # Reference to the user's document
-    user_data = user_docs[0].to_dict()
+    # The GenAI module stores the answer of the message it was asked about, a shared answer
+    # was generated for another message so it is stored here
+    if not persist:
+        return output
+    if shared:
+        await update_message_fields(session_id, user_name, message_id, answer_fields(output))
+    else:
+        await touch_conversation(session_id, user_name, message_id, answer_fields(output))
+    return output
 
-    # Find the specified conversation and update it with the new message
-    conversations = user_data.get("conversations", [])
-    conversation_found = False
 
-    for conversation in conversations:
-        if conversation["conversation_id"] == conversation_id:
-            conversation["messages"].append(message_data)
-            conversation["last_interaction"] = str(datetime.utcnow())
-            conversation_found = True
-            break
+async def stream_llm_invoke(message: str, session_id: str, user_name: str, create_time: str, message_id: str):
+    """
+    Streams the LLM answer from the GenAI service, yielding each output chunk as a dict.
+    Text deltas are yielded under `content`, other output fields (e.g. `generated_chart`) as received.
+    A cached answer (LLM_CACHE_ENABLED) is yielded whole, streams are not coalesced but a completed
+    stream is cached.
+    """
+    context_id = await conversation_context_id(session_id, user_name, message_id, message, create_time)
+    cache_key = answer_cache.key(user_name, session_id, message, context_id)
+    cached = answer_cache.get(cache_key)
+    if cached is not None:
+        yield cached
+        return
 
-    if not conversation_found:
-        raise HTTPException(status_code=404, detail="Conversation not found")
+    payload = {
+        "input": {
+            "message": message,
+            "session_id": session_id,
+            "user_name": user_name,
+            "createTime": create_time,
+            "message_id": message_id
+        }
+    }
+    output = {"content": ""}
+    async with genai_stream(GENAI_LLM_STREAM_PATH, payload, timeout=GENAI_LLM_TIMEOUT_SECONDS) as response:
+        async for event, data in iter_sse_events(response):
+            if event == "end":
+                break
+            if event == "error":
+                raise RuntimeError(f"LLM stream error: {data}")
+            if event not in ("data", "message"):
+                continue  # e.g. metadata events
 
-    # Update Firestore with the modified conversations list
-    user_doc.update({
-        "conversations": conversations
-    })
+            if isinstance(data, str):
+                data = {"content": data}
+            if not isinstance(data, dict):
+                continue
+
+            # Complete answer, assembled for the cache
+            content = data.get("content")
+            if isinstance(content, str) and isinstance(output["content"], str):
+                output["content"] += content
+            elif content is not None:
+                output["content"] = content
+            output.update({key: value for key, value in data.items() if key != "content"})
+            yield data
+
+    # The stream completed (end event or end of the response), the assembled answer can be reused
+    answer_cache.set(cache_key, output)
 
 
-def update_message_content(conversation_id: str, current_user: str, message_id: str, content: str):
+async def get_user_reference(current_user):
     """
-    Updates the answer content for a specific message in Firestore.
+    Returns the Firestore document reference of the given user, accepting either the
+    user returned by `get_current_user` or a username.
     """
-    # Query Firestore to retrieve the user document
-    user_query = client.collection(USERS_COLLECTION).where("username", "==", current_user).limit(1).stream()
-    user_docs = list(user_query)
+    if isinstance(current_user, dict):
+        return current_user["reference"]
 
-    if not user_docs:
+    user = await get_user_entry(current_user)
+    if user is None:
         raise HTTPException(status_code=404, detail="User not found")
 
-    user_doc = user_docs[0].reference  # Reference to the user's document
-    user_data = user_docs[0].to_dict()
-
-    # Find the specified conversation and message
-    conversations = user_data.get("conversations", [])
-    conversation_found = False
-    message_found = False
-
-    for conversation in conversations:
-        if conversation["conversation_id"] == conversation_id:
-            conversation_found = True
-            for message in conversation["messages"]:
-                if message["message_id"] == message_id:
-                    message["answer"]["content"] = content
-                    message_found = True
-                    break
-            break
-
-    if not conversation_found:
+    return user["reference"]
+
+
+def get_conversation_reference(user_ref, conversation_id: str):
+    """
+    Returns the document reference of a conversation stored under the user document.
+    """
+    return user_ref.collection(CONVERSATIONS_COLLECTION).document(conversation_id)
+
+
+def get_message_reference(conversation_ref, message_id: str):
+    """
+    Returns the document reference of a message stored under the conversation document.
+    """
+    return conversation_ref.collection(MESSAGES_COLLECTION).document(message_id)
+
+
+async def delete_collection(collection_ref, batch_size: int = FIRESTORE_BATCH_SIZE):
+    """
+    Deletes every document of a collection, in batched writes of at most `batch_size` documents.
+    """
+    while True:
+        docs = await collection_ref.limit(batch_size).get()
+        if not docs:
+            return
+
+        batch = client.batch()
+        for doc in docs:
+            batch.delete(doc.reference)
+        await batch.commit()
+
+
+async def iter_query_pages(query, page_size: int) -> AsyncIterator[List]:
+    """
+    Yields the documents of an ordered query page by page, each page read by its own request
+    (resumed after the last document of the previous one), so a long read holds one page in
+    memory and no query stays open while the caller processes a page.
+    """
+    cursor = None
+    while True:
+        page_query = query.start_after(cursor) if cursor is not None else query
+        documents = await page_query.limit(page_size).get()
+        if documents:
+            yield documents
+        if len(documents) < page_size:
+            return
+        cursor = documents[-1]
+
+
+async def get_message_page(
+    conversation_ref,
+    limit: Optional[int] = None,
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    since: Optional[str] = None
+) -> Tuple[List[Dict], bool]:
+    """
+    Retrieves messages of a conversation in chronological order, served by the Firestore
+    timestamp index. With a `limit` and no cursor the newest page is returned; `before`
+    pages backwards from a message ID, `after` forwards from a message ID and `since`
+    returns the messages newer than a timestamp.
+    Returns the messages and whether more messages exist in the paging direction.
+    """
+    messages_ref = conversation_ref.collection(MESSAGES_COLLECTION)
+    cursor_id = before or after
+    newest_first = bool(before) or (limit is not None and not after and not since)
+
+    query = messages_ref.order_by("timestamp", direction=firestore.Query.DESCENDING if newest_first else firestore.Query.ASCENDING)
+    if cursor_id:
+        cursor_doc = await get_message_reference(conversation_ref, cursor_id).get(field_paths=["timestamp"])
+        if not cursor_doc.exists:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        query = query.start_after(cursor_doc)
+    elif since:
+        query = query.where(filter=firestore.FieldFilter("timestamp", ">", since))
+
+    if limit is not None:
+        query = query.limit(limit + 1)  # One extra message tells whether there are more
+
+    messages = [message_doc.to_dict() async for message_doc in query.stream()]
+    has_more = limit is not None and len(messages) > limit
+    messages = messages[:limit] if limit is not None else messages
+
+    if newest_first:
+        messages.reverse()
+    return messages, has_more
+
+
+async def store_base64_audio(base64_audio: str) -> str:
+    """
+    Decodes base64 audio into a new blob, returning the blob ID referenced by the message.
+    """
+    try:
+        audio = base64.b64decode(base64_audio, validate=True)
+    except (binascii.Error, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid base64 audio")
+
+    if len(audio) > AUDIO_MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail=f"Audio exceeds {AUDIO_MAX_UPLOAD_BYTES} bytes")
+
+    audio_id = new_blob_id()
+    await get_blob_store().write(audio_id, iter_bytes(audio))
+    return audio_id
+
+
+def message_preview(message_data: Dict) -> str:
+    """
+    Returns the preview of a message shown in the conversation list, audio questions
+    are previewed with their transcription.
+    """
+    question = message_data.get("question") or {}
+    text = question.get("transcription") or (question.get("content") if question.get("type") != "AUDIO" else None)
+    return (text or "")[:MESSAGE_PREVIEW_LENGTH]
+
+
+async def store_message(conversation_id, current_user, message_data):
+    user_ref = await get_user_reference(current_user)
+    conversation_ref = get_conversation_reference(user_ref, conversation_id)
+    message_ref = get_message_reference(conversation_ref, message_data["message_id"])
+
+    # Write the message document, its search index entries and usage counters and touch the conversation
+    # and the conversation list in a single batch, the update fails (and with it the whole batch) if the conversation does not exist
+    now = str(datetime.utcnow())
+    batch = client.batch()
+    batch.set(message_ref, message_data)
+    add_index_writes(batch, new_message_index_writes(user_ref, conversation_id, message_data))
+    add_counter_writes(batch, new_messages_counter_writes(user_ref, conversation_id, [message_data]))
+    batch.update(conversation_ref, {
+        "last_interaction": now,
+        "updated_at": now,
+        "message_count": firestore.Increment(1),
+        "last_message_preview": message_preview(message_data)
+    })
+    batch.update(user_ref, conversation_list_version())
+
+    try:
+        await batch.commit()
+    except NotFound:
         raise HTTPException(status_code=404, detail="Conversation not found")
-    
-    if not message_found:
+
+
+async def store_messages(user_ref, conversation_id: str, messages: List[Dict]) -> List[Optional[str]]:
+    """
+    Bulk counterpart of `store_message` for messages of a single conversation. The messages are
+    written in batches of at most FIRESTORE_BATCH_SIZE writes, each also updating the conversation
+    summary and the usage counters for the messages it holds, so every committed batch leaves the
+    conversation consistent. The search index entries of each committed batch are written next, in
+    batches of their own. Returns, for each message, None once stored or the error that prevented it.
+    """
+    conversation_ref = get_conversation_reference(user_ref, conversation_id)
+    errors: List[Optional[str]] = []
+
+    for chunk in message_chunks(messages, FIRESTORE_BATCH_SIZE - 2):  # Two writes of each batch are the conversation and user updates
+        now = str(datetime.utcnow())
+        batch = client.batch()
+        for message_data in chunk:
+            batch.set(get_message_reference(conversation_ref, message_data["message_id"]), message_data)
+        add_counter_writes(batch, new_messages_counter_writes(user_ref, conversation_id, chunk))
+        batch.update(conversation_ref, {
+            "last_interaction": now,
+            "updated_at": now,
+            "message_count": firestore.Increment(len(chunk)),
+            "last_message_preview": message_preview(max(chunk, key=lambda message: message["timestamp"]))
+        })
+        batch.update(user_ref, conversation_list_version())
+
+        try:
+            await batch.commit()
+        except NotFound:
+            errors.extend(["Conversation not found"] * len(chunk))
+            continue
+        except Exception as e:
+            print(f"An error occurred storing a batch of messages: {e}")
+            errors.extend(["The message could not be stored"] * len(chunk))
+            continue
+
+        errors.extend([None] * len(chunk))
+        index_writes = [write for message_data in chunk for write in new_message_index_writes(user_ref, conversation_id, message_data)]
+        for index_start in range(0, len(index_writes), FIRESTORE_BATCH_SIZE):
+            batch = client.batch()
+            add_index_writes(batch, index_writes[index_start:index_start + FIRESTORE_BATCH_SIZE])
+            await batch.commit()
+
+    return errors
+
+
+def message_chunks(messages: List[Dict], max_writes: int) -> Iterator[List[Dict]]:
+    """
+    Splits messages in chunks whose writes, one per message plus their counter writes (which grow
+    with the days the messages span), fit in `max_writes`.
+    """
+    chunk, days = [], set()
+    for message_data in messages:
+        day = message_day(message_data.get("timestamp"))
+        chunk_days = days | {day}
+        if chunk and len(chunk) + 1 + new_messages_counter_write_count(len(chunk_days)) > max_writes:
+            yield chunk
+            chunk, chunk_days = [], {day}
+        chunk.append(message_data)
+        days = chunk_days
+    if chunk:
+        yield chunk
+
+
+def conversation_version() -> Dict:
+    """
+    Conversation fields to update along with any change of its messages, `updated_at` is the
+    version the message list validators (ETag, Last-Modified) are derived from.
+    """
+    return {"updated_at": str(datetime.utcnow())}
+
+
+def conversation_list_version() -> Dict:
+    """
+    User document fields to update along with any change of the conversation summaries (a conversation
+    created or deleted, messages stored), `conversations_version` is the version the conversation list
+    ETag is derived from, so it can be checked without querying the summaries.
+    """
+    return {CONVERSATIONS_VERSION_FIELD: firestore.Increment(1)}
+
+
+async def touch_conversation(conversation_id: str, current_user, message_id: str, fields: Dict):
+    """
+    Bumps the version of a conversation whose message was changed outside of this API (e.g. answers
+    written by the GenAI module), re-indexes the changed `fields` of the message and moves its large
+    payloads out of line.
+    """
+    user_ref = await get_user_reference(current_user)
+    conversation_ref = get_conversation_reference(user_ref, conversation_id)
+    message_ref = get_message_reference(conversation_ref, message_id)
+    previous_blob_ids = await replaced_blob_ids(message_ref, fields)
+    payload_fields, blob_ids = await externalize_payloads(fields)
+
+    batch = client.batch()
+    batch.update(conversation_ref, conversation_version())
+    if blob_ids or previous_blob_ids:
+        batch.update(message_ref, {
+            field: value for field, value in payload_fields.items()
+            if field in ("data", "answer.generated_chart", DATA_REF_FIELD, CHART_REF_FIELD)
+        })
+    add_index_writes(batch, await updated_message_index_writes(user_ref, conversation_id, message_id, fields))
+    add_counter_writes(batch, tools_counter_writes(fields))
+    try:
+        await batch.commit()
+    except NotFound:
+        await delete_blobs(blob_ids)  # Deleted in the meantime
+        return
+    await delete_blobs(previous_blob_ids)
+
+
+async def update_message_fields(conversation_id: str, current_user, message_id: str, fields: Dict):
+    """
+    Updates the given fields (dotted paths allowed, e.g. `answer.content`) of a single message document.
+    """
+    user_ref = await get_user_reference(current_user)
+    conversation_ref = get_conversation_reference(user_ref, conversation_id)
+    message_ref = get_message_reference(conversation_ref, message_id)
+
+    # Large tables and charts are written to the blob store first, the message only references them.
+    # The blobs of the payloads they replace are deleted once the message no longer references them
+    previous_blob_ids = await replaced_blob_ids(message_ref, fields)
+    fields, blob_ids = await externalize_payloads(fields)
+
+    # The message, its search index entries, the usage counters and the conversation version are updated in a single batch
+    batch = client.batch()
+    batch.update(message_ref, fields)
+    batch.update(conversation_ref, conversation_version())
+    add_index_writes(batch, await updated_message_index_writes(user_ref, conversation_id, message_id, fields))
+    add_counter_writes(batch, tools_counter_writes(fields))
+    try:
+        await batch.commit()
+    except NotFound:
+        await delete_blobs(blob_ids)
         raise HTTPException(status_code=404, detail="Message not found")
+    await delete_blobs(previous_blob_ids)
 
-    # Update Firestore with the modified conversations list
-    user_doc.update({
-        "conversations": conversations
-    })
+
+async def update_message_transactionally(
+    conversation_id: str,
+    current_user,
+    message_id: str,
+    mutate: Callable[[Dict], Optional[Dict]],
+    field_paths: Optional[List[str]] = None,
+    counters: Optional[Callable[[Dict, Dict], CounterWrites]] = None
+) -> Tuple[Dict, Optional[Dict]]:
+    """
+    Read-modify-write of a single message document in a Firestore transaction, retried when
+    a concurrent write conflicts. `mutate` receives the current message (restricted to
+    `field_paths`) and returns the fields to update, or None to leave the message untouched.
+    `counters` returns the counter writes of an update, given the message as read and the fields.
+    Updated indexed fields (e.g. `answer.content`) are re-indexed in the same transaction.
+    Returns the message as read and the updated fields.
+    """
+    user_ref = await get_user_reference(current_user)
+    conversation_ref = get_conversation_reference(user_ref, conversation_id)
+    message_ref = get_message_reference(conversation_ref, message_id)
+
+    @async_transactional
+    async def read_modify_write(transaction):
+        message_doc = await message_ref.get(field_paths=field_paths, transaction=transaction)
+        if not message_doc.exists:
+            raise HTTPException(status_code=404, detail="Message not found")
+
+        message = message_doc.to_dict()
+        fields = mutate(message)
+        if fields:
+            # Firestore transactions read everything before writing, the index entries included
+            index_writes = await updated_message_index_writes(user_ref, conversation_id, message_id, fields, transaction)
+            transaction.update(message_ref, fields)
+            transaction.update(conversation_ref, conversation_version())
+            add_index_writes(transaction, index_writes)
+            if counters is not None:
+                add_counter_writes(transaction, counters(message, fields))
+        return message, fields
+
+    return await read_modify_write(client.transaction(max_attempts=FIRESTORE_TRANSACTION_MAX_ATTEMPTS))
+
+
+async def update_message_content(conversation_id: str, current_user: str, message_id: str, content: str, only_if_empty: bool = False):
+    """
+    Updates the answer content for a specific message in Firestore. With `only_if_empty`
+    an answer written concurrently (e.g. by the GenAI module) is never overwritten.
+    """
+    if only_if_empty:
+        await update_message_transactionally(
+            conversation_id,
+            current_user,
+            message_id,
+            lambda message: None if message.get("answer", {}).get("content") else {"answer.content": content},
+            field_paths=["answer.content"]
+        )
+        return
+
+    # Only the answer content field of the message document is written
+    await update_message_fields(conversation_id, current_user, message_id, {"answer.content": content})
+
+
+def answer_fields(output: Dict) -> Dict:
+    """
+    Maps the output of the LLM to the message fields to update.
+    """
+    fields = {"answer.content": output.get("content", "")}
+    if "generated_chart" in output:
+        fields["answer.generated_chart"] = storable_generated_chart(output["generated_chart"])
+    for key in ("data", "tools"):
+        if key in output:
+            fields[key] = output[key]
+    return fields
+
+
+async def fail_audio_message(error: Exception, conversation_id: str, username: str, message_id: str):
+    """
+    Failure handler of `process_audio_message`: the message is marked FAILED with the error, and gets
+    the error answer unless an answer was already stored, so the clients waiting for it are done.
+    """
+    try:
+        await update_message_transactionally(
+            conversation_id,
+            username,
+            message_id,
+            lambda message: {
+                "status": "FAILED",
+                "error": f"{type(error).__name__}: {error}"[:500],
+                **({} if (message.get("answer") or {}).get("content") else {"answer.content": LLM_ERR_MSG}),
+            },
+            field_paths=["answer.content"]
+        )
+    except HTTPException:
+        pass  # Deleted in the meantime
+
+
+@register_job("process_audio_message", on_failure=fail_audio_message)
+async def process_audio_message(conversation_id: str, username: str, message_id: str):
+    """
+    Background job transcribing a stored AUDIO message and answering it, the progress
+    is tracked in the `status` field of the message document.
+    """
+    user_ref = await get_user_reference(username)
+    message_ref = get_message_reference(get_conversation_reference(user_ref, conversation_id), message_id)
+
+    message_doc = await message_ref.get(field_paths=["question.audio_id", "question.content"])
+    if not message_doc.exists:
+        return  # Deleted before the job ran
+    question = message_doc.to_dict().get("question", {})
+    del message_doc
+
+    await update_message_fields(conversation_id, username, message_id, {"status": "TRANSCRIBING"})
+    if question.get("audio_id"):
+        transcription = await call_speech_to_text(audio_id=question["audio_id"])
+    else:
+        transcription = await call_speech_to_text(question.get("content"))  # Messages stored before audio blobs
+    del question  # Don't keep a legacy audio payload around during the LLM call
+
+    if not transcription:
+        await update_message_fields(conversation_id, username, message_id, {"answer.content": STT_ERR_MSG, "status": "FAILED"})
+        return
+
+    await update_message_fields(conversation_id, username, message_id, {"question.transcription": transcription, "status": "ANSWERING"})
+    output = await call_llm_invoke(
+        message=transcription,
+        session_id=conversation_id,
+        user_name=username,
+        create_time=str(datetime.utcnow()),
+        message_id=message_id,
+        persist=False
+    )
+
+    if output is None:
+        # call_llm_invoke already stored the error message as the answer
+        await update_message_fields(conversation_id, username, message_id, {"status": "FAILED"})
+        return
+
+    await update_message_fields(conversation_id, username, message_id, {**answer_fields(output), "status": "DONE"})
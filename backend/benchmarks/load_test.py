@@ -0,0 +1,325 @@
+"""
+Load test of the API hot paths: register, login, create conversation, send messages, list
+messages/conversations and feedback, run by concurrent virtual users.
+
+By default the API is served in-process on the in-memory Firestore stand-in and the fake GenAI
+service, which also reports the Firestore documents and bytes read/written per endpoint.
+Pass --base-url to drive a running server instead (client-side metrics only).
+
+Usage (from the backend directory):
+    python -m benchmarks.load_test --users 50 --concurrency 10 --messages 5
+    python -m benchmarks.load_test --scenario contention --requests 200
+    python -m benchmarks.load_test --base-url http://localhost:8000 --users 20
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import sys
+import time
+import uuid
+from collections import defaultdict
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+
+# The in-process target runs on local stand-ins, configured before the app is imported
+os.environ.setdefault("FIRESTORE_BACKEND", "memory")
+os.environ.setdefault("GENAI_BACKEND", "fake")
+os.environ.setdefault("BLOB_STORAGE_PATH", "./data/benchmark-blobs")
+os.environ.setdefault("RATE_LIMIT_ENABLED", "false")  # Virtual users send faster than the per-user limits allow
+
+import httpx
+
+API_PREFIX = "/api/v1"
+FAKE_AUDIO_BASE64 = base64.b64encode(os.urandom(16 * 1024)).decode()
+
+
+def percentile(values, percent: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(percent / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+class Recorder:
+    """
+    Collects the latency, status and transferred bytes of every request, per endpoint.
+    """
+
+    def __init__(self, firestore_client=None):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.bytes_sent = defaultdict(int)
+        self.bytes_received = defaultdict(int)
+        self.firestore_client = firestore_client
+
+    async def request(self, http: httpx.AsyncClient, endpoint: str, method: str, url: str, **kwargs) -> httpx.Response:
+        with firestore_stats(endpoint) if self.firestore_client is not None else nullcontext():
+            started = time.perf_counter()
+            response = await http.request(method, url, **kwargs)
+            self.latencies[endpoint].append(time.perf_counter() - started)
+
+        self.bytes_sent[endpoint] += len(response.request.content or b"")
+        self.bytes_received[endpoint] += len(response.content)
+        if response.status_code >= 400:
+            self.errors[endpoint] += 1
+        return response
+
+    def report(self, elapsed: float) -> dict:
+        firestore_stats = self.firestore_client.stats.by_label if self.firestore_client is not None else {}
+        report = {}
+        for endpoint, latencies in sorted(self.latencies.items()):
+            stats = firestore_stats.get(endpoint, {})
+            report[endpoint] = {
+                "requests": len(latencies),
+                "errors": self.errors[endpoint],
+                "throughput_rps": len(latencies) / elapsed if elapsed else 0.0,
+                "p50_ms": percentile(latencies, 50) * 1000,
+                "p95_ms": percentile(latencies, 95) * 1000,
+                "p99_ms": percentile(latencies, 99) * 1000,
+                "bytes_sent": self.bytes_sent[endpoint],
+                "bytes_received": self.bytes_received[endpoint],
+                "firestore_reads": stats.get("reads", 0),
+                "firestore_writes": stats.get("writes", 0),
+                "firestore_bytes_read": stats.get("bytes_reads", 0),
+                "firestore_bytes_written": stats.get("bytes_writes", 0),
+            }
+        return report
+
+
+@contextmanager
+def firestore_stats(label: str):
+    """
+    Accounts the Firestore operations of the in-process app to `label`, the app runs in the
+    task of the request so the context variable reaches it.
+    """
+    from app.firestore_memory import firestore_stats_label
+    token = firestore_stats_label.set(label)
+    try:
+        yield
+    finally:
+        firestore_stats_label.reset(token)
+
+
+@asynccontextmanager
+async def open_target(base_url: str = None):
+    """
+    Yields an HTTP client to the API and, for the in-process target, the in-memory Firestore client.
+    """
+    if base_url:
+        async with httpx.AsyncClient(base_url=base_url, timeout=300) as http:
+            yield http, None
+        return
+
+    from app.dependencies import client as firestore_client
+    from app.main import app
+
+    # ASGITransport does not run the lifespan, so it is entered explicitly
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=300) as http:
+            yield http, firestore_client
+
+
+async def login(http, recorder: Recorder, username: str, password: str) -> dict:
+    await recorder.request(http, "POST /auth/register/", "POST", f"{API_PREFIX}/auth/register/",
+                           json={"username": username, "password": password})
+    response = await recorder.request(http, "POST /auth/token/", "POST", f"{API_PREFIX}/auth/token/",
+                                      data={"username": username, "password": password})
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+
+async def create_conversation(http, recorder: Recorder, headers: dict) -> str:
+    response = await recorder.request(http, "POST /conversations/", "POST", f"{API_PREFIX}/conversations/",
+                                      json={"title": "Benchmark conversation"}, headers=headers)
+    return response.json()["conversation_id"]
+
+
+async def user_workflow(http, recorder: Recorder, args):
+    headers = await login(http, recorder, f"bench-{uuid.uuid4().hex[:12]}", "benchmark-password")
+    conversation_id = await create_conversation(http, recorder, headers)
+    conversation_url = f"{API_PREFIX}/conversations/{conversation_id}"
+
+    message_ids = []
+    for index in range(args.messages):
+        if args.audio_every and (index + 1) % args.audio_every == 0:
+            response = await recorder.request(
+                http, "POST /conversations/{id}/audio/", "POST", f"{conversation_url}/audio/",
+                json={"question": {"type": "AUDIO", "content": FAKE_AUDIO_BASE64}}, headers=headers
+            )
+        else:
+            response = await recorder.request(
+                http, "POST /conversations/{id}/text/", "POST", f"{conversation_url}/text/",
+                json={"question": {"type": "TEXT", "content": f"Benchmark question {index}"}}, headers=headers
+            )
+        if response.status_code < 400:
+            message_ids.append(response.json()["message_id"])
+
+        await recorder.request(http, "GET /conversations/{id}/messages/", "GET", f"{conversation_url}/messages/",
+                               params={"limit": 20}, headers=headers)
+
+    if message_ids:
+        await recorder.request(
+            http, "PUT /conversations/{id}/messages/{id}/feedback/", "PUT",
+            f"{conversation_url}/messages/{message_ids[-1]}/feedback/", json={"feedback": "LIKE"}, headers=headers
+        )
+    await recorder.request(http, "GET /conversations/", "GET", f"{API_PREFIX}/conversations/", headers=headers)
+
+
+async def run_workflow(http, recorder: Recorder, args) -> bool:
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def bounded_workflow():
+        async with semaphore:
+            await user_workflow(http, recorder, args)
+
+    await asyncio.gather(*(bounded_workflow() for _ in range(args.users)))
+    return True
+
+
+async def wait_for_messages(http, recorder: Recorder, conversation_url: str, message_ids: list, headers: dict):
+    """
+    Polls the status of background messages until they are all DONE or FAILED.
+    """
+    pending = set(message_ids)
+    while pending:
+        for message_id in list(pending):
+            response = await recorder.request(
+                http, "GET /conversations/{id}/messages/{id}/status/", "GET",
+                f"{conversation_url}/messages/{message_id}/status/", headers=headers
+            )
+            if response.status_code >= 400 or response.json()["status"] in ("DONE", "FAILED"):
+                pending.discard(message_id)
+        if pending:
+            await asyncio.sleep(0.05)
+
+
+async def run_contention(http, recorder: Recorder, args) -> bool:
+    """
+    Hammers a single user and conversation with parallel messages and feedback updates, then
+    checks that no update was lost:
+    - every text message gets concurrent, conflicting feedback clicks;
+    - every background audio message gets its feedback while its job writes the status, the
+      transcription and the answer of the same document, so the feedback transactions conflict
+      with the job's writes and are retried.
+    """
+    headers = await login(http, recorder, f"bench-{uuid.uuid4().hex[:12]}", "benchmark-password")
+    conversation_id = await create_conversation(http, recorder, headers)
+    conversation_url = f"{API_PREFIX}/conversations/{conversation_id}"
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def send(index: int):
+        async with semaphore:
+            return await recorder.request(
+                http, "POST /conversations/{id}/text/", "POST", f"{conversation_url}/text/",
+                json={"question": {"type": "TEXT", "content": f"Contention question {index}"}}, headers=headers
+            )
+
+    responses = await asyncio.gather(*(send(index) for index in range(args.requests)))
+    message_ids = [response.json()["message_id"] for response in responses if response.status_code < 400]
+
+    async def feedback(message_id: str, value: str):
+        async with semaphore:
+            await recorder.request(
+                http, "PUT /conversations/{id}/messages/{id}/feedback/", "PUT",
+                f"{conversation_url}/messages/{message_id}/feedback/", json={"feedback": value}, headers=headers
+            )
+
+    # Every message gets concurrent, conflicting feedback clicks
+    await asyncio.gather(*(
+        feedback(message_id, value) for message_id in message_ids for value in ("LIKE", "DISLIKE", "LIKE")
+    ))
+
+    # Every audio message gets its feedback as soon as it is accepted, while its job is running
+    expected_feedback = {}
+
+    async def send_audio_with_feedback(index: int):
+        async with semaphore:
+            response = await recorder.request(
+                http, "POST /conversations/{id}/audio/", "POST", f"{conversation_url}/audio/",
+                params={"background": "true"}, headers=headers,
+                json={"question": {"type": "AUDIO", "content": FAKE_AUDIO_BASE64}}
+            )
+        if response.status_code >= 400:
+            return
+        message_id = response.json()["message_id"]
+        expected_feedback[message_id] = "LIKE" if index % 2 == 0 else "DISLIKE"
+        await feedback(message_id, expected_feedback[message_id])
+
+    await asyncio.gather(*(send_audio_with_feedback(index) for index in range(args.requests)))
+    await wait_for_messages(http, recorder, conversation_url, list(expected_feedback), headers)
+
+    messages = (await recorder.request(http, "GET /conversations/{id}/messages/", "GET",
+                                       f"{conversation_url}/messages/", headers=headers)).json()["messages"]
+    conversations = (await recorder.request(http, "GET /conversations/", "GET",
+                                            f"{API_PREFIX}/conversations/", headers=headers)).json()["conversations"]
+    message_count = next(conv["message_count"] for conv in conversations if conv["conversation_id"] == conversation_id)
+    stats = (await recorder.request(http, "GET /stats/", "GET", f"{API_PREFIX}/stats/",
+                                    params={"conversation_id": conversation_id}, headers=headers)).json()
+    audio_messages = [message for message in messages if message["message_id"] in expected_feedback]
+
+    stored_ids = {message["message_id"] for message in messages}
+    stored_likes = sum(message["feedback"] == "LIKE" for message in messages)
+    checks = {
+        "all messages stored": stored_ids == set(message_ids) | set(expected_feedback),
+        "message_count matches": message_count == len(message_ids) + len(expected_feedback),
+        "every feedback applied": all(message["feedback"] in ("LIKE", "DISLIKE") for message in messages),
+        "audio feedback kept": all(message["feedback"] == expected_feedback[message["message_id"]] for message in audio_messages),
+        "audio answers kept": all(
+            message["status"] == "DONE" and message["question"]["transcription"] and message["answer"]["content"]
+            for message in audio_messages
+        ),
+        "feedback counters match": stats.get("conversation", {}).get("likes") in (None, stored_likes),
+    }
+    for check, passed in checks.items():
+        print(f"[{'OK' if passed else 'FAIL'}] {check}")
+    if recorder.firestore_client is not None:
+        aborted = sum(counters.get("aborted_transactions", 0) for counters in recorder.firestore_client.stats.by_label.values())
+        print(f"{aborted} transactions aborted by concurrent writes and retried")
+    return all(checks.values())
+
+
+def print_report(report: dict, elapsed: float):
+    columns = ["requests", "errors", "throughput_rps", "p50_ms", "p95_ms", "p99_ms",
+               "bytes_received", "firestore_reads", "firestore_bytes_read", "firestore_bytes_written"]
+    width = max(len(endpoint) for endpoint in report) if report else 10
+    print(f"{'endpoint':<{width}}  " + "  ".join(f"{column:>22}" for column in columns))
+    for endpoint, metrics in report.items():
+        values = [f"{metrics[column]:>22.1f}" if isinstance(metrics[column], float) else f"{metrics[column]:>22}"
+                  for column in columns]
+        print(f"{endpoint:<{width}}  " + "  ".join(values))
+    total = sum(metrics["requests"] for metrics in report.values())
+    print(f"\n{total} requests in {elapsed:.2f}s ({total / elapsed if elapsed else 0:.1f} req/s)")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Load test of the conversations API.")
+    parser.add_argument("--scenario", choices=["workflow", "contention"], default="workflow")
+    parser.add_argument("--base-url", help="Drive a running server instead of the in-process app.")
+    parser.add_argument("--users", type=int, default=20, help="Virtual users of the workflow scenario.")
+    parser.add_argument("--concurrency", type=int, default=10, help="Maximum concurrent users/requests.")
+    parser.add_argument("--messages", type=int, default=5, help="Messages sent by each virtual user.")
+    parser.add_argument("--audio-every", type=int, default=0, help="Send every Nth message as audio (0 = never).")
+    parser.add_argument("--requests", type=int, default=100, help="Parallel messages of the contention scenario.")
+    parser.add_argument("--json", dest="json_path", help="Also write the report to this JSON file.")
+    args = parser.parse_args()
+
+    async with open_target(args.base_url) as (http, firestore_client):
+        recorder = Recorder(firestore_client)
+        started = time.perf_counter()
+        scenario = run_contention if args.scenario == "contention" else run_workflow
+        passed = await scenario(http, recorder, args)
+        elapsed = time.perf_counter() - started
+
+    report = recorder.report(elapsed)
+    print_report(report, elapsed)
+    if args.json_path:
+        with open(args.json_path, "w") as file:
+            json.dump({"scenario": args.scenario, "elapsed_seconds": elapsed, "endpoints": report}, file, indent=2)
+
+    return 0 if passed else 1
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
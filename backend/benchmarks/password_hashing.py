@@ -0,0 +1,142 @@
+"""
+Event loop responsiveness under concurrent logins.
+
+A heartbeat task ticks every few milliseconds on the event loop and records how late each tick
+fires, while concurrent password verifications run:
+    - inline: bcrypt called on the event loop, as the login handler used to do,
+    - pool:   bcrypt on the password hashing pool (app.passwords),
+    - api:    real logins against the in-process API (or --base-url, client-side only),
+              including the 503 rejections of the admission control.
+
+Usage (from the backend directory):
+    python -m benchmarks.password_hashing --logins 50
+    python -m benchmarks.password_hashing --mode api --logins 200
+"""
+import argparse
+import asyncio
+import sys
+import time
+import uuid
+
+from benchmarks.load_test import API_PREFIX, open_target, percentile
+
+PASSWORD = "benchmark-password"
+
+
+class Heartbeat:
+    """
+    Measures the event loop lag: the delay between when a tick was due and when it ran.
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.lags = []
+        self._task = None
+        self._due = None
+
+    async def _run(self):
+        while True:
+            self._due = time.perf_counter() + self.interval
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, time.perf_counter() - self._due))
+            self._due = None
+
+    def __enter__(self):
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    def __exit__(self, *exc_info):
+        # A tick blocked until the end of the burst has not run yet, its lag counts too
+        if self._due is not None:
+            self.lags.append(max(0.0, time.perf_counter() - self._due))
+        self._task.cancel()
+
+
+async def run_inline(args) -> dict:
+    from app.dependencies import get_password_hash, verify_password
+    hashed_password = get_password_hash(PASSWORD)
+
+    async def login():
+        started = time.perf_counter()
+        verify_password(PASSWORD, hashed_password)
+        return time.perf_counter() - started, 200
+
+    return await run_logins(args, login)
+
+
+async def run_pool(args) -> dict:
+    from app.passwords import PasswordHasherBusy, close_password_hasher, get_password_hasher
+    hasher = get_password_hasher()
+    hashed_password = await hasher.hash(PASSWORD)
+
+    async def login():
+        started = time.perf_counter()
+        try:
+            await hasher.verify(PASSWORD, hashed_password)
+            status = 200
+        except PasswordHasherBusy:
+            status = 503
+        return time.perf_counter() - started, status
+
+    try:
+        return await run_logins(args, login)
+    finally:
+        close_password_hasher()
+
+
+async def run_api(args) -> dict:
+    async with open_target(args.base_url) as (http, _):
+        username = f"bench-{uuid.uuid4().hex[:12]}"
+        await http.post(f"{API_PREFIX}/auth/register/", json={"username": username, "password": PASSWORD})
+
+        async def login():
+            started = time.perf_counter()
+            response = await http.post(f"{API_PREFIX}/auth/token/", data={"username": username, "password": PASSWORD})
+            return time.perf_counter() - started, response.status_code
+
+        return await run_logins(args, login)
+
+
+async def run_logins(args, login) -> dict:
+    # Let the heartbeat settle before the burst
+    with Heartbeat() as heartbeat:
+        await asyncio.sleep(0.05)
+        started = time.perf_counter()
+        results = await asyncio.gather(*(login() for _ in range(args.logins)))
+        elapsed = time.perf_counter() - started
+
+    latencies = [latency for latency, status in results if status < 400]
+    return {
+        "logins": len(results),
+        "rejected": sum(1 for _, status in results if status == 503),
+        "errors": sum(1 for _, status in results if status >= 400 and status != 503),
+        "elapsed_s": elapsed,
+        "login_p50_ms": percentile(latencies, 50) * 1000,
+        "login_p99_ms": percentile(latencies, 99) * 1000,
+        "loop_lag_p50_ms": percentile(heartbeat.lags, 50) * 1000,
+        "loop_lag_p99_ms": percentile(heartbeat.lags, 99) * 1000,
+        "loop_lag_max_ms": max(heartbeat.lags, default=0.0) * 1000,
+    }
+
+
+MODES = {"inline": run_inline, "pool": run_pool, "api": run_api}
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Event loop lag under concurrent password verifications.")
+    parser.add_argument("--mode", choices=["all", *MODES], default="all")
+    parser.add_argument("--logins", type=int, default=50, help="Concurrent logins of the burst.")
+    parser.add_argument("--base-url", help="Drive a running server in the api mode instead of the in-process app.")
+    args = parser.parse_args()
+
+    modes = list(MODES) if args.mode == "all" else [args.mode]
+    for mode in modes:
+        result = await MODES[mode](args)
+        print(f"{mode:<7} " + "  ".join(
+            f"{key}={value:.1f}" if isinstance(value, float) else f"{key}={value}" for key, value in result.items()
+        ))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,148 @@
+"""
+Search latency as a user's history grows.
+
+A single user's history is grown step by step with the batch ingestion endpoint (messages drawn
+from a Zipf-distributed vocabulary, spread over conversations), and after each step the same
+queries are run against:
+- `GET /conversations/search/`, served by the inverted index;
+- the client-side scan the search replaces: list the conversations, fetch all their messages
+  and match the terms locally, for the first --scan-queries queries.
+
+The search reads at most SEARCH_CANDIDATES_PER_TERM postings per term and the messages of one page:
+its cost grows with the history until the postings of the query terms fill that window, then stays
+flat, while the scan keeps growing with every message. The in-memory Firestore stand-in also
+reports the documents read per query.
+
+Usage (from the backend directory):
+    python -m benchmarks.search
+    python -m benchmarks.search --sizes 1000 8000 64000 --queries 50
+    python -m benchmarks.search --base-url http://localhost:8000 --scan-queries 0
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import uuid
+
+# The in-process target runs on local stand-ins, configured before the app is imported
+os.environ.setdefault("FIRESTORE_BACKEND", "memory")
+os.environ.setdefault("GENAI_BACKEND", "fake")
+os.environ.setdefault("RATE_LIMIT_ENABLED", "false")
+
+from benchmarks.load_test import API_PREFIX, Recorder, create_conversation, login, open_target, percentile
+
+VOCABULARY_SIZE = 5000
+BATCH_SIZE = 500
+
+
+class Vocabulary:
+    """
+    Synthetic words with Zipf-distributed frequencies, like the words of natural text.
+    """
+
+    def __init__(self, size: int, rng: random.Random):
+        self.rng = rng
+        self.words = [f"w{index}x{rng.randrange(1000)}" for index in range(size)]
+        self.weights = [1 / (rank + 1) for rank in range(size)]
+
+    def text(self, length: int) -> str:
+        return " ".join(self.rng.choices(self.words, weights=self.weights, k=length))
+
+    def query(self) -> str:
+        # Two or three terms, past the most frequent words (the stopwords of natural text)
+        return " ".join(self.rng.choice(self.words[10:VOCABULARY_SIZE // 5]) for _ in range(self.rng.randint(2, 3)))
+
+
+async def grow_history(http, recorder: Recorder, headers: dict, conversation_ids: list, vocabulary: Vocabulary, count: int):
+    items = [
+        {
+            "conversation_id": random.choice(conversation_ids),
+            "question": {"type": "TEXT", "content": vocabulary.text(random.randint(5, 20))},
+            "answer": {"type": "TEXT", "content": vocabulary.text(random.randint(20, 80))},
+        }
+        for _ in range(count)
+    ]
+    for start in range(0, count, BATCH_SIZE):
+        response = await recorder.request(http, "POST /conversations/messages/batch/", "POST",
+                                          f"{API_PREFIX}/conversations/messages/batch/",
+                                          json={"messages": items[start:start + BATCH_SIZE]}, headers=headers)
+        response.raise_for_status()
+
+
+async def scan_search(http, recorder: Recorder, headers: dict, query: str) -> int:
+    """
+    The client-side search: every message of every conversation is fetched and matched locally.
+    """
+    terms = query.casefold().split()
+    conversations = (await recorder.request(http, "scan", "GET", f"{API_PREFIX}/conversations/",
+                                            headers=headers)).json()["conversations"]
+    matches = 0
+    for conversation in conversations:
+        messages = (await recorder.request(
+            http, "scan", "GET", f"{API_PREFIX}/conversations/{conversation['conversation_id']}/messages/", headers=headers
+        )).json()["messages"]
+        for message in messages:
+            text = f"{message['question'].get('content', '')} {message['answer'].get('content', '')}".casefold()
+            matches += any(term in text for term in terms)
+    return matches
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Search latency as a user's history grows.")
+    parser.add_argument("--base-url", help="Drive a running server instead of the in-process app.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 4000, 16000, 32000], help="History sizes, in messages.")
+    parser.add_argument("--conversations", type=int, default=50, help="Conversations the messages are spread over.")
+    parser.add_argument("--queries", type=int, default=30, help="Queries run at each size.")
+    parser.add_argument("--scan-queries", type=int, default=3, help="Queries of the scan baseline (0 = no baseline).")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    vocabulary = Vocabulary(VOCABULARY_SIZE, random.Random(args.seed))
+    queries = [vocabulary.query() for _ in range(args.queries)]
+
+    print(f"{'messages':>10}  {'search p50 ms':>14}  {'search p95 ms':>14}  {'reads/query':>12}  "
+          f"{'scan p50 ms':>12}  {'scan reads/query':>17}")
+
+    async with open_target(args.base_url) as (http, firestore_client):
+        setup = Recorder(firestore_client)
+        headers = await login(http, setup, f"bench-{uuid.uuid4().hex[:12]}", "benchmark-password")
+        conversation_ids = [await create_conversation(http, setup, headers) for _ in range(args.conversations)]
+
+        size = 0
+        for target_size in sorted(args.sizes):
+            await grow_history(http, setup, headers, conversation_ids, vocabulary, target_size - size)
+            size = target_size
+
+            recorder = Recorder(firestore_client)
+            if firestore_client is not None:
+                firestore_client.stats.reset()
+            for query in queries:
+                response = await recorder.request(http, "search", "GET", f"{API_PREFIX}/conversations/search/",
+                                                  params={"q": query, "limit": 20}, headers=headers)
+                response.raise_for_status()
+            scan_queries = queries[:args.scan_queries]
+            for query in scan_queries:
+                await scan_search(http, recorder, headers, query)
+
+            report = recorder.report(elapsed=1.0)
+            search, scan = report["search"], report.get("scan")
+            scan_latencies = []
+            if scan is not None:
+                # A scan is several requests, its latency is the sum of them
+                per_query = len(recorder.latencies["scan"]) // len(scan_queries)
+                scan_latencies = [sum(recorder.latencies["scan"][index:index + per_query])
+                                  for index in range(0, len(recorder.latencies["scan"]), per_query)]
+            print(
+                f"{size:>10}  {search['p50_ms']:>14.1f}  {search['p95_ms']:>14.1f}  "
+                f"{search['firestore_reads'] / len(queries):>12.0f}  "
+                + (f"{percentile(scan_latencies, 50) * 1000:>12.1f}  {scan['firestore_reads'] / len(scan_queries):>17.0f}"
+                   if scan is not None else f"{'-':>12}  {'-':>17}")
+            )
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,6 @@
+import os
+
+# The tests run on the in-memory Firestore stand-in and the fake GenAI service, configured before the app is imported
+os.environ.setdefault("FIRESTORE_BACKEND", "memory")
+os.environ.setdefault("GENAI_BACKEND", "fake")
+os.environ.setdefault("BLOB_STORAGE_PATH", "./data/test-blobs")
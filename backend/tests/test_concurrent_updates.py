@@ -0,0 +1,148 @@
+"""
+Concurrent updates of the same messages on the in-memory Firestore, whose transactions conflict and
+are retried like Firestore's: feedback transactions racing the status and answer writes of the
+background jobs, and conflicting feedback clicks, must neither lose a field nor miscount a counter.
+"""
+import asyncio
+import uuid
+from app.dependencies import USERS_COLLECTION, client, get_user_entry, normalize_username
+from app.models.conversation import ConversationCreate
+from app.routers.conversations import create_conversation
+from app.routers.messages import set_message_feedback
+from app.search import search_messages
+from app.stats import user_stats
+from app.utils import (
+    LLM_ERR_MSG, fail_audio_message, store_message, update_message_content, update_message_fields,
+    update_message_transactionally
+)
+
+
+async def create_user_conversation(message_count: int):
+    username = f"test-{uuid.uuid4().hex[:12]}"
+    await client.start().collection(USERS_COLLECTION).document(normalize_username(username)).set({"username": username})
+    current_user = await get_user_entry(username)
+    conversation_id = (await create_conversation(ConversationCreate(title="Concurrency"), current_user))["conversation_id"]
+
+    message_ids = []
+    for index in range(message_count):
+        message_id = str(uuid.uuid4())
+        await store_message(conversation_id, current_user, {
+            "message_id": message_id,
+            "question": {"type": "AUDIO", "content": ""},
+            "answer": {"type": "TEXT", "content": "", "generated_chart": None},
+            "data": None,
+            "tools": None,
+            "feedback": None,
+            "status": "PENDING",
+            "timestamp": f"2026-01-01 00:00:{index:02d}",
+        })
+        message_ids.append(message_id)
+    return current_user, conversation_id, message_ids
+
+
+async def read_message(current_user: dict, conversation_id: str, message_id: str) -> dict:
+    message_ref = (
+        current_user["reference"].collection("conversations").document(conversation_id)
+        .collection("messages").document(message_id)
+    )
+    return (await message_ref.get()).to_dict()
+
+
+def aborted_transactions() -> int:
+    return sum(counters.get("aborted_transactions", 0) for counters in client.start().stats.by_label.values())
+
+
+def test_feedback_racing_answer_writes_keeps_every_field():
+    async def scenario():
+        current_user, conversation_id, message_ids = await create_user_conversation(20)
+        expected_feedback = {message_id: "LIKE" if index % 2 == 0 else "DISLIKE" for index, message_id in enumerate(message_ids)}
+        aborted_before = aborted_transactions()
+
+        async def answer(message_id: str):
+            # The writes of the audio job, each committed separately
+            await update_message_fields(conversation_id, current_user, message_id, {"status": "TRANSCRIBING"})
+            await update_message_fields(conversation_id, current_user, message_id, {"question.transcription": "transcribed", "status": "ANSWERING"})
+            await update_message_fields(conversation_id, current_user, message_id, {"answer.content": "answered", "status": "DONE"})
+
+        await asyncio.gather(*(
+            coroutine for message_id in message_ids for coroutine in (
+                answer(message_id),
+                set_message_feedback(conversation_id, current_user, message_id, expected_feedback[message_id]),
+            )
+        ))
+
+        for message_id in message_ids:
+            message = await read_message(current_user, conversation_id, message_id)
+            assert message["feedback"] == expected_feedback[message_id]
+            assert message["status"] == "DONE"
+            assert message["question"]["transcription"] == "transcribed"
+            assert message["answer"]["content"] == "answered"
+
+        stats = await user_stats(current_user["reference"], 1, conversation_id)
+        assert stats["conversation"]["likes"] == 10
+        assert stats["conversation"]["dislikes"] == 10
+        assert stats["conversation"]["messages"] == 20
+        # The race is real: feedback transactions were aborted by the job writes and retried
+        assert aborted_transactions() > aborted_before
+
+    asyncio.run(scenario())
+
+
+def test_conflicting_feedback_clicks_keep_counters_consistent():
+    async def scenario():
+        current_user, conversation_id, message_ids = await create_user_conversation(10)
+
+        await asyncio.gather(*(
+            set_message_feedback(conversation_id, current_user, message_id, value)
+            for message_id in message_ids for value in ("LIKE", "DISLIKE", "LIKE", "DISLIKE")
+        ))
+
+        messages = [await read_message(current_user, conversation_id, message_id) for message_id in message_ids]
+        assert all(message["feedback"] in ("LIKE", "DISLIKE") for message in messages)
+        stats = await user_stats(current_user["reference"], 1, conversation_id)
+        assert stats["conversation"]["likes"] == sum(message["feedback"] == "LIKE" for message in messages)
+        assert stats["conversation"]["dislikes"] == sum(message["feedback"] == "DISLIKE" for message in messages)
+
+    asyncio.run(scenario())
+
+
+def test_concurrent_read_modify_writes_are_not_lost():
+    async def scenario():
+        current_user, conversation_id, [message_id] = await create_user_conversation(1)
+
+        # Each writer increments the value it read, a lost update would leave a smaller count
+        await asyncio.gather(*(
+            update_message_transactionally(
+                conversation_id, current_user, message_id,
+                lambda message: {"attempts": (message.get("attempts") or 0) + 1},
+                field_paths=["attempts"]
+            )
+            for _ in range(5)
+        ))
+
+        assert (await read_message(current_user, conversation_id, message_id))["attempts"] == 5
+
+    asyncio.run(scenario())
+
+
+def test_racing_answers_are_indexed_as_stored():
+    async def scenario():
+        current_user, conversation_id, message_ids = await create_user_conversation(10)
+
+        # The error answer of a failed job races the answer of the request, the first one written is kept
+        await asyncio.gather(*(
+            coroutine for message_id in message_ids for coroutine in (
+                fail_audio_message(RuntimeError("boom"), conversation_id, current_user["username"], message_id),
+                update_message_content(conversation_id, current_user, message_id, "answered", only_if_empty=True),
+            )
+        ))
+
+        messages = {message_id: await read_message(current_user, conversation_id, message_id) for message_id in message_ids}
+        assert all(message["status"] == "FAILED" for message in messages.values())
+        for query, answer in (("occurred", LLM_ERR_MSG), ("answered", "answered")):
+            results, _ = await search_messages(current_user["reference"], query, limit=len(message_ids))
+            assert {result["message_id"] for result in results} == {
+                message_id for message_id, message in messages.items() if message["answer"]["content"] == answer
+            }
+
+    asyncio.run(scenario())